@@ -0,0 +1,104 @@
+"""Benchmark candidates/sec of the active sampling loop on CPU.
+
+Every workload runs a --model_layers transformer encoder over --workload_size
+sequences on the CPU, in place of a BERT sampling step, and hands the kernels
+of --kernels_dir to the clang workers, which compile them and extract their
+Grewe features as text_candidate_worker does. Workloads are run with
+--active_pipeline_depth 0, the lockstep loop, and with every depth up to
+--max_pipeline_depth, which lets the clang workers process previous workloads
+while the model samples.
+
+  $ python -m deeplearning.clgen.benchmarks.active_pipeline_benchmark \
+      --kernels_dir=rodinia_benchmarks
+"""
+import collections
+import pathlib
+import time
+import typing
+
+from absl import app, flags
+
+from deeplearning.clgen.features import extractor
+from deeplearning.clgen.models.torch_bert import data_generator
+from deeplearning.clgen.preprocessors import clang
+from deeplearning.clgen.preprocessors import opencl
+from deeplearning.clgen.util.pytorch import torch
+from eupy.native import logger as l
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string(
+  "kernels_dir",
+  "rodinia_benchmarks",
+  "Directory of OpenCL kernels (*.cl) used as candidates."
+)
+flags.DEFINE_integer(
+  "num_workloads",
+  20,
+  "Number of sampled workloads per run."
+)
+flags.DEFINE_integer(
+  "workload_size",
+  256,
+  "Number of candidates of every workload."
+)
+flags.DEFINE_integer(
+  "model_layers",
+  2,
+  "Number of transformer layers of the model step."
+)
+flags.DEFINE_integer(
+  "max_pipeline_depth",
+  2,
+  "Largest pipeline depth to benchmark."
+)
+
+def _CandidateWorker(src: str) -> typing.Optional[typing.Dict[str, float]]:
+  try:
+    _ = opencl.Compile(src)
+    return extractor.ExtractFeatures(src, ["GreweFeatures"])["GreweFeatures"]
+  except ValueError:
+    return None
+
+def _Run(model: torch.nn.Module, kernels: typing.List[str], depth: int) -> float:
+  """Run the workloads with a pipeline depth and return candidates/sec."""
+  pending, num_candidates = collections.deque(), 0
+  inputs = torch.rand(FLAGS.workload_size, 128, 256)
+  t = time.time()
+  for idx in range(FLAGS.num_workloads):
+    with torch.no_grad():
+      model(inputs)
+    candidates = [
+      "// {}\n{}".format(idx, kernels[x % len(kernels)]) for x in range(FLAGS.workload_size)
+    ]
+    pending.append(data_generator.SubmitCandidates(_CandidateWorker, candidates))
+    while len(pending) > depth:
+      num_candidates += len(data_generator.CollectCandidates(pending.popleft()))
+  while pending:
+    num_candidates += len(data_generator.CollectCandidates(pending.popleft()))
+  return num_candidates / (time.time() - t)
+
+def main(*args, **kwargs):
+  l.initLogger(name = "active_pipeline_benchmark")
+  kernels = [p.read_text() for p in sorted(pathlib.Path(FLAGS.kernels_dir).glob("*.cl"))]
+  if not kernels:
+    raise FileNotFoundError("No OpenCL kernels found in {}".format(FLAGS.kernels_dir))
+  model = torch.nn.TransformerEncoder(
+    torch.nn.TransformerEncoderLayer(d_model = 256, nhead = 4), num_layers = FLAGS.model_layers
+  ).eval()
+
+  # Warm the clang workers up outside of the measurements.
+  data_generator.CollectCandidates(data_generator.SubmitCandidates(_CandidateWorker, kernels))
+  results = []
+  for depth in range(FLAGS.max_pipeline_depth + 1):
+    results.append((depth, _Run(model, kernels, depth)))
+  clang.TerminateWorkerPool()
+
+  for depth, rate in results:
+    l.getLogger().info("depth {:<3} {:>10.1f} candidates/sec  x{:.2f}".format(
+      depth, rate, rate / results[0][1])
+    )
+  return
+
+if __name__ == "__main__":
+  app.run(main)
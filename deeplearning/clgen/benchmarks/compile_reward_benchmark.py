@@ -0,0 +1,131 @@
+"""Benchmark training steps/sec with compilation rewards on CPU.
+
+Every step runs a forward and backward pass of a --model_layers transformer
+encoder over --batch_size sequences on the CPU, in place of a BERT training
+step, and compiles --batch_size kernels of --kernels_dir, tokenized with a
+pickled tokenizer, as the filled sequences of the batch. Steps are run with
+--reward_compilation_lag 0, which compiles every batch before its backward
+pass, and with every lag up to --max_lag, which queues batches on a
+compiler.CompileRewardQueue and runs the extra forward pass that fills them.
+Reports steps/sec and the milliseconds per step spent waiting on clang.
+
+  $ python -m deeplearning.clgen.benchmarks.compile_reward_benchmark \
+      --tokenizer_path=<cache>/corpus/encoded/<id>/tokenizer.pkl \
+      --kernels_dir=rodinia_benchmarks
+"""
+import pathlib
+import time
+import typing
+
+import numpy as np
+from absl import app, flags
+
+from deeplearning.clgen.corpuses import tokenizers
+from deeplearning.clgen.models.torch_bert import compiler
+from deeplearning.clgen.preprocessors import clang
+from deeplearning.clgen.preprocessors import opencl
+from deeplearning.clgen.util.pytorch import torch
+from eupy.native import logger as l
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string(
+  "tokenizer_path",
+  None,
+  "Path to a pickled tokenizer."
+)
+flags.DEFINE_string(
+  "kernels_dir",
+  "rodinia_benchmarks",
+  "Directory of OpenCL kernels (*.cl) used as filled sequences."
+)
+flags.DEFINE_integer(
+  "num_steps",
+  50,
+  "Number of training steps per run."
+)
+flags.DEFINE_integer(
+  "batch_size",
+  32,
+  "Number of sequences per training step."
+)
+flags.DEFINE_integer(
+  "model_layers",
+  2,
+  "Number of transformer layers of the model step."
+)
+flags.DEFINE_integer(
+  "max_lag",
+  2,
+  "Largest reward lag to benchmark."
+)
+
+def _Batches(tokenizer: tokenizers.TokenizerBase) -> typing.List[typing.List[np.array]]:
+  """Filled sequences of every step. Every step gets distinct sources, so that none is served by the compile cache."""
+  kernels = [p.read_text() for p in sorted(pathlib.Path(FLAGS.kernels_dir).glob("*.cl"))]
+  if not kernels:
+    raise FileNotFoundError("No OpenCL kernels found in {}".format(FLAGS.kernels_dir))
+  return [
+    [
+      np.asarray(tokenizer.TokenizeString("// {}\n{}".format(step, kernels[x % len(kernels)])), dtype = np.int64)
+      for x in range(FLAGS.batch_size)
+    ]
+    for step in range(1 + (FLAGS.max_lag + 1) * (FLAGS.num_steps + FLAGS.max_lag))
+  ]
+
+def _Run(model: torch.nn.Module,
+         tokenizer: tokenizers.TokenizerBase,
+         batches: typing.Iterator[typing.List[np.array]],
+         lag: int,
+         ) -> typing.Tuple[float, float]:
+  """Train for --num_steps steps with a reward lag and return steps/sec and clang wait ms/step."""
+  optimizer = torch.optim.SGD(model.parameters(), lr = 0.01)
+  inputs    = torch.rand(FLAGS.batch_size, 128, 256)
+  queue     = compiler.CompileRewardQueue(tokenizer, lag, extract_features = False) if lag > 0 else None
+  wait_ms   = 0.0
+  t = time.time()
+  for _ in range(FLAGS.num_steps):
+    if queue is None:
+      w = time.time()
+      opencl.CompileMany([tokenizer.ArrayToCode(s) for s in next(batches)])
+      wait_ms += 1000 * (time.time() - w)
+    else:
+      while not queue.is_full:
+        with torch.no_grad():
+          model(inputs)
+        queue.Submit(None, next(batches))
+      wait_ms += queue.Pop()[-1]
+    loss = model(inputs).mean()
+    optimizer.zero_grad()
+    loss.backward()
+    optimizer.step()
+  elapsed = time.time() - t
+  if queue is not None:
+    queue.Close()
+  return FLAGS.num_steps / elapsed, wait_ms / FLAGS.num_steps
+
+def main(*args, **kwargs):
+  l.initLogger(name = "compile_reward_benchmark")
+  if FLAGS.tokenizer_path is None:
+    raise ValueError("--tokenizer_path is required")
+  tokenizer = tokenizers.TokenizerBase.FromFile(pathlib.Path(FLAGS.tokenizer_path))
+  model = torch.nn.TransformerEncoder(
+    torch.nn.TransformerEncoderLayer(d_model = 256, nhead = 4), num_layers = FLAGS.model_layers
+  ).train()
+  batches = iter(_Batches(tokenizer))
+
+  # Warm the clang workers up outside of the measurements.
+  opencl.CompileMany([tokenizer.ArrayToCode(s) for s in next(batches)])
+  results = []
+  for lag in range(FLAGS.max_lag + 1):
+    results.append((lag, *_Run(model, tokenizer, batches, lag)))
+  clang.TerminateWorkerPool()
+
+  for lag, rate, wait_ms in results:
+    l.getLogger().info("lag {:<3} {:>8.2f} steps/sec  x{:<6.2f} clang wait {:>8.1f}ms/step".format(
+      lag, rate, rate / results[0][1], wait_ms)
+    )
+  return
+
+if __name__ == "__main__":
+  app.run(main)
@@ -0,0 +1,139 @@
+"""Benchmark training steps/sec of torch_bert dataloaders with worker processes.
+
+Tokenizes every file of --kernels_dir with a pickled tokenizer into a sharded
+online corpus and trains a small CPU model on batches of an OnlineDataset,
+which inserts holes into every sequence as it is loaded. Runs --num_steps
+steps for every number of dataloader workers in --num_workers; 0 loads every
+batch on the training thread between steps.
+
+  $ python -m deeplearning.clgen.benchmarks.dataloader_benchmark \
+      --tokenizer_path=<cache>/corpus/encoded/<id>/tokenizer.pkl \
+      --kernels_dir=rodinia_benchmarks
+"""
+import pathlib
+import tempfile
+import time
+import types
+
+import numpy as np
+from absl import app, flags
+
+from deeplearning.clgen.corpuses import tokenizers
+from deeplearning.clgen.models import corpus_shards
+from deeplearning.clgen.models.torch_bert import data_generator
+from deeplearning.clgen.models.torch_bert import datasets
+from deeplearning.clgen.proto import model_pb2
+from deeplearning.clgen.util.pytorch import torch
+from eupy.native import logger as l
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string(
+  "tokenizer_path",
+  None,
+  "Path to a pickled tokenizer."
+)
+flags.DEFINE_string(
+  "kernels_dir",
+  "rodinia_benchmarks",
+  "Directory of OpenCL kernels (*.cl) to train on."
+)
+flags.DEFINE_integer(
+  "sequence_length",
+  512,
+  "Length of padded sequences. Longer kernels are skipped."
+)
+flags.DEFINE_integer(
+  "batch_size",
+  32,
+  "Number of sequences per training step."
+)
+flags.DEFINE_integer(
+  "num_steps",
+  200,
+  "Number of training steps per run."
+)
+flags.DEFINE_list(
+  "num_workers",
+  ["0", "2", "4"],
+  "Comma-separated numbers of dataloader workers to benchmark."
+)
+
+def _Corpus(tokenizer: tokenizers.TokenizerBase) -> np.array:
+  corpus = []
+  for p in sorted(pathlib.Path(FLAGS.kernels_dir).glob("*.cl")):
+    encoded = [tokenizer.startToken] + list(tokenizer.TokenizeString(p.read_text())) + [tokenizer.endToken]
+    if len(encoded) <= FLAGS.sequence_length:
+      corpus.append(encoded + [tokenizer.padToken] * (FLAGS.sequence_length - len(encoded)))
+  if not corpus:
+    raise FileNotFoundError("No OpenCL kernels of at most {} tokens found in {}".format(FLAGS.sequence_length, FLAGS.kernels_dir))
+  corpus = np.asarray(corpus, dtype = np.int64)
+  return corpus[np.arange(FLAGS.num_steps * FLAGS.batch_size) % len(corpus)]
+
+def _Run(dg: types.SimpleNamespace, vocab_size: int) -> float:
+  """Train for --num_steps steps and return steps/sec."""
+  dataset = datasets.OnlineDataset(dg, is_train = True)
+  loader  = torch.utils.data.dataloader.DataLoader(
+    dataset    = dataset,
+    drop_last  = False,
+    **data_generator.BatchKwargs(
+      dataset, torch.utils.data.RandomSampler(dataset, replacement = False), FLAGS.batch_size
+    ),
+    **data_generator.WorkerKwargs(),
+  )
+  embedding = torch.nn.Embedding(vocab_size, 128)
+  output    = torch.nn.Linear(128, vocab_size)
+  optimizer = torch.optim.SGD(list(embedding.parameters()) + list(output.parameters()), lr = 0.01)
+  batches, steps = iter(loader), 0
+  t = time.time()
+  while steps < FLAGS.num_steps:
+    try:
+      inputs = next(batches)
+    except StopIteration:
+      batches = iter(loader)
+      inputs = next(batches)
+    logits = output(embedding(inputs['input_ids']))
+    loss = torch.nn.functional.cross_entropy(
+      logits.view(-1, vocab_size), inputs['mask_labels'].view(-1)
+    )
+    optimizer.zero_grad()
+    loss.backward()
+    optimizer.step()
+    steps += 1
+  return steps / (time.time() - t)
+
+def main(*args, **kwargs):
+  l.initLogger(name = "dataloader_benchmark")
+  if FLAGS.tokenizer_path is None:
+    raise ValueError("--tokenizer_path is required")
+  tokenizer = tokenizers.TokenizerBase.FromFile(pathlib.Path(FLAGS.tokenizer_path))
+
+  results = []
+  with tempfile.TemporaryDirectory() as d:
+    path = pathlib.Path(d)
+    corpus_shards.WriteShards(path, "corpus", _Corpus(tokenizer), corpus_shards.DtypeForVocabulary(tokenizer.vocab_size))
+    config = model_pb2.DataGenerator(datapoint_time = "online", validation_split = 0)
+    config.hole.absolute_length = 10
+    config.hole.uniform_distribution = True
+    dg = types.SimpleNamespace(
+      cache           = types.SimpleNamespace(path = path),
+      pre_train       = False,
+      config          = config,
+      training_opts   = model_pb2.TrainingOptions(
+        max_predictions_per_seq = 20, masked_lm_prob = 0.6, batch_size = FLAGS.batch_size
+      ),
+      steps_per_epoch = FLAGS.num_steps,
+      tokenizer       = tokenizer,
+    )
+    for num_workers in FLAGS.num_workers:
+      FLAGS.dataloader_num_workers = int(num_workers)
+      results.append((int(num_workers), _Run(dg, tokenizer.vocab_size)))
+
+  for num_workers, rate in results:
+    l.getLogger().info("{:<3} workers {:>8.2f} steps/sec  x{:.2f}".format(
+      num_workers, rate, rate / results[0][1])
+    )
+  return
+
+if __name__ == "__main__":
+  app.run(main)
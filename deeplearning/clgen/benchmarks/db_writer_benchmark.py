@@ -0,0 +1,103 @@
+"""Benchmark database writes of corpus imports.
+
+Writes --num_rows synthetic pre-processed content files to a fresh database
+twice: the way imports used to, with one session.add() per row and a commit
+every 10 seconds on the calling thread, and through
+sqlutil.BufferedDatabaseWriter, which commits bulk inserts from a background
+thread. Reports rows/sec of both.
+
+  $ python -m deeplearning.clgen.benchmarks.db_writer_benchmark \
+      --num_rows=1000000
+"""
+import datetime
+import pathlib
+import tempfile
+import time
+import typing
+
+from absl import app, flags
+
+from deeplearning.clgen.corpuses import preprocessed
+from deeplearning.clgen.util import crypto
+from deeplearning.clgen.util import sqlutil
+from eupy.native import logger as l
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer(
+  "num_rows",
+  1000000,
+  "Number of content files written by each implementation."
+)
+flags.DEFINE_integer(
+  "text_length",
+  2000,
+  "Number of characters of each synthetic content file."
+)
+
+def _Rows(num_rows: int) -> typing.Iterator[preprocessed.PreprocessedContentFile]:
+  """Yield synthetic pre-processed content files with distinct contents."""
+  filler = "x" * FLAGS.text_length
+  for idx in range(num_rows):
+    text = "// {}\n{}".format(idx, filler)
+    sha  = crypto.sha256_str(text)
+    yield preprocessed.PreprocessedContentFile(
+      input_relpath           = "{}.cl".format(idx),
+      input_sha256            = sha,
+      input_charcount         = len(text),
+      input_linecount         = 2,
+      sha256                  = sha,
+      charcount               = len(text),
+      linecount               = 2,
+      text                    = text,
+      preprocessing_succeeded = True,
+      preprocess_time_ms      = 0,
+      wall_time_ms            = 0,
+      date_added              = datetime.datetime.utcnow(),
+    )
+
+def _SessionAdd(db: preprocessed.PreprocessedContentFiles) -> None:
+  with db.Session() as session:
+    last_commit = time.time()
+    for row in _Rows(FLAGS.num_rows):
+      session.add(row)
+      if time.time() - last_commit > 10:
+        session.commit()
+        last_commit = time.time()
+    session.commit()
+  return
+
+def _BufferedWriter(db: preprocessed.PreprocessedContentFiles) -> None:
+  with sqlutil.BufferedDatabaseWriter(
+    db,
+    max_buffer_size         = 64 * 1024 * 1024,
+    max_buffer_length       = 10000,
+    max_seconds_since_flush = 10,
+  ) as writer:
+    for row in _Rows(FLAGS.num_rows):
+      writer.AddOne(row, size = row.charcount)
+  return
+
+def main(*args, **kwargs):
+  l.initLogger(name = "db_writer_benchmark")
+  times = []
+  with tempfile.TemporaryDirectory() as d:
+    for name, fn in [("session", _SessionAdd), ("buffered", _BufferedWriter)]:
+      db = preprocessed.PreprocessedContentFiles("sqlite:///{}".format(pathlib.Path(d) / "{}.db".format(name)))
+      t = time.time()
+      fn(db)
+      t = time.time() - t
+      with db.Session() as session:
+        count = session.query(preprocessed.PreprocessedContentFile.id).count()
+      if count != FLAGS.num_rows:
+        raise ValueError("{} wrote {} of {} rows".format(name, count, FLAGS.num_rows))
+      times.append((name, t))
+
+  for name, t in times:
+    l.getLogger().info("{:<10} {:.3f}s {:>10.0f} rows/sec  x{:.1f}".format(
+      name, t, FLAGS.num_rows / t, times[0][1] / t)
+    )
+  return
+
+if __name__ == "__main__":
+  app.run(main)
@@ -0,0 +1,86 @@
+"""Benchmark nearest neighbour lookups of EuclideanSampler.
+
+Draws --corpus_size random feature vectors of --feature_space, up to the
+values of its normalizer, as the feature vectors of a corpus, and finds the
+--top_k closest corpus vectors of --num_targets random targets. Lookups are
+run with calculate_distance on one dict at a time and a sort, as
+EuclideanSampler and BenchmarkDistance did, and with every kind of
+feature_sampler.FeatureIndex. Tree build times are reported separately.
+
+  $ python -m deeplearning.clgen.benchmarks.feature_sampler_benchmark \
+      --corpus_size=1000000
+"""
+import time
+import typing
+
+import numpy as np
+from absl import app, flags
+
+from deeplearning.clgen.features import feature_sampler
+from deeplearning.clgen.features import normalizers
+from eupy.native import logger as l
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string(
+  "feature_space",
+  "GreweFeatures",
+  "Feature space of the feature vectors."
+)
+flags.DEFINE_integer(
+  "corpus_size",
+  200000,
+  "Number of corpus feature vectors."
+)
+flags.DEFINE_integer(
+  "num_targets",
+  20,
+  "Number of target feature vectors to look up."
+)
+flags.DEFINE_integer(
+  "top_k",
+  10,
+  "Number of closest corpus vectors of every target."
+)
+
+def _Features(rngen: np.random.RandomState, num: int) -> typing.List[typing.Dict[str, float]]:
+  limits = normalizers.normalizer[FLAGS.feature_space]
+  return [
+    {k: float(rngen.randint(0, v + 1)) for k, v in limits.items()}
+    for _ in range(num)
+  ]
+
+def main(*args, **kwargs):
+  l.initLogger(name = "feature_sampler_benchmark")
+  rngen   = np.random.RandomState(0)
+  corpus  = _Features(rngen, FLAGS.corpus_size)
+  targets = _Features(rngen, FLAGS.num_targets)
+
+  t = time.time()
+  expected = [
+    sorted(feature_sampler.calculate_distance(fts, tar, FLAGS.feature_space) for fts in corpus)[:FLAGS.top_k]
+    for tar in targets
+  ]
+  dict_time = time.time() - t
+
+  results = [("dicts", 0.0, dict_time)]
+  matrix  = feature_sampler.FeatureMatrix(corpus, FLAGS.feature_space)
+  tarmat  = feature_sampler.FeatureMatrix(targets, FLAGS.feature_space)
+  for kind in ["none", "kd_tree", "ball_tree"]:
+    t = time.time()
+    index = feature_sampler.FeatureIndex(matrix, kind)
+    build_time = time.time() - t
+    t = time.time()
+    distances, _ = index.Query(tarmat, FLAGS.top_k)
+    results.append((kind, build_time, time.time() - t))
+    if not np.allclose(distances, np.asarray(expected)):
+      raise ValueError("{} lookups differ from calculate_distance".format(kind))
+
+  for name, build_time, query_time in results:
+    l.getLogger().info("{:<10} build {:>9.1f}ms  lookup {:>10.1f}ms/target  x{:.1f}".format(
+      name, 1000 * build_time, 1000 * query_time / FLAGS.num_targets, dict_time / query_time)
+    )
+  return
+
+if __name__ == "__main__":
+  app.run(main)
@@ -0,0 +1,114 @@
+"""Benchmark batched hole insertion against per-sequence HoleSequence.
+
+Tokenizes every file of --kernels_dir with a pickled tokenizer, wraps it with
+[START]/[END] and pads it to --sequence_length, then inserts holes with
+sequence_masking.HoleSequence one sequence at a time and with
+sequence_masking.HoleSequenceBatch in batches of --batch_size. Reports
+instances/sec and hole statistics of both, which should agree in distribution.
+
+  $ python -m deeplearning.clgen.benchmarks.hole_masking_benchmark \
+      --tokenizer_path=<cache>/corpus/encoded/<id>/tokenizer.pkl \
+      --kernels_dir=rodinia_benchmarks
+"""
+import pathlib
+import tempfile
+import time
+import typing
+
+import numpy as np
+from absl import app, flags
+
+from deeplearning.clgen.corpuses import tokenizers
+from deeplearning.clgen.models import sequence_masking
+from deeplearning.clgen.util import distributions
+from eupy.native import logger as l
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string(
+  "tokenizer_path",
+  None,
+  "Path to a pickled tokenizer."
+)
+flags.DEFINE_string(
+  "kernels_dir",
+  "rodinia_benchmarks",
+  "Directory of OpenCL kernels (*.cl) to mask."
+)
+flags.DEFINE_integer(
+  "sequence_length",
+  512,
+  "Length of padded sequences. Longer kernels are skipped."
+)
+flags.DEFINE_integer(
+  "batch_size",
+  32,
+  "Number of sequences per HoleSequenceBatch call."
+)
+flags.DEFINE_integer(
+  "hole_length",
+  10,
+  "Upper bound of the uniform hole length distribution."
+)
+flags.DEFINE_integer(
+  "num_instances",
+  10000,
+  "Number of instances masked by each implementation."
+)
+flags.DEFINE_integer(
+  "seed",
+  0,
+  "Seed of HoleSequenceBatch."
+)
+
+def _HoleStats(kernels: typing.List[typing.Dict[str, np.array]]) -> str:
+  lengths = np.concatenate([k['masked_lm_lengths'][k['masked_lm_lengths'] >= 0] for k in kernels])
+  return "{:.2f} holes/instance, mean hole length {:.2f}".format(
+    len(lengths) / len(kernels), lengths.mean() if len(lengths) else 0.0
+  )
+
+def main(*args, **kwargs):
+  l.initLogger(name = "hole_masking_benchmark")
+  if FLAGS.tokenizer_path is None:
+    raise ValueError("--tokenizer_path is required")
+  tokenizer = tokenizers.TokenizerBase.FromFile(pathlib.Path(FLAGS.tokenizer_path))
+
+  corpus = []
+  for p in sorted(pathlib.Path(FLAGS.kernels_dir).glob("*.cl")):
+    encoded = [tokenizer.startToken] + list(tokenizer.TokenizeString(p.read_text())) + [tokenizer.endToken]
+    if len(encoded) <= FLAGS.sequence_length:
+      corpus.append(encoded + [tokenizer.padToken] * (FLAGS.sequence_length - len(encoded)))
+  if not corpus:
+    raise FileNotFoundError("No OpenCL kernels of at most {} tokens found in {}".format(FLAGS.sequence_length, FLAGS.kernels_dir))
+  corpus = np.asarray(corpus, dtype = np.int64)
+  corpus = corpus[np.arange(FLAGS.num_instances) % len(corpus)]
+
+  with tempfile.TemporaryDirectory() as log_path:
+    distribution = distributions.UniformDistribution(FLAGS.hole_length, 1.0, log_path, "hole_length")
+    kwargs = {
+      'train_set'       : True,
+      'max_predictions' : 20,
+      'masked_lm_prob'  : 0.6,
+      'distribution'    : distribution,
+      'tokenizer'       : tokenizer,
+    }
+
+    t = time.time()
+    single = [sequence_masking.HoleSequence(seq, **kwargs) for seq in corpus]
+    single_time = time.time() - t
+
+    rngen = np.random.RandomState(FLAGS.seed)
+    t = time.time()
+    batched = []
+    for idx in range(0, len(corpus), FLAGS.batch_size):
+      batched += sequence_masking.HoleSequenceBatch(corpus[idx: idx + FLAGS.batch_size], rngen = rngen, **kwargs)[0]
+    batched_time = time.time() - t
+
+  for name, kernels, t in [("single", single, single_time), ("batched", batched, batched_time)]:
+    l.getLogger().info("{:<8} {:.3f}s {:>10.0f} instances/sec  x{:.1f}  {}".format(
+      name, t, len(kernels) / t, single_time / t, _HoleStats(kernels))
+    )
+  return
+
+if __name__ == "__main__":
+  app.run(main)
@@ -0,0 +1,148 @@
+"""Benchmark hot corpus and sample queries with and without their indexes.
+
+Fills a pre-processed content files database and a samples database with
+--num_rows synthetic rows, a --failure_rate fraction of which failed
+pre-processing or compilation. Each hot query is timed with the secondary
+indexes of the schema dropped, as in databases of older versions, and again
+after CreateMissingIndexes() has migrated the database.
+
+  $ python -m deeplearning.clgen.benchmarks.index_benchmark \
+      --num_rows=1000000
+"""
+import datetime
+import pathlib
+import tempfile
+import time
+import typing
+
+import numpy as np
+import sqlalchemy as sql
+from absl import app, flags
+
+from deeplearning.clgen.corpuses import preprocessed
+from deeplearning.clgen.samplers import samples_database
+from deeplearning.clgen.util import sqlutil
+from eupy.native import logger as l
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer(
+  "num_rows",
+  1000000,
+  "Number of rows of each database."
+)
+flags.DEFINE_integer(
+  "text_length",
+  2000,
+  "Number of characters of each synthetic file or sample."
+)
+flags.DEFINE_float(
+  "failure_rate",
+  0.3,
+  "Fraction of files that failed pre-processing, and of samples that don't compile."
+)
+flags.DEFINE_integer(
+  "repetitions",
+  3,
+  "Number of runs per query. The fastest is reported."
+)
+
+def _Fill(db: sqlutil.Database, table: sql.Table, row_fn: typing.Callable[[int, bool], typing.Dict[str, typing.Any]]) -> None:
+  rngen = np.random.RandomState(0)
+  for start in range(0, FLAGS.num_rows, 10000):
+    ok = rngen.random_sample(10000) >= FLAGS.failure_rate
+    db.engine.execute(
+      table.insert(),
+      [row_fn(idx + 1, bool(ok[idx - start])) for idx in range(start, min(start + 10000, FLAGS.num_rows))]
+    )
+  return
+
+def _PreprocessedRow(idx: int, ok: bool) -> typing.Dict[str, typing.Any]:
+  return {
+    "id"                      : idx,
+    "input_relpath"           : "repo_{}/src/kernel_{}.cl".format(idx % 1000, idx),
+    "input_sha256"            : "{:064x}".format(idx),
+    "input_charcount"         : FLAGS.text_length,
+    "input_linecount"         : 1,
+    "sha256"                  : "{:064x}".format(idx),
+    "charcount"               : FLAGS.text_length,
+    "linecount"               : 1,
+    "text"                    : "x" * FLAGS.text_length,
+    "preprocessing_succeeded" : ok,
+    "preprocess_time_ms"      : 0,
+    "wall_time_ms"            : 0,
+    "date_added"              : datetime.datetime.utcnow(),
+  }
+
+def _SampleRow(idx: int, ok: bool) -> typing.Dict[str, typing.Any]:
+  return {
+    "id"                     : idx,
+    "sha256"                 : "{:064x}".format(idx),
+    "train_step"             : 0,
+    "original_input"         : "",
+    "sample_feed"            : "",
+    "text"                   : "x" * FLAGS.text_length,
+    "sample_indices"         : "",
+    "encoded_text"           : "",
+    "encoded_sample_indices" : "",
+    "compile_status"         : ok,
+    "feature_vector"         : "",
+    "num_tokens"             : 0,
+    "categorical_sampling"   : "False",
+    "sample_time_ms"         : 0,
+    "date_added"             : datetime.datetime.utcnow(),
+  }
+
+def _Time(db: sqlutil.Database, query_fn: typing.Callable[[sqlutil.Session], typing.Any]) -> float:
+  best = float("inf")
+  for _ in range(FLAGS.repetitions):
+    with db.Session() as session:
+      t = time.time()
+      query_fn(session)
+      best = min(best, time.time() - t)
+  return best
+
+def _Benchmark(db: sqlutil.Database,
+               table: sql.Table,
+               queries: typing.List[typing.Tuple[str, typing.Callable[[sqlutil.Session], typing.Any]]],
+               ) -> typing.List[typing.Tuple[str, float, float]]:
+  for index in table.indexes:
+    index.drop(db.engine)
+  db.engine.execute("ANALYZE")
+  before = [_Time(db, fn) for _, fn in queries]
+  db.CreateMissingIndexes()
+  db.engine.execute("ANALYZE")
+  after = [_Time(db, fn) for _, fn in queries]
+  return [(name, b, a) for (name, _), b, a in zip(queries, before, after)]
+
+def main(*args, **kwargs):
+  l.initLogger(name = "index_benchmark")
+  P = preprocessed.PreprocessedContentFile
+  S = samples_database.Sample
+  middle = FLAGS.num_rows // 2
+  results = []
+  with tempfile.TemporaryDirectory() as d:
+    p_db = preprocessed.PreprocessedContentFiles("sqlite:///{}".format(pathlib.Path(d).absolute() / "preprocessed.db"))
+    _Fill(p_db, P.__table__, _PreprocessedRow)
+    results += _Benchmark(p_db, P.__table__, [
+      ("preprocessed size", lambda s: s.query(sql.func.count(P.id)).filter(P.preprocessing_succeeded == True).scalar()),
+      ("imported relpaths", lambda s: s.query(P.input_relpath).all()),
+      ("succeeded id page", lambda s: s.query(P.id).filter(
+        P.preprocessing_succeeded == True, P.id > middle
+      ).order_by(P.id).limit(10000).all()),
+    ])
+    s_db = samples_database.SamplesDatabase("sqlite:///{}".format(pathlib.Path(d).absolute() / "samples.db"))
+    _Fill(s_db, S.__table__, _SampleRow)
+    results += _Benchmark(s_db, S.__table__, [
+      ("compiled samples", lambda s: s.query(sql.func.count(S.id)).filter(S.compile_status == True).scalar()),
+      ("sample by sha256", lambda s: s.query(S.id).filter(S.sha256 == "{:064x}".format(middle)).scalar()),
+    ])
+
+  for name, before, after in results:
+    l.getLogger().info("{:<20} {:>9.2f}ms -> {:>9.2f}ms  x{:.1f}".format(
+      name, before * 1000, after * 1000, before / after if after > 0 else float("inf"))
+    )
+  return
+
+if __name__ == "__main__":
+  app.run(main)
@@ -0,0 +1,70 @@
+"""Benchmark per-kernel OpenCL compile latency with and without the precompiled header.
+
+Every kernel of --kernels_dir is compiled with libclang (opencl.Compile) and
+with the clang binary (opencl.CompileLlvmBytecode), first against the plain
+'-include' OpenCL headers and then against their cached PCH.
+
+  $ python -m deeplearning.clgen.benchmarks.opencl_pch_benchmark \
+      --kernels_dir=rodinia_benchmarks
+"""
+import pathlib
+import time
+import typing
+
+import numpy as np
+from absl import app, flags
+
+from deeplearning.clgen.preprocessors import opencl
+from eupy.native import logger as l
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string(
+  "kernels_dir",
+  "rodinia_benchmarks",
+  "Directory of OpenCL kernels (*.cl) to compile."
+)
+flags.DEFINE_integer(
+  "repetitions",
+  3,
+  "Number of times each kernel is compiled per configuration."
+)
+
+def _TimeCompile(fn: typing.Callable[[str], typing.Any], kernels: typing.List[str]) -> np.array:
+  """Return the latency in ms of every compilation of every kernel."""
+  latencies = []
+  for _ in range(FLAGS.repetitions):
+    for k in kernels:
+      t = time.time()
+      try:
+        fn(k)
+      except ValueError:
+        pass
+      latencies.append(1000 * (time.time() - t))
+  return np.array(latencies)
+
+def main(*args, **kwargs):
+  l.initLogger(name = "opencl_pch_benchmark")
+  kernels = [p.read_text() for p in sorted(pathlib.Path(FLAGS.kernels_dir).glob("*.cl"))]
+  if not kernels:
+    raise FileNotFoundError("No OpenCL kernels found in {}".format(FLAGS.kernels_dir))
+
+  # Build both precompiled headers outside of the measurements.
+  for frontend in ["libclang", "clang"]:
+    t = time.time()
+    pch = opencl.GetPrecompiledHeader(use_aux_headers = True, pch_frontend = frontend)
+    l.getLogger().info("{} PCH: {}, ready in {:.1f}ms".format(frontend, pch, 1000 * (time.time() - t)))
+
+  for name, fn in [("Compile", opencl.Compile), ("CompileLlvmBytecode", opencl.CompileLlvmBytecode)]:
+    for use_pch in [False, True]:
+      FLAGS.use_opencl_pch = use_pch
+      lat = _TimeCompile(fn, kernels)
+      l.getLogger().info(
+        "{:<20} pch={:<5} kernels={} mean={:.1f}ms median={:.1f}ms p95={:.1f}ms".format(
+          name, str(use_pch), len(kernels), lat.mean(), np.median(lat), np.percentile(lat, 95)
+        )
+      )
+  return
+
+if __name__ == "__main__":
+  app.run(main)
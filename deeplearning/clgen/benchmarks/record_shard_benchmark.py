@@ -0,0 +1,115 @@
+"""Benchmark opening and reading pt_record shards.
+
+Writes --num_shards shards of --rows_per_shard synthetic masked instances,
+once saved whole with torch.save, as pt_record files used to be, and once as
+record shards with an index sidecar. Reports the time to open all shards,
+which used to torch.load every shard to count its rows, and rows/sec of
+random reads within the shards, in the order of LazyRandomSampler.
+
+  $ python -m deeplearning.clgen.benchmarks.record_shard_benchmark \
+      --num_shards=100
+"""
+import pathlib
+import tempfile
+import time
+import typing
+
+import numpy as np
+from absl import app, flags
+
+from deeplearning.clgen.models import corpus_shards
+from deeplearning.clgen.models.torch_bert import datasets
+from deeplearning.clgen.util.pytorch import torch
+from eupy.native import logger as l
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer(
+  "num_shards",
+  100,
+  "Number of shards of each format."
+)
+flags.DEFINE_integer(
+  "rows_per_shard",
+  2000,
+  "Number of masked instances per shard."
+)
+flags.DEFINE_integer(
+  "sequence_length",
+  512,
+  "Length of every sequence of an instance."
+)
+flags.DEFINE_integer(
+  "max_predictions",
+  20,
+  "Length of the masked_lm_lengths of an instance."
+)
+
+def _Instances(rngen: np.random.RandomState) -> typing.List[typing.Dict[str, np.array]]:
+  seq = lambda: rngen.randint(0, 1000, FLAGS.sequence_length).astype(np.int64)
+  return [{
+    'seen_in_training'     : np.int64([0]),
+    'original_input'       : seq(),
+    'input_ids'            : seq(),
+    'input_mask'           : np.ones(FLAGS.sequence_length, dtype = np.int64),
+    'position_ids'         : np.arange(FLAGS.sequence_length, dtype = np.int64),
+    'mask_labels'          : seq(),
+    'masked_lm_lengths'    : rngen.randint(0, 10, FLAGS.max_predictions).astype(np.int64),
+    'next_sentence_labels' : np.int64([0]),
+  } for _ in range(FLAGS.rows_per_shard)]
+
+def _ReadTorchSave(paths: typing.List[pathlib.Path], order: typing.List[typing.Tuple[int, int]]) -> None:
+  """Read rows the way LazyConcatDataset did, reloading a shard whenever the shard changes."""
+  current, shard = None, None
+  for shard_idx, row in order:
+    if current != shard_idx:
+      current, shard = shard_idx, torch.load(paths[shard_idx])
+    shard[row]
+  return
+
+def main(*args, **kwargs):
+  l.initLogger(name = "record_shard_benchmark")
+  rngen = np.random.RandomState(0)
+  # Shards in random order, rows in random order within every shard.
+  order = [
+    (shard_idx, row)
+    for shard_idx in rngen.permutation(FLAGS.num_shards)
+    for row in rngen.permutation(FLAGS.rows_per_shard)
+  ]
+  num_rows = len(order)
+  with tempfile.TemporaryDirectory() as d:
+    path = pathlib.Path(d)
+    (path / "torch").mkdir()
+    (path / "record").mkdir()
+    torch_paths, record_paths = [], []
+    for idx in range(FLAGS.num_shards):
+      instances = _Instances(rngen)
+      torch_paths.append(path / "torch" / "train_dataset_{}.pt_record".format(idx))
+      torch.save([{k: torch.from_numpy(v) for (k, v) in inst.items()} for inst in instances], torch_paths[-1])
+      record_paths.append(path / "record" / "train_dataset_{}.pt_record".format(idx))
+      corpus_shards.WriteRecordShard(record_paths[-1], instances)
+
+    t = time.time()
+    for p in torch_paths:
+      len(torch.load(p))
+    torch_open = time.time() - t
+    t = time.time()
+    _ReadTorchSave(torch_paths, order)
+    torch_read = time.time() - t
+
+    t = time.time()
+    dataset = datasets.LazyConcatDataset(record_paths)
+    record_open = time.time() - t
+    t = time.time()
+    for shard_idx, row in order:
+      dataset[(dataset.cumulative_sizes[shard_idx - 1] if shard_idx else 0) + row]
+    record_read = time.time() - t
+
+  for name, open_time, read_time in [("torch.save", torch_open, torch_read), ("record", record_open, record_read)]:
+    l.getLogger().info("{:<10} open {:>9.1f}ms  x{:<8.1f} read {:>10.0f} rows/sec  x{:.1f}".format(
+      name, 1000 * open_time, torch_open / open_time, num_rows / read_time, torch_read / read_time)
+    )
+  return
+
+if __name__ == "__main__":
+  app.run(main)
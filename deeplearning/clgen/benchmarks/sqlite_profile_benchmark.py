@@ -0,0 +1,102 @@
+"""Benchmark SQLite connection profiles on the encoded corpus schema.
+
+For every profile of sqlutil.SQLITE_PROFILES, creates an encoded content
+files database, inserts --num_rows synthetic encoded files committing every
+--commit_every rows, then scans the token data of all rows in id order, as
+the training data pipeline does. Reports rows/sec of inserts and scans.
+
+  $ python -m deeplearning.clgen.benchmarks.sqlite_profile_benchmark \
+      --num_rows=200000
+"""
+import datetime
+import pathlib
+import tempfile
+import time
+
+import numpy as np
+from absl import app, flags
+
+from deeplearning.clgen.corpuses import encoded
+from deeplearning.clgen.util import sqlutil
+from eupy.native import logger as l
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer(
+  "num_rows",
+  200000,
+  "Number of encoded files inserted and scanned per profile."
+)
+flags.DEFINE_integer(
+  "commit_every",
+  100,
+  "Number of inserted rows per transaction."
+)
+flags.DEFINE_integer(
+  "tokencount",
+  512,
+  "Number of tokens of each synthetic encoded file."
+)
+
+def _Insert(db: sqlutil.Database, rngen: np.random.RandomState) -> None:
+  for start in range(0, FLAGS.num_rows, FLAGS.commit_every):
+    with db.Session(commit = True) as session:
+      for idx in range(start, min(start + FLAGS.commit_every, FLAGS.num_rows)):
+        data, data_format = encoded.EncodedContentFile.NumpyArrayToData(
+          rngen.randint(0, 1000, FLAGS.tokencount)
+        )
+        session.add(
+          encoded.EncodedContentFile(
+            id               = idx + 1,
+            data             = data,
+            data_format      = data_format,
+            tokencount       = FLAGS.tokencount,
+            feature_vector   = "",
+            encoding_time_ms = 0,
+            wall_time_ms     = 0,
+            date_added       = datetime.datetime.utcnow(),
+          )
+        )
+  return
+
+def _Scan(db: sqlutil.Database) -> int:
+  num_tokens = 0
+  with db.Session() as session:
+    query = session.query(
+      encoded.EncodedContentFile.data, encoded.EncodedContentFile.data_format
+    ).order_by(encoded.EncodedContentFile.id).yield_per(1000)
+    for data, data_format in query:
+      num_tokens += len(encoded.EncodedContentFile.DataToNumpyArray(data, data_format))
+  return num_tokens
+
+def main(*args, **kwargs):
+  l.initLogger(name = "sqlite_profile_benchmark")
+  results = []
+  with tempfile.TemporaryDirectory() as d:
+    for profile in sqlutil.SQLITE_PROFILES:
+      db = sqlutil.Database(
+        "sqlite:///{}".format(pathlib.Path(d).absolute() / "{}.db".format(profile)),
+        encoded.Base,
+        sqlite_profile = profile,
+      )
+      t = time.time()
+      _Insert(db, np.random.RandomState(0))
+      insert_time = time.time() - t
+      t = time.time()
+      num_tokens = _Scan(db)
+      scan_time = time.time() - t
+      if num_tokens != FLAGS.num_rows * FLAGS.tokencount:
+        raise ValueError("Scanned {} tokens, expected {}".format(num_tokens, FLAGS.num_rows * FLAGS.tokencount))
+      db.Close()
+      results.append((profile, insert_time, scan_time))
+
+  for profile, insert_time, scan_time in results:
+    l.getLogger().info("{:<12} insert {:>10.0f} rows/sec  x{:.1f}   scan {:>10.0f} rows/sec  x{:.1f}".format(
+      profile,
+      FLAGS.num_rows / insert_time, results[0][1] / insert_time,
+      FLAGS.num_rows / scan_time, results[0][2] / scan_time,
+    ))
+  return
+
+if __name__ == "__main__":
+  app.run(main)
@@ -0,0 +1,115 @@
+"""Benchmark WordTokenizer throughput against the former greedy scanner.
+
+Loads a pickled tokenizer of a corpus and tokenizes every file of
+--kernels_dir with the trie-based WordTokenizer.TokenizeString, with
+TokenizeMany and with the previous implementation, which scanned every
+multi-character atom sharing the current first character. Outputs of all
+three are checked for equality.
+
+  $ python -m deeplearning.clgen.benchmarks.tokenizer_benchmark \
+      --tokenizer_path=<cache>/corpus/encoded/<id>/tokenizer.pkl \
+      --kernels_dir=rodinia_benchmarks
+"""
+import pathlib
+import time
+import typing
+
+import numpy as np
+from absl import app, flags
+
+from deeplearning.clgen.corpuses import tokenizers
+from eupy.native import logger as l
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string(
+  "tokenizer_path",
+  None,
+  "Path to a pickled WordTokenizer."
+)
+flags.DEFINE_string(
+  "kernels_dir",
+  "rodinia_benchmarks",
+  "Directory of OpenCL kernels (*.cl) to tokenize."
+)
+flags.DEFINE_integer(
+  "repetitions",
+  3,
+  "Number of passes over the kernels per implementation."
+)
+
+def _ScanTokenizeString(tokenizer: tokenizers.WordTokenizer,
+                        lookup: typing.Dict[str, typing.List[str]],
+                        text: str,
+                        ) -> np.array:
+  """The greedy longest-match tokenizer WordTokenizer used to implement."""
+  indices = []
+  i = 0
+  j = 2
+  while i < len(text):
+    if lookup.get(text[i]):
+      if j <= len(text) and any(
+        x.startswith(text[i:j]) for x in lookup[text[i]]
+      ):
+        j += 1
+      else:
+        while j > i + 1:
+          if any(x == text[i:j] for x in lookup[text[i]]):
+            indices.append(tokenizer.vocab[text[i:j]])
+            i = j
+            j += 2
+            break
+          else:
+            j -= 1
+        else:
+          indices.append(tokenizer.vocab[text[i]])
+          i += 1
+          j += 2
+    else:
+      indices.append(tokenizer.vocab[text[i]])
+      i += 1
+      j += 2
+  return np.array(indices, dtype=np.int32)
+
+def _Time(fn: typing.Callable[[], typing.Any]) -> typing.Tuple[float, typing.Any]:
+  """Return the fastest wall time in seconds over FLAGS.repetitions calls, and the last output."""
+  best, out = float("inf"), None
+  for _ in range(FLAGS.repetitions):
+    t = time.time()
+    out = fn()
+    best = min(best, time.time() - t)
+  return best, out
+
+def main(*args, **kwargs):
+  l.initLogger(name = "tokenizer_benchmark")
+  if FLAGS.tokenizer_path is None:
+    raise ValueError("--tokenizer_path is required")
+  tokenizer = tokenizers.WordTokenizer.FromFile(pathlib.Path(FLAGS.tokenizer_path))
+  if not isinstance(tokenizer, tokenizers.WordTokenizer):
+    raise TypeError("Expected a WordTokenizer, got {}".format(tokenizer))
+  texts = [p.read_text() for p in sorted(pathlib.Path(FLAGS.kernels_dir).glob("*.cl"))]
+  if not texts:
+    raise FileNotFoundError("No OpenCL kernels found in {}".format(FLAGS.kernels_dir))
+
+  multichars = set(k for k in tokenizer.atoms if len(k) > 1)
+  lookup = dict(
+    (c, [a for a in multichars if a[0] == c]) for c in set(a[0] for a in multichars)
+  )
+  scan_time, scan_out = _Time(lambda: [_ScanTokenizeString(tokenizer, lookup, t) for t in texts])
+  trie_time, trie_out = _Time(lambda: [tokenizer.TokenizeString(t) for t in texts])
+  many_time, (flat, offsets) = _Time(lambda: tokenizer.TokenizeMany(texts))
+
+  for idx, (a, b) in enumerate(zip(scan_out, trie_out)):
+    if not np.array_equal(a, b) or not np.array_equal(a, flat[offsets[idx]:offsets[idx + 1]]):
+      raise ValueError("Tokenization mismatch on kernel {}".format(idx))
+
+  num_tokens = len(flat)
+  l.getLogger().info("{}, {} kernels, {} tokens".format(tokenizer, len(texts), num_tokens))
+  for name, t in [("scan", scan_time), ("trie", trie_time), ("trie-many", many_time)]:
+    l.getLogger().info(
+      "{:<10} {:.3f}s {:>12.0f} tokens/sec  x{:.1f}".format(name, t, num_tokens / t, scan_time / t)
+    )
+  return
+
+if __name__ == "__main__":
+  app.run(main)
@@ -335,10 +335,35 @@ class Corpus(object):
       return self.config.contentfile_separator.join([x[0] for x in query])
 
   def GetTrainingDataGenerator(self):
-    with self.encoded.Session() as session:
-      for x in session.query(encoded.EncodedContentFile).yield_per(1000000):
+    for batch in self.encoded.GetBatches():
+      for x in batch:
         yield list(x.indices_array)
-      return
+    return
+
+  def GetTrainingDataBatches(self,
+                             batch_size: int = 10000,
+                             sequence_length: int = None,
+                             bucket_width: int = None,
+                             ) -> typing.Iterator[typing.List[np.array]]:
+    """Stream the encoded corpus in bounded-memory batches of arrays.
+
+    Args:
+      batch_size: Maximum number of contentfiles per batch.
+      sequence_length: If set, only fitting sequences are streamed.
+      bucket_width: If set, batches group sequences of similar length. See
+        EncodedContentFiles.GetBatches.
+
+    Returns:
+      An iterator of lists of encoded contentfiles.
+    """
+    for batch in self.encoded.GetBatches(
+      batch_size     = batch_size,
+      max_tokencount = sequence_length or None,
+      bucket_width   = bucket_width,
+      columns        = [encoded.EncodedContentFile.data, encoded.EncodedContentFile.data_format],
+    ):
+      yield [x.indices_array for x in batch]
+    return
 
   def GetTrainingData(self,
                       shuffle: bool = False,
@@ -355,59 +380,46 @@ class Corpus(object):
     """
     # Load all indices from the database into memory, and keep them there.
     # This is to remove the latency from reading the contents from a
-    # database.
-    #
-    # TODO(https://github.com/ChrisCummins/clgen/issues/128): Storing the
-    # entire corpus in memory like this prevents training on corpuses larger
-    # than system memory. Replace this method with an interface for streaming
-    # data from the encoded database.
+    # database. Use GetTrainingDataBatches() to stream corpuses larger than
+    # system memory instead.
     if self._indices_arrays is None:
-      with self.encoded.Session() as session:
-        if sequence_length:
-          query = session.query(encoded.EncodedContentFile).filter(encoded.EncodedContentFile.tokencount <= sequence_length).yield_per(1000000)
-        else:
-          query = session.query(encoded.EncodedContentFile).yield_per(1000000)
-        self._indices_arrays = np.array([x.indices_array for x in query])
+      self._indices_arrays = np.array([
+        x for batch in self.GetTrainingDataBatches(sequence_length = sequence_length) for x in batch
+      ])
 
     if shuffle:
       random.shuffle(self._indices_arrays)
 
     return self._indices_arrays
 
-  def GetTrainingFeatures(self, sequence_length: int) -> typing.List[typing.Dict[str, typing.Dict[str, float]]]:
+  def GetTrainingFeatures(self, sequence_length: int) -> typing.Iterator[typing.Dict[str, typing.Dict[str, float]]]:
     """
-    Get feature vectors of training instances within the specified sequence length.
+    Stream feature vectors of training instances within the specified sequence length.
     """
-    with self.encoded.Session() as session:
-      query = session.query(encoded.EncodedContentFile).filter(encoded.EncodedContentFile.tokencount <= sequence_length)
-      return [x.features for x in query]
-
-  def getFeaturesContents(self, sequence_length: int = None) -> typing.List[typing.Tuple[np.array, typing.Dict[str, float]]]:
+    for batch in self.encoded.GetBatches(
+      max_tokencount = sequence_length,
+      columns = [encoded.EncodedContentFile.feature_vector],
+    ):
+      for x in batch:
+        yield x.features
+    return
+
+  def getFeaturesContents(self, sequence_length: int = None) -> typing.Iterator[typing.Tuple[np.array, typing.Dict[str, float]]]:
     """
-    Get tuple of contents accompanied by feature vectors.
+    Stream tuples of contents accompanied by feature vectors.
     """
-    with self.encoded.Session() as session:
-      if sequence_length:
-        query = session.query(encoded.EncodedContentFile).filter(encoded.EncodedContentFile.tokencount <= sequence_length)
-      else:
-        query = session.query(encoded.EncodedContentFile)
-      return [(self.tokenizer.ArrayToCode(x.indices_array, with_formatting = False), x.features) for x in query]
+    for batch in self.encoded.GetBatches(max_tokencount = sequence_length):
+      for x in batch:
+        yield (self.tokenizer.ArrayToCode(x.indices_array, with_formatting = False), x.features)
+    return
 
   def GetNumContentFiles(self) -> int:
     """Get the number of contentfiles which were pre-processed."""
-    with self.preprocessed.Session() as session:
-      return session.query(preprocessed.PreprocessedContentFile).count()
+    return self.preprocessed.input_size
 
   def GetNumPreprocessedFiles(self) -> int:
     """The number of succesfully pre-processed content files."""
-    with self.preprocessed.Session() as session:
-      return (
-        session.query(preprocessed.PreprocessedContentFile.text)
-        .filter(
-          preprocessed.PreprocessedContentFile.preprocessing_succeeded == True
-        )
-        .count()
-      )
+    return self.preprocessed.size
 
   @property
   def tokenizer(self) -> tokenizers.TokenizerBase:
@@ -445,10 +457,7 @@ class Corpus(object):
   @property
   def size(self) -> int:
     """Return the size of the atomized corpus."""
-    with self.encoded.Session() as session:
-      return session.query(
-        sql.func.sum(encoded.EncodedContentFile.tokencount)
-      ).one()
+    return self.encoded.token_count
 
   def __eq__(self, rhs) -> bool:
     if not isinstance(rhs, Corpus):
@@ -537,29 +546,17 @@ def ResolveContentId(
       config.local_directory, path_prefix=FLAGS.clgen_local_path_prefix
     )
 
-    # After the first time we compute the hash of a directory, we write it into
-    # a file. This is a shortcut to work around the fact that computing the
-    # directory checksum is O(n) with respect to the number of files in the
-    # directory (even if the directory is already cached by the hash cache).
-    # This means that it is the responsibility of the user to delete this cached
-    # file if the directory is changed.
-    hash_file_path = pathlib.Path(str(local_directory) + ".sha1.txt")
-    if hash_file_path.is_file():
-      l.getLogger().info("Reading directory hash: '{}'.".format(hash_file_path))
-      with open(hash_file_path) as f:
-        content_id = f.read().rstrip()
+    if FLAGS.incremental_corpus_update:
+      # The corpus is identified by its path. Its pre-processed and encoded
+      # databases are brought up to date with the files instead.
+      content_id = crypto.sha256_str(str(local_directory))
     else:
-      # No hash file, so compute the directory hash and create it.
+      if hc is None:
+        hc = hashcache.HashCache(cache.cachepath("hashcache.db"), "sha1")
       try:
-        # content_id = hc.GetHash(local_directory)
-        content_id = crypto.sha256_str(str(local_directory))
+        content_id = hc.GetDirectoryDigest(local_directory)
       except FileNotFoundError as e:
         raise ValueError(e)
-      # Create the hash file in the directory so that next time we don't need
-      # to reference the hash cache.
-      with open(hash_file_path, "w") as f:
-        print(content_id, file=f)
-      l.getLogger().info("Wrote directory hash: '{}'.".format(hash_file_path))
   elif config.HasField("local_tar_archive"):
     # This if not an efficient means of getting the hash, as it requires always
     # unpacking the archive and reading the entire contents. It would be nicer
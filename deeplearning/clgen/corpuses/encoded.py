@@ -16,6 +16,7 @@
 import datetime
 import functools
 import multiprocessing
+import os
 import pickle
 import time
 import typing
@@ -24,6 +25,7 @@ import pathlib
 import numpy as np
 import progressbar
 import sqlalchemy as sql
+from sqlalchemy import orm
 from sqlalchemy.ext import declarative
 from sqlalchemy.sql import func
 
@@ -32,7 +34,9 @@ from deeplearning.clgen.corpuses import tokenizers
 from deeplearning.clgen.corpuses import preprocessed
 from deeplearning.clgen.proto import internal_pb2
 from deeplearning.clgen.util import monitors
+from deeplearning.clgen.util import process
 from deeplearning.clgen.features import extractor
+from deeplearning.clgen.preprocessors import clang
 from absl import flags
 import humanize
 from deeplearning.clgen.util import sqlutil
@@ -43,6 +47,17 @@ FLAGS = flags.FLAGS
 
 Base = declarative.declarative_base()
 
+# Rows read per keyset page of the preprocessed and encoded databases.
+IMPORT_PAGE_SIZE = 10000
+# Jobs sent to an encoder worker at a time.
+IMPORT_CHUNK_SIZE = 64
+# Encoding jobs queued or running in the worker pool before reading stalls.
+IMPORT_MAX_IN_FLIGHT = 8 * IMPORT_CHUNK_SIZE * multiprocessing.cpu_count()
+
+# Shard database of this process, see ShardedEncoderWorker().
+_SHARD     = None
+_SHARD_PID = None
+
 flags.DEFINE_boolean(
   "override_encoding",
   False,
@@ -64,11 +79,28 @@ class EncodedContentFileStats(Base):
 
   # Total number of files.
   file_count       : int = sql.Column(sql.Integer,      primary_key = True)
+  # Total number of tokens, excluding EOF markers. NULL in databases of older
+  # versions until the stats are recomputed.
+  token_count      : int = sql.Column(sql.Integer,      nullable = True)
   # Average feature vector of contentfiles.
   corpus_features  : str = sql.Column(sql.String(1024), nullable = False)
   # Token length distribution of contentfiles.
   corpus_lengths   : str = sql.Column(sql.String(1024), nullable = False)
 
+# Storage formats of EncodedContentFile.data.
+# Period-separated decimal string, e.g. '0.1.2.0.1'. Only found in databases
+# created before binary storage, until they are migrated.
+DATA_FORMAT_TEXT  = 0
+# Raw little-endian int16 array.
+DATA_FORMAT_INT16 = 1
+# Raw little-endian int32 array.
+DATA_FORMAT_INT32 = 2
+
+DATA_FORMAT_DTYPES = {
+  DATA_FORMAT_INT16: np.dtype("<i2"),
+  DATA_FORMAT_INT32: np.dtype("<i4"),
+}
+
 class EncodedContentFile(Base):
   """A single encoded content file."""
 
@@ -76,12 +108,14 @@ class EncodedContentFile(Base):
 
   # The ID of the PreprocessedContentFile.
   id: int = sql.Column(sql.Integer, primary_key=True)
-  # We store the vocabulary indices array as a string of period-separated
-  # integers, e.g. '0.1.2.0.1'. To access the values as an array of integers,
-  # use EncodedContentFile.indices_array.
-  data: str = sql.Column(sqlutil.ColumnTypes.UnboundedUnicodeText(), nullable=False)
+  # We store the vocabulary indices array as raw bytes, in the encoding given by
+  # data_format. To access the values as an array of integers, use
+  # EncodedContentFile.indices_array.
+  data: bytes = sql.Column(sqlutil.ColumnTypes.LargeBinary(), nullable=False)
+  # One of the DATA_FORMAT_* values.
+  data_format: int = sql.Column(sql.Integer, nullable=False, default=DATA_FORMAT_INT32)
   # Number of tokens in sequence
-  tokencount: int = sql.Column(sql.Integer, nullable=False)
+  tokencount: int = sql.Column(sql.Integer, nullable=False, index=True)
   # Sequence features extracted.
   feature_vector: str = sql.Column(sqlutil.ColumnTypes.UnboundedUnicodeText(), nullable = False)
   # The number of milliseconds encoding took.
@@ -97,18 +131,37 @@ class EncodedContentFile(Base):
 
   @staticmethod
   def DataStringToNumpyArray(data: str) -> np.ndarray:
-    """Convert the 'data' string to a numpy array."""
+    """Convert a legacy period-separated 'data' string to a numpy array."""
     return np.array([int(x) for x in data.split(".")], dtype=np.int32)
 
   @staticmethod
-  def NumpyArrayToDataString(array: np.ndarray) -> str:
-    """Convert the 'data' string to a numpy array."""
-    return ".".join(str(x) for x in array)
+  def DataToNumpyArray(data: bytes, data_format: int) -> np.ndarray:
+    """Convert the 'data' bytes to an int32 numpy array.
+
+    int32 data is not copied, so the returned array is read-only.
+    """
+    array = np.frombuffer(data, dtype = DATA_FORMAT_DTYPES[data_format])
+    if array.dtype != np.int32:
+      array = array.astype(np.int32)
+    return array
+
+  @staticmethod
+  def NumpyArrayToData(array: np.ndarray) -> typing.Tuple[bytes, int]:
+    """Convert a numpy array to 'data' bytes, in the narrowest format that fits.
+
+    Returns:
+      A tuple of the encoded bytes and their data format.
+    """
+    if len(array) == 0 or (array.min() >= np.iinfo(np.int16).min and array.max() <= np.iinfo(np.int16).max):
+      data_format = DATA_FORMAT_INT16
+    else:
+      data_format = DATA_FORMAT_INT32
+    return array.astype(DATA_FORMAT_DTYPES[data_format]).tobytes(), data_format
 
   @property
   def indices_array(self) -> np.ndarray:
     """The numpy array of the encoded data."""
-    return self.DataStringToNumpyArray(self.data)
+    return self.DataToNumpyArray(self.data, self.data_format)
 
   @property
   def features(self) -> typing.Dict[str, float]:
@@ -147,15 +200,17 @@ class EncodedContentFile(Base):
         feature_vector = ""
     except Exception as e:
       raise e
+    # Encode the end-of-file marker separately to ensure that it resolves to
+    # the correct token. For example if the vocabulary contains 'a', 'b',
+    # and 'ab', then a content file 'a' with EOF marker 'b' would be encoded
+    # as 'ab', instead of 'a'+'b'.
+    encoded, data_format = cls.NumpyArrayToData(
+      np.concatenate((data, tokenizer.TokenizeString(eof)))
+    )
     return EncodedContentFile(
       id = preprocessed_cf.id,
-      # Encode the end-of-file marker separately to ensure that it resolves to
-      # the correct token. For example if the vocabulary contains 'a', 'b',
-      # and 'ab', then a content file 'a' with EOF marker 'b' would be encoded
-      # as 'ab', instead of 'a'+'b'.
-      data = cls.NumpyArrayToDataString(
-        np.concatenate((data, tokenizer.TokenizeString(eof)))
-      ),
+      data             = encoded,
+      data_format      = data_format,
       tokencount       = len(data),
       feature_vector   = feature_vector,
       encoding_time_ms = encoding_time_ms,
@@ -186,6 +241,57 @@ def EncoderWorker(
     raise e
 
 
+def ShardedEncoderWorker(
+  jobs: typing.List[internal_pb2.EncoderWorker],
+  shard_dir: pathlib.Path,
+  tokenizer,
+  contentfile_separator,
+  is_pre_train,
+) -> typing.List[typing.Tuple[int, str, typing.Optional[np.ndarray]]]:
+  """Encode a chunk of content files into the shard database of this process.
+
+  Returns:
+    The tokencount, feature vector and, unless pre-training, the indices array
+    of every encoded file, for the monitors of the import.
+  """
+  global _SHARD, _SHARD_PID
+  if _SHARD_PID != os.getpid():
+    _SHARD = sqlutil.Database(
+      "sqlite:///{}".format(shard_dir / "encoded_{}.db".format(os.getpid())), Base
+    )
+    _SHARD_PID = os.getpid()
+  encoded_cfs = [
+    EncoderWorker(job, tokenizer, contentfile_separator, is_pre_train) for job in jobs
+  ]
+  summaries = [
+    (cf.tokencount, cf.feature_vector, None if is_pre_train else cf.indices_array)
+    for cf in encoded_cfs
+  ]
+  with _SHARD.Session(commit = True) as session:
+    session.bulk_save_objects(encoded_cfs)
+  return summaries
+
+
+def _KeysetRows(db: sqlutil.Database,
+                id_column: sql.Column,
+                columns: typing.List[sql.Column] = (),
+                *filters,
+                ) -> typing.Iterator[typing.Tuple[typing.Any, ...]]:
+  """Yield (id, *columns) of the rows of a table that match filters in ascending
+  id order, reading IMPORT_PAGE_SIZE rows at a time with keyset pagination.
+  """
+  last_id = None
+  while True:
+    with db.Session() as session:
+      query = session.query(id_column, *columns).filter(*filters)
+      if last_id is not None:
+        query = query.filter(id_column > last_id)
+      page = query.order_by(id_column).limit(IMPORT_PAGE_SIZE).all()
+    if not page:
+      return
+    yield from page
+    last_id = page[-1][0]
+
 class EncodedContentFiles(sqlutil.Database):
   """A database of encoded pre-processed contentfiles."""
 
@@ -196,7 +302,134 @@ class EncodedContentFiles(sqlutil.Database):
     if not self.is_pre_train:
       self.token_monitor    = monitors.NormalizedFrequencyMonitor(self.encoded_path, "token_distribution")
       self.feature_monitors = {ftype: monitors.CategoricalDistribMonitor(self.encoded_path, "{}_distribution".format(ftype)) for ftype in extractor.extractors.keys()}
-    super(EncodedContentFiles, self).__init__(url, Base, must_exist=must_exist)
+    super(EncodedContentFiles, self).__init__(
+      url, Base, must_exist=must_exist, sqlite_profile="performance"
+    )
+    if not self.HasBinaryData():
+      l.getLogger().warn("{} stores token strings. Migrating to binary storage.".format(url))
+      self.MigrateToBinaryData()
+    self.CreateMissingColumns()
+    self.CreateMissingIndexes()
+
+  def GetBatches(self,
+                 batch_size     : int = 10000,
+                 min_tokencount : int = None,
+                 max_tokencount : int = None,
+                 bucket_width   : int = None,
+                 columns        : typing.List[sql.Column] = None,
+                 ) -> typing.Iterator[typing.List[EncodedContentFile]]:
+    """Stream encoded contentfiles in batches of bounded size.
+
+    Rows are fetched with keyset pagination, one short-lived session per page,
+    so memory use does not grow with the size of the database.
+
+    Args:
+      batch_size: Maximum number of files per batch.
+      min_tokencount: If set, skip files with fewer tokens.
+      max_tokencount: If set, skip files with more tokens.
+      bucket_width: If set, files are walked in order of tokencount through its
+        index, and every batch only holds files whose tokencount falls in the
+        same [k * bucket_width, (k + 1) * bucket_width) bucket. Otherwise files
+        are walked in id order.
+      columns: If set, only load these columns of each row. Other attributes
+        of the yielded objects are not accessible.
+
+    Returns:
+      An iterator of lists of detached EncodedContentFile objects.
+    """
+    tc, idx = EncodedContentFile.tokencount, EncodedContentFile.id
+    last_tc, last_id = None, -1
+    pending, pending_bucket = [], None
+    while True:
+      with self.Session() as session:
+        query = session.query(EncodedContentFile)
+        if columns:
+          query = query.options(orm.load_only(idx, tc, *columns))
+        if min_tokencount is not None:
+          query = query.filter(tc >= min_tokencount)
+        if max_tokencount is not None:
+          query = query.filter(tc <= max_tokencount)
+        if bucket_width:
+          if last_tc is not None:
+            query = query.filter(sql.or_(tc > last_tc, sql.and_(tc == last_tc, idx > last_id)))
+          query = query.order_by(tc, idx)
+        else:
+          query = query.filter(idx > last_id).order_by(idx)
+        page = query.limit(batch_size).all()
+      if not page:
+        break
+      last_tc, last_id = page[-1].tokencount, page[-1].id
+      if not bucket_width:
+        yield page
+        continue
+      for cf in page:
+        bucket = cf.tokencount // bucket_width
+        if pending and (bucket != pending_bucket or len(pending) == batch_size):
+          yield pending
+          pending = []
+        pending_bucket = bucket
+        pending.append(cf)
+    if pending:
+      yield pending
+    return
+
+  def HasBinaryData(self) -> bool:
+    """Return True unless the database stores token strings, or is being migrated."""
+    columns = sql.inspect(self.engine).get_columns(EncodedContentFile.__tablename__)
+    if "data_format" not in [c["name"] for c in columns]:
+      return False
+    with self.Session() as session:
+      return session.query(Meta).filter(Meta.key == "data_migration").first() is None
+
+  def MigrateToBinaryData(self, batch_size: int = 10000) -> None:
+    """Convert a database of period-separated token strings to binary data.
+
+    The data_format column is added, with rows marked DATA_FORMAT_TEXT, and
+    rows are converted in batches. An interrupted migration resumes where it
+    stopped.
+    """
+    table = EncodedContentFile.__tablename__
+    columns = [c["name"] for c in sql.inspect(self.engine).get_columns(table)]
+    with self.engine.begin() as conn:
+      if "data_format" not in columns:
+        conn.execute(sql.text(
+          "ALTER TABLE {} ADD COLUMN data_format INTEGER NOT NULL DEFAULT {}".format(table, DATA_FORMAT_TEXT)
+        ))
+        conn.execute(Meta.__table__.insert().values(key = "data_migration", value = "incomplete"))
+      total = conn.execute(sql.text(
+        "SELECT COUNT(*) FROM {} WHERE data_format = {}".format(table, DATA_FORMAT_TEXT)
+      )).scalar()
+    bar = progressbar.ProgressBar(max_value = total)
+    done, last_id = 0, -1
+    while True:
+      with self.engine.begin() as conn:
+        # Raw SQL, since the mapped column would try to read strings as bytes.
+        rows = conn.execute(sql.text(
+          "SELECT id, data FROM {} WHERE id > :last_id AND data_format = {} ORDER BY id LIMIT {}".format(
+            table, DATA_FORMAT_TEXT, batch_size
+          )
+        ), last_id = last_id).fetchall()
+        if not rows:
+          break
+        last_id = rows[-1][0]
+        updates = []
+        for idx, data in rows:
+          encoded, data_format = EncodedContentFile.NumpyArrayToData(
+            EncodedContentFile.DataStringToNumpyArray(data)
+          )
+          updates.append({"id": idx, "data": encoded, "data_format": data_format})
+        conn.execute(sql.text(
+          "UPDATE {} SET data = :data, data_format = :data_format WHERE id = :id".format(table)
+        ), updates)
+      done += len(rows)
+      bar.update(done)
+    with self.engine.begin() as conn:
+      conn.execute(Meta.__table__.delete().where(Meta.key == "data_migration"))
+    if self.engine.dialect.name == "sqlite":
+      # Give the space freed by the shorter encoding back to the file system.
+      self.engine.execute(sql.text("VACUUM"))
+    l.getLogger().info("Migrated {} encoded contentfiles to binary storage.".format(humanize.intcomma(done)))
+    return
 
   def Create(
     self,
@@ -220,10 +453,16 @@ class EncodedContentFiles(sqlutil.Database):
     """
     with self.Session() as session:
       if not self.IsDone(session):
+        # Stats of an interrupted import may have missed some of its files.
+        self.RecomputeStats(session)
         self.Import(session, p, tokenizer, contentfile_separator)
         self.SetStats(session)
         self.SetDone(session)
         session.commit()
+      elif FLAGS.incremental_corpus_update:
+        self.Update(session, p, tokenizer, contentfile_separator)
+        self.SetStats(session)
+        session.commit()
 
       # Logging output.
     #   num_files = session.query(EncodedContentFile).count()
@@ -251,7 +490,7 @@ class EncodedContentFiles(sqlutil.Database):
   def size(self):
     """Return the total number of files in the encoded corpus."""
     with self.Session() as session:
-      return session.query(EncodedContentFile).count()
+      return self._GetStats(session).file_count
 
   @property
   def token_count(self) -> int:
@@ -260,7 +499,60 @@ class EncodedContentFiles(sqlutil.Database):
     This excludes the EOF markers which are appended to each encoded text.
     """
     with self.Session() as session:
-      return session.query(func.sum(EncodedContentFile.tokencount)).scalar()
+      return self._GetStats(session).token_count
+
+  def Update(
+    self,
+    session: sqlutil.Session,
+    p: preprocessed.PreprocessedContentFiles,
+    tokenizer: tokenizers.TokenizerBase,
+    contentfile_separator: str,
+  ) -> None:
+    """Bring a finished encoded corpus up to date with its pre-processed corpus.
+
+    Encoded files whose pre-processed file was deleted, or replaced by a newer
+    row with the same id, are deleted. Import then encodes the missing ones.
+    Both corpora are walked in id order and merge joined, as in _PendingJobs().
+    """
+    P = preprocessed.PreprocessedContentFile
+    current = _KeysetRows(p, P.id, [P.date_added], P.preprocessing_succeeded == True)
+    next_current = next(current, None)
+    self._GetStats(session)
+    session.commit()
+    num_stale, stale = 0, []
+    for idx, date_added in _KeysetRows(self, EncodedContentFile.id, [EncodedContentFile.date_added]):
+      while next_current is not None and next_current[0] < idx:
+        next_current = next(current, None)
+      if next_current is None or next_current[0] != idx or next_current[1] > date_added:
+        stale.append(idx)
+      if len(stale) >= 500:
+        self._DeleteEncoded(session, stale)
+        num_stale, stale = num_stale + len(stale), []
+    self._DeleteEncoded(session, stale)
+    num_stale += len(stale)
+    size = session.query(func.count(EncodedContentFile.id)).scalar()
+    self.Import(session, p, tokenizer, contentfile_separator)
+    l.getLogger().info(
+      "Incremental update of encoded corpus: {} removed, {} added.".format(
+        humanize.intcomma(num_stale),
+        humanize.intcomma(session.query(func.count(EncodedContentFile.id)).scalar() - size),
+      )
+    )
+    return
+
+  def _DeleteEncoded(self, session: sqlutil.Session, ids: typing.List[int]) -> None:
+    """Delete encoded files and their stats, and commit."""
+    if not ids:
+      return
+    chunk = EncodedContentFile.id.in_(ids)
+    file_count, token_count = session.query(
+      func.count(EncodedContentFile.id), func.sum(EncodedContentFile.tokencount)
+    ).filter(chunk).one()
+    self._AddStats(session, -file_count, -(token_count or 0))
+    session.query(EncodedContentFile).filter(chunk).delete(synchronize_session = False)
+    # Pages of the merge join are read by sessions of their own.
+    session.commit()
+    return
 
   def IsDone(self, session: sqlutil.Session):
     if session.query(Meta).filter(Meta.key == "done").first():
@@ -275,27 +567,49 @@ class EncodedContentFiles(sqlutil.Database):
     session.add(Meta(key="done", value="yes"))
 
   def SetStats(self, session: sqlutil.Session) -> None:
-    """Write corpus stats to DB"""
-    file_count      = session.query(EncodedContentFile.id).count()
+    """Write the distributions of the last import to the stats table."""
     if not self.is_pre_train:
       corpus_features = '\n\n'.join([ftype + ":\n" + mon.getStrData() for ftype, mon in self.feature_monitors.items()])
     else:
       corpus_features = ""
-    corpus_lengths  = self.length_monitor.getStrData()
+    stats = self._GetStats(session)
+    stats.corpus_features = corpus_features
+    stats.corpus_lengths  = self.length_monitor.getStrData()
+    return
 
-    if session.query(EncodedContentFileStats).first():
+  def _GetStats(self, session: sqlutil.Session) -> EncodedContentFileStats:
+    """Get the stats of the corpus. Databases that lack them are scanned once."""
+    stats = session.query(EncodedContentFileStats).first()
+    if stats is None or stats.token_count is None:
+      self.RecomputeStats(session)
       stats = session.query(EncodedContentFileStats).first()
-      stats.file_count      = file_count
-      stats.corpus_features = corpus_features
-      stats.corpus_lengths  = corpus_lengths
-    else:
+    return stats
+
+  def _AddStats(self, session: sqlutil.Session, file_count: int, token_count: int) -> None:
+    stats = self._GetStats(session)
+    stats.file_count  += file_count
+    stats.token_count += token_count
+    return
+
+  def RecomputeStats(self, session: sqlutil.Session) -> None:
+    """Recount the files and tokens of the stats table with a full scan."""
+    file_count, token_count = session.query(
+      func.count(EncodedContentFile.id), func.sum(EncodedContentFile.tokencount)
+    ).one()
+    stats = session.query(EncodedContentFileStats).first()
+    if stats is None:
       session.add(
         EncodedContentFileStats(
-          file_count = file_count,
-          corpus_features = corpus_features,
-          corpus_lengths = corpus_lengths,
+          file_count      = file_count,
+          token_count     = token_count or 0,
+          corpus_features = "",
+          corpus_lengths  = "",
         )
       )
+    else:
+      stats.file_count  = file_count
+      stats.token_count = token_count or 0
+    session.commit()
     return
 
   def Import(
@@ -305,101 +619,202 @@ class EncodedContentFiles(sqlutil.Database):
     tokenizer: tokenizers.TokenizerBase,
     contentfile_separator: str,
   ) -> None:
+    """Encode every successfully preprocessed file that is not encoded yet.
+
+    Preprocessed files are streamed in id order and diffed against the
+    encoded ids with a merge join, so memory use does not depend on the size
+    of either database and resuming an interrupted import costs a scan, not a
+    growing IN-list. Jobs are handed to the persistent clang worker pool at
+    most IMPORT_MAX_IN_FLIGHT at a time and encoded files are committed in
+    batches by a BufferedDatabaseWriter.
+
+    With --import_shards, files are encoded and written by processes of their
+    own instead, see _ImportSharded().
+    """
+    # Files of an interrupted sharded import.
+    self._MergeShards(session)
     with preprocessed_db.Session() as p_session:
-      query = p_session.query(preprocessed.PreprocessedContentFile).filter(
-        preprocessed.PreprocessedContentFile.preprocessing_succeeded == True,
-        ~preprocessed.PreprocessedContentFile.id.in_(
-          session.query(EncodedContentFile.id).all()
-        ),
-      )
-      # jobs = [
-      #   internal_pb2.EncoderWorker(
-      #     id=x.id,
-      #     text=x.text,
-      #     contentfile_separator=contentfile_separator,
-      #     # pickled_tokenizer=pickle.dumps(tokenizer),
-      #   )
-      #   for x in query
-      # ]
-      # if not jobs:
-      #   raise ValueError(
-      #     "Pre-processed corpus contains no files: " f"'{preprocessed_db.url}'"
-      #   )
-      total_jobs = query.count()
-      l.getLogger().info("Encoding {} of {} preprocessed files"
-                          .format(
-                              humanize.intcomma(total_jobs),
-                              humanize.intcomma(
-                                p_session.query(preprocessed.PreprocessedContentFile)
-                                .filter(preprocessed.PreprocessedContentFile.preprocessing_succeeded == True)
-                                .count()
-                              )
-                          )
+      total_files = p_session.query(func.count(preprocessed.PreprocessedContentFile.id)).filter(
+        preprocessed.PreprocessedContentFile.preprocessing_succeeded == True
+      ).scalar()
+    total_jobs = max(0, total_files - session.query(func.count(EncodedContentFile.id)).scalar())
+    l.getLogger().info("Encoding {} of {} preprocessed files"
+                        .format(
+                            humanize.intcomma(total_jobs),
+                            humanize.intcomma(total_files),
                         )
-      bar = progressbar.ProgressBar(max_value=total_jobs)
-      chunk, idx = 2000000, 0
-      last_commit = time.time()
-      wall_time_start = time.time()
-      while idx < total_jobs:
-        try:
-          batch = query.limit(chunk).offset(idx).all()
-          pool = multiprocessing.Pool()
-          for encoded_cf in pool.imap_unordered(
-                              functools.partial(EncoderWorker,
-                                                tokenizer = tokenizer,
-                                                contentfile_separator = contentfile_separator,
-                                                is_pre_train = self.is_pre_train,
-                                                ),
-                              batch
-                            ):
-            wall_time_end = time.time()
-            # TODO(cec): Remove the if check once EncoderWorker no longer returns
-            # None on tokenizer encode error.
-            if encoded_cf:
-              encoded_cf.wall_time_ms = int(
-                (wall_time_end - wall_time_start) * 1000
-              )
-              session.add(encoded_cf)
-              self.length_monitor.register(encoded_cf.tokencount)
-              if not self.is_pre_train:
-                self.token_monitor.register([tokenizer.decoder[int(x)] for x in encoded_cf.data.split('.')])
-
-                dict_features = extractor.RawToDictFeats(encoded_cf.feature_vector)
-                if dict_features:
-                  for key, value in dict_features.items():
-                    self.feature_monitors[key].register(value)
-            wall_time_start = wall_time_end
-            if wall_time_end - last_commit > 10:
-              session.commit()
-              last_commit = wall_time_end
-            idx += 1
-            bar.update(idx)
-          pool.close()
-        except KeyboardInterrupt as e:
-          pool.terminate()
-          self.length_monitor.plot()
-          if not self.is_pre_train:
-            self.token_monitor.plot()
-            for m in self.feature_monitors.values():
-              m.plot()
-          raise e
-        except Exception as e:
-          l.getLogger().error(e)
-          pool.terminate()
-          self.length_monitor.plot()
-          if not self.is_pre_train:
-            self.token_monitor.plot()
-            for m in self.feature_monitors.values():
-              m.plot()
-          raise e
-      self.length_monitor.plot()
-      if not self.is_pre_train:
-        self.token_monitor.plot()
-        for m in self.feature_monitors.values():
-          m.plot()
+                      )
+    # Make sure the stats cover the files encoded so far before adding to them.
+    self._GetStats(session)
+    # The writer opens its own sessions, release any lock held by this one.
+    session.commit()
+    if FLAGS.import_shards > 0:
+      self._ImportSharded(session, preprocessed_db, tokenizer, contentfile_separator, total_jobs)
+      return
+
+    worker = functools.partial(EncoderWorker,
+                               tokenizer = tokenizer,
+                               contentfile_separator = contentfile_separator,
+                               is_pre_train = self.is_pre_train,
+                               )
+    # Workers are long-lived and shared with other clang batch jobs.
+    pool = clang.GetWorkerPool()
+    if pool is None:
+      encoded_cfs = map(worker, self._PendingJobs(preprocessed_db))
+    else:
+      encoded_cfs = process.ThrottledMap(
+        pool, worker, self._PendingJobs(preprocessed_db), IMPORT_MAX_IN_FLIGHT, chunksize = IMPORT_CHUNK_SIZE
+      )
+    bar = progressbar.ProgressBar(max_value = total_jobs)
+    idx, added_files, added_tokens = 0, 0, 0
+    wall_time_start = time.time()
+    try:
+      with sqlutil.BufferedDatabaseWriter(
+        self,
+        max_buffer_length       = IMPORT_CHUNK_SIZE * 16,
+        max_seconds_since_flush = 10,
+      ) as writer:
+        for encoded_cf in encoded_cfs:
+          wall_time_end = time.time()
+          # TODO(cec): Remove the if check once EncoderWorker no longer returns
+          # None on tokenizer encode error.
+          if encoded_cf:
+            encoded_cf.wall_time_ms = int(
+              (wall_time_end - wall_time_start) * 1000
+            )
+            writer.AddOne(encoded_cf, size = encoded_cf.tokencount * 4)
+            added_files  += 1
+            added_tokens += encoded_cf.tokencount
+            self._RegisterMonitors(
+              tokenizer,
+              encoded_cf.tokencount,
+              encoded_cf.feature_vector,
+              None if self.is_pre_train else encoded_cf.indices_array,
+            )
+          wall_time_start = wall_time_end
+          idx += 1
+          bar.update(min(idx, total_jobs))
+    except KeyboardInterrupt as e:
+      if pool is not None:
+        encoded_cfs.Stop()
+      clang.TerminateWorkerPool()
+      raise e
+    except Exception as e:
+      l.getLogger().error(e)
+      if pool is not None:
+        encoded_cfs.Stop()
+      clang.TerminateWorkerPool()
+      raise e
+    finally:
+      # The writer has committed every file handed to it.
+      self._AddStats(session, added_files, added_tokens)
+      session.commit()
+      self._PlotMonitors()
+    return
+
+  def _ImportSharded(
+    self,
+    session: sqlutil.Session,
+    preprocessed_db: preprocessed.PreprocessedContentFiles,
+    tokenizer: tokenizers.TokenizerBase,
+    contentfile_separator: str,
+    total_jobs: int,
+  ) -> None:
+    """Encode files on processes that write to shard databases of their own.
+
+    Shards are merged into the corpus once every file is encoded. Shards of an
+    interrupted import are merged by the next one.
+    """
+    if self.engine.dialect.name != "sqlite":
+      raise ValueError("Sharded imports need a SQLite database, not {}".format(self.url))
+    shard_dir = self.encoded_path / "shards"
+    shard_dir.mkdir(exist_ok = True)
+    worker = functools.partial(ShardedEncoderWorker,
+                               shard_dir = shard_dir,
+                               tokenizer = tokenizer,
+                               contentfile_separator = contentfile_separator,
+                               is_pre_train = self.is_pre_train,
+                               )
+    bar = progressbar.ProgressBar(max_value = total_jobs)
+    idx = 0
+    try:
+      for summaries in preprocessed.RunShardWorkers(
+        worker, self._PendingJobs(preprocessed_db), IMPORT_CHUNK_SIZE
+      ):
+        for tokencount, feature_vector, indices in summaries:
+          self._RegisterMonitors(tokenizer, tokencount, feature_vector, indices)
+        idx += len(summaries)
+        bar.update(min(idx, total_jobs))
+      self._MergeShards(session)
+    finally:
+      self._PlotMonitors()
+    return
+
+  def _MergeShards(self, session: sqlutil.Session) -> None:
+    """Merge the shard databases of a sharded import into the corpus."""
+    shard_dir = self.encoded_path / "shards"
+    if self.engine.dialect.name != "sqlite" or not shard_dir.exists():
+      return
+    shards = sorted(shard_dir.glob("encoded_*.db"))
+    if not shards:
+      return
+    # The merge writes through a connection of its own.
     session.commit()
+    merged = sqlutil.MergeShards(self, shards, EncodedContentFile.__table__)
+    # Encoded files keep the ids of their pre-processed files, so merged rows
+    # are not a range of ids. The recount is an index scan of tokencount.
+    self.RecomputeStats(session)
+    l.getLogger().info("Merged {} encoded files from {} shards.".format(
+      humanize.intcomma(merged), len(shards))
+    )
     return
 
+  def _RegisterMonitors(self,
+                        tokenizer: tokenizers.TokenizerBase,
+                        tokencount: int,
+                        feature_vector: str,
+                        indices: typing.Optional[np.ndarray],
+                        ) -> None:
+    """Add an encoded file to the distributions of the import."""
+    self.length_monitor.register(tokencount)
+    if not self.is_pre_train:
+      self.token_monitor.register([tokenizer.decoder[int(x)] for x in indices])
+
+      dict_features = extractor.RawToDictFeats(feature_vector)
+      if dict_features:
+        for key, value in dict_features.items():
+          self.feature_monitors[key].register(value)
+    return
+
+  def _PlotMonitors(self) -> None:
+    self.length_monitor.plot()
+    if not self.is_pre_train:
+      self.token_monitor.plot()
+      for m in self.feature_monitors.values():
+        m.plot()
+    return
+
+  def _EncodedIds(self) -> typing.Iterator[int]:
+    """Yield the ids of encoded files in ascending order, a page at a time."""
+    return (x for x, in _KeysetRows(self, EncodedContentFile.id))
+
+  def _PendingJobs(self,
+                   preprocessed_db: preprocessed.PreprocessedContentFiles,
+                   ) -> typing.Iterator[internal_pb2.EncoderWorker]:
+    """Yield successfully preprocessed files that have no encoded counterpart.
+
+    Both tables are walked in id order with keyset pagination and merge
+    joined, so only a page of each is held in memory.
+    """
+    P = preprocessed.PreprocessedContentFile
+    encoded_ids  = self._EncodedIds()
+    next_encoded = next(encoded_ids, None)
+    for pid, text in _KeysetRows(preprocessed_db, P.id, [P.text], P.preprocessing_succeeded == True):
+      while next_encoded is not None and next_encoded < pid:
+        next_encoded = next(encoded_ids, None)
+      if next_encoded != pid:
+        yield internal_pb2.EncoderWorker(id = pid, text = text)
+
   @staticmethod
   def GetVocabFromMetaTable(session) -> typing.Dict[str, int]:
     """Read a vocabulary dictionary from the 'Meta' table of a database."""
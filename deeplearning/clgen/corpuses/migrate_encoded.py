@@ -0,0 +1,43 @@
+"""Migrate encoded corpus databases to binary token storage.
+
+Databases written before binary storage keep each content file's tokens as a
+period-separated string. They are migrated the first time they are opened;
+this command does it ahead of time, e.g. for all corpuses of a workspace:
+
+  $ python -m deeplearning.clgen.corpuses.migrate_encoded \
+      --encoded_db=<cache>/corpus/encoded/<id>/encoded.db
+"""
+import pathlib
+
+from absl import app, flags
+
+from deeplearning.clgen.corpuses import encoded
+from eupy.native import logger as l
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_list(
+  "encoded_db",
+  [],
+  "Comma-separated paths of encoded databases to migrate."
+)
+
+def main(*args, **kwargs):
+  l.initLogger(name = "migrate_encoded")
+  if not FLAGS.encoded_db:
+    raise ValueError("No --encoded_db specified.")
+  for path in FLAGS.encoded_db:
+    path = pathlib.Path(path).resolve()
+    if not path.exists():
+      raise FileNotFoundError(path)
+    db = encoded.EncodedContentFiles("sqlite:///{}".format(path), is_pre_train = True, must_exist = True)
+    # Opening the database migrates it, and resumes a migration that was
+    # interrupted midway through its data_migration marker. Only a database
+    # that is still not migrated after that is migrated here.
+    if not db.HasBinaryData():
+      db.MigrateToBinaryData()
+    l.getLogger().info("{}: {} files, {} tokens.".format(path, db.size, db.token_count))
+  return
+
+if __name__ == "__main__":
+  app.run(main)
@@ -13,9 +13,11 @@
 # You should have received a copy of the GNU General Public License
 # along with clgen.  If not, see <https://www.gnu.org/licenses/>.
 """This file defines a database for pre-preprocessed content files."""
+import collections
 import contextlib
 import datetime
 import hashlib
+import itertools
 import multiprocessing
 import os
 import pathlib
@@ -34,7 +36,10 @@ from deeplearning.clgen.preprocessors import preprocessors
 from deeplearning.clgen.proto import corpus_pb2
 from deeplearning.clgen.proto import internal_pb2
 from deeplearning.clgen.github import bigQuery_database as bqdb
+from deeplearning.clgen.util import dirscan
 from deeplearning.clgen.util import fs
+from deeplearning.clgen.util import process
+from deeplearning.clgen.util import preprocess_cache
 from deeplearning.clgen.util import sqlutil
 
 from eupy.native import logger as l
@@ -57,8 +62,42 @@ flags.DEFINE_boolean(
   "Set to override incomplete pre-processing. Does not set DB value to 'done'"
 )
 
+flags.DEFINE_boolean(
+  "incremental_corpus_update",
+  False,
+  "Set to bring finished local_directory corpora up to date with their content files: "
+  "new and changed files are pre-processed and encoded, rows of removed files are deleted."
+)
+
+flags.DEFINE_boolean(
+  "dedupe_preprocessed",
+  True,
+  "Set to keep a single copy of identical pre-processed files in a corpus. "
+  "Duplicates are stored as unsuccessful, without their text."
+)
+
+flags.DEFINE_integer(
+  "import_shards",
+  0,
+  "Number of processes that pre-process and encode corpus files into SQLite shard databases "
+  "of their own, merged into the corpus databases when they are done. Set to scale imports "
+  "past the throughput of a single database writer. 0 writes every file from the main process."
+)
+
 Base = declarative.declarative_base()
 
+# Text stored in place of a pre-processed file that is a duplicate.
+DUPLICATE_TEXT = "/*duplicate of a pre-processed file*/"
+
+# Jobs pre-processed and committed to a shard database at a time.
+SHARD_CHUNK_SIZE = 256
+# Rows read per page by incremental updates.
+UPDATE_PAGE_SIZE = 10000
+
+# Shard database of this process, see ShardedPreprocessorWorker().
+_SHARD     = None
+_SHARD_PID = None
+
 
 class Meta(Base):
   __tablename__ = "meta"
@@ -67,8 +106,61 @@ class Meta(Base):
   value: str = sql.Column(sql.String(1024), nullable=False)
 
 
+class PreprocessedContentFileStats(Base):
+  """Running totals of a pre-processed corpus, updated on import."""
+
+  __tablename__ = "preprocessed_contentfiles_stats"
+
+  id               : int = sql.Column(sql.Integer, primary_key = True)
+  # Number of rows, including unsuccessful ones.
+  input_count      : int = sql.Column(sql.Integer, nullable = False)
+  input_char_count : int = sql.Column(sql.Integer, nullable = False)
+  input_line_count : int = sql.Column(sql.Integer, nullable = False)
+  # Totals of successfully pre-processed files.
+  file_count       : int = sql.Column(sql.Integer, nullable = False)
+  char_count       : int = sql.Column(sql.Integer, nullable = False)
+  line_count       : int = sql.Column(sql.Integer, nullable = False)
+
+  @staticmethod
+  def Totals(session: sqlutil.Session, *filters) -> typing.Dict[str, int]:
+    """Aggregate the stats of the pre-processed files matching filters."""
+    P = PreprocessedContentFile
+    inputs = session.query(
+      func.count(P.id), func.sum(P.input_charcount), func.sum(P.input_linecount)
+    ).filter(*filters).one()
+    outputs = session.query(
+      func.count(P.id), func.sum(P.charcount), func.sum(P.linecount)
+    ).filter(P.preprocessing_succeeded == True, *filters).one()
+    return {
+      "input_count"      : inputs[0] or 0,
+      "input_char_count" : inputs[1] or 0,
+      "input_line_count" : inputs[2] or 0,
+      "file_count"       : outputs[0] or 0,
+      "char_count"       : outputs[1] or 0,
+      "line_count"       : outputs[2] or 0,
+    }
+
+  @staticmethod
+  def Of(preprocessed_cf: "PreprocessedContentFile") -> typing.Dict[str, int]:
+    """The stats a single pre-processed file contributes."""
+    succeeded = bool(preprocessed_cf.preprocessing_succeeded)
+    return {
+      "input_count"      : 1,
+      "input_char_count" : preprocessed_cf.input_charcount,
+      "input_line_count" : preprocessed_cf.input_linecount,
+      "file_count"       : int(succeeded),
+      "char_count"       : preprocessed_cf.charcount if succeeded else 0,
+      "line_count"       : preprocessed_cf.linecount if succeeded else 0,
+    }
+
 class PreprocessedContentFile(Base):
   __tablename__ = "preprocessed_contentfiles"
+  __table_args__ = (
+    # Counts and id-ordered walks of successfully pre-processed files.
+    sql.Index("ix_preprocessed_contentfiles_succeeded_id", "preprocessing_succeeded", "id"),
+    # Relpaths already imported, read when resuming or updating a corpus.
+    sql.Index("ix_preprocessed_contentfiles_input_relpath", "input_relpath", mysql_length = 255),
+  )
 
   id: int = sql.Column(sql.Integer, primary_key=True)
   # Relative path of the input file within the content files.
@@ -105,22 +197,26 @@ class PreprocessedContentFile(Base):
     contentfile_root: pathlib.Path,
     relpath: pathlib.Path,
     preprocessors_: typing.List[str],
+    cache_entries: typing.Optional[typing.List[typing.Tuple[str, typing.List[typing.Tuple[str, bool]]]]] = None,
   ) -> "PreprocessedContentFile":
-    """Instantiate a PreprocessedContentFile."""
+    """Instantiate a PreprocessedContentFile.
+
+    Outputs that miss the preprocessing cache are appended to cache_entries,
+    see CachedPreprocess().
+    """
     start_time = time.time()
     input_text = ""
     preprocessing_succeeded = False
     try:
-      with open(contentfile_root / relpath) as f:
-        try:
-          input_text = f.read()
-        except UnicodeDecodeError:
-          input_text = "/*corrupted file format*/"
-        except UnicodeError:
-          input_text = "/*corrupted file format*/"
-        except Exception:
-          input_text = "/*corrupted file format*/"
-      text_generator = preprocessors.Preprocess(input_text, preprocessors_)
+      # The file is read once, for both its checksum and its text.
+      with open(contentfile_root / relpath, 'rb') as f:
+        input_bytes = f.read()
+      input_sha256 = hashlib.sha256(input_bytes).hexdigest()
+      try:
+        input_text = input_bytes.decode("utf-8").replace("\r\n", "\n").replace("\r", "\n")
+      except UnicodeError:
+        input_text = "/*corrupted file format*/"
+      text_generator = CachedPreprocess(input_text, input_sha256, preprocessors_, cache_entries)
       # preprocessing_succeeded = True
     except Exception as e:
       raise("Unexpected exception: {}".format(e))
@@ -130,7 +226,7 @@ class PreprocessedContentFile(Base):
     input_text_stripped = input_text.strip()
     return [ cls(
       input_relpath           = relpath,
-      input_sha256            = GetFileSha256(contentfile_root / (relpath)),
+      input_sha256            = input_sha256,
       input_charcount         = len(input_text_stripped),
       input_linecount         = len(input_text_stripped.split("\n")),
       sha256                  = hashlib.sha256(text.encode("utf-8")).hexdigest(),
@@ -148,13 +244,20 @@ class PreprocessedContentFile(Base):
     cls,
     file: bqdb.bqMainFile,
     preprocessors_: typing.List[str],
+    cache_entries: typing.Optional[typing.List[typing.Tuple[str, typing.List[typing.Tuple[str, bool]]]]] = None,
   ) -> "PreprocessedContentFile":
-    """Instantiate a PreprocessedContentFile."""
+    """Instantiate a PreprocessedContentFile.
+
+    Outputs that miss the preprocessing cache are appended to cache_entries,
+    see CachedPreprocess().
+    """
     start_time = time.time()
     preprocessing_succeeded = False
     try:
       input_text = file.content
-      text_generator = preprocessors.Preprocess(input_text, preprocessors_)
+      text_generator = CachedPreprocess(
+        input_text, hashlib.sha256(input_text.encode("utf-8")).hexdigest(), preprocessors_, cache_entries
+      )
       # preprocessing_succeeded = True
     except Exception as e:
       raise("Unexpected exception: {}".format(e))
@@ -177,33 +280,143 @@ class PreprocessedContentFile(Base):
       date_added              = datetime.datetime.utcnow(),
     ) for (text, success) in text_generator ]
 
+  def MarkDuplicate(self) -> None:
+    """Keep a duplicate pre-processed file out of the corpus, but record its input as done."""
+    self.text                    = DUPLICATE_TEXT
+    self.charcount               = len(DUPLICATE_TEXT)
+    self.linecount               = 1
+    self.preprocessing_succeeded = False
+    return
+
+def CachedPreprocess(input_text: str,
+                     input_sha256: str,
+                     preprocessors_: typing.List[str],
+                     cache_entries: typing.Optional[typing.List[typing.Tuple[str, typing.List[typing.Tuple[str, bool]]]]] = None,
+                     ) -> typing.List[typing.Tuple[str, bool]]:
+  """Run a preprocessor pipeline, or reuse its outputs for identical content.
+
+  Outputs are looked up in the preprocessing cache, which is shared between
+  corpora, by the checksum of the input and the pipeline. On a miss, the
+  (key, outputs) entry is appended to cache_entries for the caller to write,
+  or written right away if cache_entries is None.
+  """
+  pcache = preprocess_cache.GetPreprocessCache()
+  if pcache is None:
+    return list(preprocessors.Preprocess(input_text, preprocessors_))
+  key     = pcache.Key(input_sha256, preprocessors_, preprocessors.PipelineDigest(preprocessors_))
+  outputs = pcache.Get(key)
+  if outputs is None:
+    outputs = list(preprocessors.Preprocess(input_text, preprocessors_))
+    if cache_entries is None:
+      pcache.SetMany([(key, outputs)])
+    else:
+      cache_entries.append((key, outputs))
+  return outputs
+
 def PreprocessorWorker(job: str,
                        contentfile_root: pathlib.Path,
                        preprocessors: typing.List[str]
-                       ) -> PreprocessedContentFile:
-  """The inner loop of a parallelizable pre-processing job."""
-  return PreprocessedContentFile.FromContentFile(
-    contentfile_root, job, preprocessors
-  )
+                       ) -> typing.Tuple[typing.List[PreprocessedContentFile], typing.List[typing.Any]]:
+  """The inner loop of a parallelizable pre-processing job.
 
-def BQPreprocessorWorker(file: bqdb.bqMainFile, preprocessors: typing.List[str]) -> PreprocessedContentFile:
-  """The inner loop of a parallelizable pre-processing job."""
-  return PreprocessedContentFile.FromBQFile(file, preprocessors)
+  Returns the pre-processed files and the preprocessing cache entries the
+  parent has to write.
+  """
+  cache_entries = []
+  return PreprocessedContentFile.FromContentFile(
+    contentfile_root, job, preprocessors, cache_entries
+  ), cache_entries
+
+def BQPreprocessorWorker(file: bqdb.bqMainFile,
+                         preprocessors: typing.List[str],
+                         ) -> typing.Tuple[typing.List[PreprocessedContentFile], typing.List[typing.Any]]:
+  """The inner loop of a parallelizable pre-processing job.
+
+  Returns the pre-processed files and the preprocessing cache entries the
+  parent has to write.
+  """
+  cache_entries = []
+  return PreprocessedContentFile.FromBQFile(file, preprocessors, cache_entries), cache_entries
+
+def ShardedPreprocessorWorker(jobs: typing.List[typing.Any],
+                              shard_dir: pathlib.Path,
+                              worker: typing.Callable[[typing.Any], typing.Tuple[typing.List[PreprocessedContentFile], typing.List[typing.Any]]],
+                              ) -> typing.Tuple[int, typing.List[typing.Any]]:
+  """Pre-process a chunk of jobs into the shard database of this process.
+
+  Args:
+    jobs: Arguments of worker.
+    shard_dir: Directory of the shard databases.
+    worker: PreprocessorWorker or BQPreprocessorWorker, with its other
+      arguments bound.
+
+  Returns:
+    The number of jobs done and the preprocessing cache entries the parent
+    has to write.
+  """
+  global _SHARD, _SHARD_PID
+  if _SHARD_PID != os.getpid():
+    _SHARD = sqlutil.Database(
+      "sqlite:///{}".format(shard_dir / "preprocessed_{}.db".format(os.getpid())), Base
+    )
+    _SHARD_PID = os.getpid()
+  preprocessed_cfs, cache_entries = [], []
+  for job in jobs:
+    cfs, entries = worker(job)
+    preprocessed_cfs += cfs
+    cache_entries    += entries
+  with _SHARD.Session(commit = True) as session:
+    session.bulk_save_objects(preprocessed_cfs)
+  return len(jobs), cache_entries
+
+def RunShardWorkers(worker: typing.Callable[[typing.List[typing.Any]], typing.Any],
+                    jobs: typing.Iterable[typing.Any],
+                    chunk_size: int,
+                    ) -> typing.Iterator[typing.Any]:
+  """Map worker over chunks of jobs on a pool of FLAGS.import_shards processes.
+
+  Jobs are read lazily: at most four chunks per process are queued at a time.
+  The pool is joined once all results are yielded, so the shard databases its
+  processes wrote to are closed.
+
+  Returns:
+    An iterator over the results of worker, in no particular order.
+  """
+  jobs    = iter(jobs)
+  chunks  = iter(lambda: list(itertools.islice(jobs, chunk_size)), [])
+  pool    = multiprocessing.Pool(FLAGS.import_shards)
+  results = process.ThrottledMap(pool, worker, chunks, 4 * FLAGS.import_shards)
+  try:
+    for result in results:
+      yield result
+    pool.close()
+    pool.join()
+  finally:
+    # The feeder must not be waiting for a free slot when the pool is terminated.
+    results.Stop()
+    pool.terminate()
+  return
 
 class PreprocessedContentFiles(sqlutil.Database):
   """A database of pre-processed contentfiles."""
 
   def __init__(self, url: str, must_exist: bool = False):
     super(PreprocessedContentFiles, self).__init__(
-      url, Base, must_exist=must_exist
+      url, Base, must_exist=must_exist, sqlite_profile="performance"
     )
+    self.CreateMissingIndexes()
 
   def Create(self, config: corpus_pb2.Corpus):
     with self.Session() as session:
       if not self.IsDone(session):
+        # Stats of an interrupted import may have missed some of its files.
+        self.RecomputeStats(session)
         self.Import(session, config)
         self.SetDone(session)
         session.commit()
+      elif FLAGS.incremental_corpus_update:
+        self.Update(session, config)
+        session.commit()
 
       # Logging output.
     #   num_input_files = session.query(PreprocessedContentFile).count()
@@ -287,20 +500,143 @@ class PreprocessedContentFiles(sqlutil.Database):
   def SetDone(self, session: sqlutil.Session):
     session.add(Meta(key="done", value="yes"))
 
+  def Update(self, session: sqlutil.Session, config: corpus_pb2.Corpus) -> None:
+    """Bring a finished corpus up to date with its content files.
+
+    Rows of removed files are deleted. A file has changed if it was modified
+    after its rows were added and its checksum differs. Rows of changed files
+    are deleted too, so that Import pre-processes them again with new files.
+
+    Rows are streamed in input_relpath order, a page at a time, and deleted
+    in batches, so memory use does not depend on the size of the corpus.
+    """
+    if not config.HasField("local_directory"):
+      l.getLogger().warn("Incremental updates are only supported for local_directory corpora.")
+      return
+    self._GetStats(session)
+    session.commit()
+    num_removed, num_changed, stale, last = 0, 0, [], None
+    with self.GetContentFileRoot(config) as contentfile_root:
+      # File mtimes are needed to spot files rewritten in place. Files found
+      # in the corpus are popped, the ones left over are new.
+      mtimes = dict(
+        (entry.path, entry.mtime_ns) for entry in self.WalkContentFiles(contentfile_root, refresh = True)
+      )
+      for relpath, input_sha256, date_added in self._StoredInputs():
+        # The rows of a file are adjacent, the first one speaks for all.
+        if relpath == last:
+          continue
+        last = relpath
+        if relpath not in mtimes:
+          num_removed += 1
+          stale.append(relpath)
+        else:
+          mtime = datetime.datetime.utcfromtimestamp(mtimes.pop(relpath) / 1e9)
+          if mtime > date_added and GetFileSha256(contentfile_root / relpath) != input_sha256:
+            num_changed += 1
+            stale.append(relpath)
+        if len(stale) >= 500:
+          self._DeleteInputs(session, stale)
+          stale = []
+      self._DeleteInputs(session, stale)
+      num_added = len(mtimes)
+    l.getLogger().info(
+      "Incremental update of content files: {} new, {} changed, {} removed.".format(
+        humanize.intcomma(num_added), humanize.intcomma(num_changed), humanize.intcomma(num_removed)
+      )
+    )
+    if num_removed or num_changed or num_added:
+      self.Import(session, config)
+    return
+
+  def _StoredInputs(self) -> typing.Iterator[typing.Tuple[str, str, datetime.datetime]]:
+    """Yield (input_relpath, input_sha256, date_added) of every row in
+    (input_relpath, id) order, UPDATE_PAGE_SIZE rows at a time with keyset
+    pagination on the input_relpath index.
+    """
+    P = PreprocessedContentFile
+    last = None
+    while True:
+      with self.Session() as session:
+        query = session.query(P.input_relpath, P.id, P.input_sha256, P.date_added)
+        if last is not None:
+          query = query.filter(sql.tuple_(P.input_relpath, P.id) > sql.tuple_(*last))
+        page = query.order_by(P.input_relpath, P.id).limit(UPDATE_PAGE_SIZE).all()
+      if not page:
+        return
+      for relpath, _, input_sha256, date_added in page:
+        yield relpath, input_sha256, date_added
+      last = page[-1][:2]
+
+  def _DeleteInputs(self, session: sqlutil.Session, relpaths: typing.List[str]) -> None:
+    """Delete the rows of input files and their stats, and commit."""
+    if not relpaths:
+      return
+    deleted = collections.Counter()
+    # Duplicates of deleted files must be pre-processed again to keep their content.
+    deleted_sha256 = [
+      x[0] for x in session.query(PreprocessedContentFile.sha256).filter(
+        PreprocessedContentFile.input_relpath.in_(relpaths),
+        PreprocessedContentFile.preprocessing_succeeded == True,
+      )
+    ]
+    deleted.update(PreprocessedContentFileStats.Totals(session, PreprocessedContentFile.input_relpath.in_(relpaths)))
+    session.query(PreprocessedContentFile).filter(
+      PreprocessedContentFile.input_relpath.in_(relpaths)
+    ).delete(synchronize_session = False)
+    if deleted_sha256:
+      duplicates = (
+        PreprocessedContentFile.sha256.in_(deleted_sha256),
+        PreprocessedContentFile.text == DUPLICATE_TEXT,
+      )
+      deleted.update(PreprocessedContentFileStats.Totals(session, *duplicates))
+      session.query(PreprocessedContentFile).filter(*duplicates).delete(synchronize_session = False)
+    self._AddStats(session, {k: -v for k, v in deleted.items()})
+    # Pages of _StoredInputs() are read by sessions of their own.
+    session.commit()
+    return
+
   def Import(self, session: sqlutil.Session, config: corpus_pb2.Corpus) -> None:
+    # Files of an interrupted sharded import.
+    self._MergeShards(session)
+    # Checksums of the pre-processed files already in the corpus, for dedupe.
+    seen = set(
+      x[0] for x in session.query(PreprocessedContentFile.sha256).filter(
+        PreprocessedContentFile.preprocessing_succeeded == True
+      )
+    )
+    # Make sure the stats cover the files imported so far before adding to them.
+    self._GetStats(session)
+    totals = collections.Counter()
     with self.GetContentFileRoot(config) as contentfile_root:
       if not config.HasField("bq_database"):
-        relpaths = set(self.GetImportRelpaths(contentfile_root))
         done = set(
           [x[0] for x in session.query(PreprocessedContentFile.input_relpath)]
         )
-        todo = relpaths - done
+        todo, num_relpaths = [], 0
+        for relpath in self.GetImportRelpaths(contentfile_root):
+          num_relpaths += 1
+          if relpath not in done:
+            todo.append(relpath)
+        del done
         l.getLogger().info(
           "Preprocessing {} of {} content files".format(
                   humanize.intcomma(len(todo)),
-                  humanize.intcomma(len(relpaths)),
+                  humanize.intcomma(num_relpaths),
               )
         )
+        if FLAGS.import_shards > 0:
+          self._ImportSharded(
+            session,
+            todo,
+            functools.partial(
+              PreprocessorWorker,
+              contentfile_root = contentfile_root,
+              preprocessors = list(config.preprocessor)
+            ),
+            len(todo),
+          )
+          return
         chunk_size = 100000
         jobs, total = [], 0
         for idx, t in enumerate(todo):
@@ -311,12 +647,13 @@ class PreprocessedContentFiles(sqlutil.Database):
           total += 1
         bar = progressbar.ProgressBar(max_value=total)
         c = 0
-        last_commit = time.time()
         wall_time_start = time.time()
+        writer = self._ImportWriter(session)
+        cache_writer = preprocess_cache.CacheWriter(preprocess_cache.GetPreprocessCache())
         for job_chunk in jobs:
           try:
             pool = multiprocessing.Pool()
-            for preprocessed_list in pool.imap_unordered(
+            for preprocessed_list, cache_entries in pool.imap_unordered(
                                        functools.partial(
                                          PreprocessorWorker,
                                          contentfile_root = contentfile_root,
@@ -330,32 +667,45 @@ class PreprocessedContentFiles(sqlutil.Database):
                   (wall_time_end - wall_time_start) * 1000
                 )
                 wall_time_start = wall_time_end
-                session.add(preprocessed_cf)
-                if wall_time_end - last_commit > 10:
-                  session.commit()
-                  last_commit = wall_time_end
+                self._Dedupe(preprocessed_cf, seen)
+                totals.update(PreprocessedContentFileStats.Of(preprocessed_cf))
+                writer.AddOne(preprocessed_cf, size = preprocessed_cf.charcount)
+              cache_writer.Add(cache_entries)
               c += 1
               bar.update(c)
             pool.close()
           except KeyboardInterrupt as e:
             pool.terminate()
+            self._CloseImportWriter(session, writer, totals, cache_writer)
             raise e
           except Exception as e:
             pool.terminate()
+            self._CloseImportWriter(session, writer, totals, cache_writer)
             raise e
+        self._CloseImportWriter(session, writer, totals, cache_writer)
       else:
           db  = bqdb.bqDatabase("sqlite:///{}".format(contentfile_root))
           bar = progressbar.ProgressBar(max_value = db.mainfile_count)
           chunk, idx = 100000, 0
 
-          last_commit     = time.time()
+          if FLAGS.import_shards > 0:
+            self._ImportSharded(
+              session,
+              (f for i in range(0, db.mainfile_count, chunk) for f in db.main_files_batch(chunk, i)),
+              functools.partial(BQPreprocessorWorker, preprocessors = list(config.preprocessor)),
+              db.mainfile_count,
+            )
+            return
+
           wall_time_start = time.time()
+          writer = self._ImportWriter(session)
+          cache_writer = preprocess_cache.CacheWriter(preprocess_cache.GetPreprocessCache())
 
           while idx < db.mainfile_count:
             try:
               batch = db.main_files_batch(chunk, idx)
               pool = multiprocessing.Pool()
-              for preprocessed_list in pool.imap_unordered(
+              for preprocessed_list, cache_entries in pool.imap_unordered(
                                         functools.partial(
                                           BQPreprocessorWorker,
                                           preprocessors = list(config.preprocessor)
@@ -366,19 +716,154 @@ class PreprocessedContentFiles(sqlutil.Database):
                     (wall_time_end - wall_time_start) * 1000
                   )
                   wall_time_start = wall_time_end
-                  session.add(preprocessed_cf)
-                  if wall_time_end - last_commit > 10:
-                    session.commit()
-                    last_commit = wall_time_end
+                  self._Dedupe(preprocessed_cf, seen)
+                  totals.update(PreprocessedContentFileStats.Of(preprocessed_cf))
+                  writer.AddOne(preprocessed_cf, size = preprocessed_cf.charcount)
+                cache_writer.Add(cache_entries)
                 idx += 1
                 bar.update(idx)
               pool.close()
             except KeyboardInterrupt as e:
               pool.terminate()
+              self._CloseImportWriter(session, writer, totals, cache_writer)
               raise e
             except Exception as e:
               pool.terminate()
+              self._CloseImportWriter(session, writer, totals, cache_writer)
               raise e
+          self._CloseImportWriter(session, writer, totals, cache_writer)
+
+  def _ImportSharded(self,
+                     session: sqlutil.Session,
+                     jobs: typing.Iterable[typing.Any],
+                     worker: typing.Callable[[typing.Any], typing.Tuple[typing.List[PreprocessedContentFile], typing.List[typing.Any]]],
+                     total: int,
+                     ) -> None:
+    """Pre-process jobs on processes that write to shard databases of their own.
+
+    Shards are merged into the corpus once every job is done. Shards of an
+    interrupted import are merged by the next one.
+    """
+    self.shard_dir.mkdir(exist_ok = True)
+    bar = progressbar.ProgressBar(max_value = total)
+    done = 0
+    cache_writer = preprocess_cache.CacheWriter(preprocess_cache.GetPreprocessCache())
+    try:
+      for num_jobs, cache_entries in RunShardWorkers(
+        functools.partial(ShardedPreprocessorWorker, shard_dir = self.shard_dir, worker = worker),
+        jobs,
+        SHARD_CHUNK_SIZE,
+      ):
+        cache_writer.Add(cache_entries)
+        done += num_jobs
+        bar.update(done)
+    finally:
+      cache_writer.Flush()
+    self._MergeShards(session)
+    return
+
+  def _MergeShards(self, session: sqlutil.Session) -> None:
+    """Merge the shard databases of a sharded import into the corpus.
+
+    Merged files are given ids after those of the corpus. Successful files
+    whose output is already in the corpus are marked as duplicates, as _Dedupe
+    does during a regular import, and their stats are added.
+    """
+    if not self.url.startswith("sqlite:///") or not self.shard_dir.exists():
+      return
+    shards = sorted(self.shard_dir.glob("preprocessed_*.db"))
+    if not shards:
+      return
+    P = PreprocessedContentFile
+    # The merge writes through a connection of its own.
+    session.commit()
+    last_id = session.query(func.max(P.id)).scalar() or 0
+    merged  = sqlutil.MergeShards(self, shards, P.__table__, keep_primary_key = False)
+    if FLAGS.dedupe_preprocessed:
+      original = sql.orm.aliased(P)
+      session.query(P).filter(
+        P.id > last_id,
+        P.preprocessing_succeeded == True,
+        session.query(original.id).filter(
+          original.sha256 == P.sha256,
+          original.preprocessing_succeeded == True,
+          original.id < P.id,
+        ).correlate(P).exists(),
+      ).update({
+        P.text                    : DUPLICATE_TEXT,
+        P.charcount               : len(DUPLICATE_TEXT),
+        P.linecount               : 1,
+        P.preprocessing_succeeded : False,
+      }, synchronize_session = False)
+    self._AddStats(session, PreprocessedContentFileStats.Totals(session, P.id > last_id))
+    session.commit()
+    l.getLogger().info("Merged {} pre-processed files from {} shards.".format(
+      humanize.intcomma(merged), len(shards))
+    )
+    return
+
+  @property
+  def shard_dir(self) -> pathlib.Path:
+    """Directory of the shard databases of sharded imports."""
+    if not self.url.startswith("sqlite:///"):
+      raise ValueError("Sharded imports need a SQLite database, not {}".format(self.url))
+    return pathlib.Path(self.url[len("sqlite:///"):]).parent / "shards"
+
+  def _ImportWriter(self, session: sqlutil.Session) -> sqlutil.BufferedDatabaseWriter:
+    """Start the background writer that commits imported files in bulk."""
+    # The writer opens its own sessions, release any lock held by this one.
+    session.commit()
+    return sqlutil.BufferedDatabaseWriter(
+      self,
+      max_buffer_size         = 64 * 1024 * 1024,
+      max_buffer_length       = 10000,
+      max_seconds_since_flush = 10,
+    )
+
+  def _CloseImportWriter(self,
+                         session: sqlutil.Session,
+                         writer: sqlutil.BufferedDatabaseWriter,
+                         totals: typing.Dict[str, int],
+                         cache_writer: preprocess_cache.CacheWriter,
+                         ) -> None:
+    """Flush the import and cache writers and add the stats of the imported files."""
+    writer.Close()
+    cache_writer.Flush()
+    self._AddStats(session, totals)
+    session.commit()
+    return
+
+  def _GetStats(self, session: sqlutil.Session) -> PreprocessedContentFileStats:
+    """Get the stats of the corpus. Databases that lack them are scanned once."""
+    stats = session.query(PreprocessedContentFileStats).first()
+    if stats is None:
+      self.RecomputeStats(session)
+      stats = session.query(PreprocessedContentFileStats).first()
+    return stats
+
+  def _AddStats(self, session: sqlutil.Session, delta: typing.Dict[str, int]) -> None:
+    stats = self._GetStats(session)
+    for key, value in delta.items():
+      setattr(stats, key, getattr(stats, key) + value)
+    return
+
+  def RecomputeStats(self, session: sqlutil.Session) -> None:
+    """Rebuild the stats table with a full scan of the pre-processed files."""
+    session.query(PreprocessedContentFileStats).delete(synchronize_session = False)
+    session.add(PreprocessedContentFileStats(id = 1, **PreprocessedContentFileStats.Totals(session)))
+    session.commit()
+    return
+
+  @staticmethod
+  def _Dedupe(preprocessed_cf: PreprocessedContentFile, seen: typing.Set[str]) -> None:
+    """Mark a successful pre-processed file as duplicate if its output is already in the corpus."""
+    if not FLAGS.dedupe_preprocessed or not preprocessed_cf.preprocessing_succeeded:
+      return
+    if preprocessed_cf.sha256 in seen:
+      preprocessed_cf.MarkDuplicate()
+    else:
+      seen.add(preprocessed_cf.sha256)
+    return
 
   @contextlib.contextmanager
   def GetContentFileRoot(self, config: corpus_pb2.Corpus) -> pathlib.Path:
@@ -426,11 +911,7 @@ class PreprocessedContentFiles(sqlutil.Database):
     This excludes contentfiles which did not pre-process successfully.
     """
     with self.Session() as session:
-      return (
-        session.query(PreprocessedContentFile)
-        .filter(PreprocessedContentFile.preprocessing_succeeded == True)
-        .count()
-      )
+      return self._GetStats(session).file_count
 
   @property
   def input_size(self) -> int:
@@ -439,7 +920,7 @@ class PreprocessedContentFiles(sqlutil.Database):
     This *includes* contentfiles which did not pre-process successfully.
     """
     with self.Session() as session:
-      return session.query(PreprocessedContentFile).count()
+      return self._GetStats(session).input_count
 
   @property
   def char_count(self) -> int:
@@ -448,11 +929,7 @@ class PreprocessedContentFiles(sqlutil.Database):
     This excludes contentfiles which did not pre-process successfully.
     """
     with self.Session() as session:
-      return (
-        session.query(func.sum(PreprocessedContentFile.charcount))
-        .filter(PreprocessedContentFile.preprocessing_succeeded == True)
-        .scalar()
-      )
+      return self._GetStats(session).char_count
 
   @property
   def line_count(self) -> int:
@@ -461,103 +938,52 @@ class PreprocessedContentFiles(sqlutil.Database):
     This excludes contentfiles which did not pre-process successfully.
     """
     with self.Session() as session:
-      return (
-        session.query(func.sum(PreprocessedContentFile.linecount))
-        .filter(PreprocessedContentFile.preprocessing_succeeded == True)
-        .scalar()
-      )
+      return self._GetStats(session).line_count
 
   @property
   def input_char_count(self) -> int:
     """Get the total number of characters in the input content files."""
     with self.Session() as session:
-      return session.query(
-        func.sum(PreprocessedContentFile.input_charcount)
-      ).scalar()
+      return self._GetStats(session).input_char_count
 
   @property
   def input_line_count(self) -> int:
     """Get the total number of characters in the input content files."""
     with self.Session() as session:
-      return session.query(
-        func.sum(PreprocessedContentFile.input_linecount)
-      ).scalar()
+      return self._GetStats(session).input_line_count
 
   def GetImportRelpaths(
     self, contentfile_root: pathlib.Path
-  ) -> typing.List[str]:
-    """Get relative paths to all files in the content files directory.
+  ) -> typing.Iterator[str]:
+    """Get paths to all files in the content files directory.
 
     Args:
       contentfile_root: The root of the content files directory.
 
     Returns:
-      A list of paths relative to the content files root.
-
-    Raises:
-      EmptyCorpusException: If the content files directory is empty.
+      An iterator over the paths of the content files.
     """
+    for entry in self.WalkContentFiles(contentfile_root):
+      yield entry.path
 
-    find_output = []
-    queue       = [contentfile_root]
-    cpus        = os.cpu_count()
-    multi_thr   = min(cpus**2, 1600)
+  def WalkContentFiles(self,
+                       contentfile_root: pathlib.Path,
+                       refresh: bool = False,
+                       ) -> typing.Iterator[dirscan.FileEntry]:
+    """Stream the content files of a directory with their mtime and size.
 
-    while queue:
-      if len(queue) >= multi_thr:
-        break
-      cur = queue.pop(0)
-      try:
-        for f in cur.iterdir():
-          if f.is_symlink():
-            continue
-          elif f.is_file():
-            if f.suffix in {'.c', '.cl'}:
-              find_output.append(str(f))
-          elif f.is_dir():
-            queue.append(f)
-          else:
-            continue
-      except PermissionError:
-        pass
-      except NotADirectoryError:
-        pass
-      except FileNotFoundError:
-        pass
-      except OSError:
-        pass
-
-    if queue:
-      p = multiprocessing.Pool(cpus)
-      for batch in p.imap_unordered(path_worker, queue):
-        find_output += batch
-    return find_output
-
-def path_worker(base_path) -> typing.List[str]:
-  paths = []
-  queue = [base_path]
-  while queue:
-    cur = queue.pop(0)
-    try:
-      for f in cur.iterdir():
-        if f.is_symlink():
-          continue
-        elif f.is_file():
-          if f.suffix in {'.c', '.cl'}:
-            paths.append(str(f))
-        elif f.is_dir():
-          queue.append(f)
-        else:
-          continue
-    except PermissionError:
-      pass
-    except NotADirectoryError:
-      pass
-    except FileNotFoundError:
-      pass
-    except OSError:
-      pass
-  return paths
+    The listing of every directory is kept in a manifest next to the database,
+    so later walks only list the directories that changed since.
+
+    Args:
+      contentfile_root: The root of the content files directory.
+      refresh: If True, stat every file, so that files rewritten in place
+        report their current mtime.
+    """
+    manifest_path = None
+    if self.url.startswith("sqlite:///"):
+      manifest_path = pathlib.Path(self.url[len("sqlite:///"):]).parent / "content_manifest.pkl"
+    return dirscan.Walk(contentfile_root, {'.c', '.cl'}, manifest_path = manifest_path, refresh = refresh)
 
 def ExpandConfigPath(path: str) -> pathlib.Path:
   return pathlib.Path(os.path.expandvars(path)).expanduser().absolute()
@@ -0,0 +1,58 @@
+"""Rebuild the cached statistics of corpus databases.
+
+File, character, line and token counts of pre-processed and encoded
+databases are kept in stats tables that imports update incrementally, so
+reading them does not scan the corpus. This command recomputes them from
+scratch, e.g. after a database was edited by hand:
+
+  $ python -m deeplearning.clgen.corpuses.recompute_stats \
+      --recompute_preprocessed_db=<cache>/corpus/preprocessed/<id>/preprocessed.db \
+      --recompute_encoded_db=<cache>/corpus/encoded/<id>/encoded.db
+"""
+import pathlib
+
+from absl import app, flags
+
+from deeplearning.clgen.corpuses import encoded
+from deeplearning.clgen.corpuses import preprocessed
+from eupy.native import logger as l
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_list(
+  "recompute_preprocessed_db",
+  [],
+  "Comma-separated paths of pre-processed databases to recompute the stats of."
+)
+flags.DEFINE_list(
+  "recompute_encoded_db",
+  [],
+  "Comma-separated paths of encoded databases to recompute the stats of."
+)
+
+def main(*args, **kwargs):
+  l.initLogger(name = "recompute_stats")
+  if not FLAGS.recompute_preprocessed_db and not FLAGS.recompute_encoded_db:
+    raise ValueError("No --recompute_preprocessed_db or --recompute_encoded_db specified.")
+  for path in FLAGS.recompute_preprocessed_db:
+    path = pathlib.Path(path).resolve()
+    if not path.exists():
+      raise FileNotFoundError(path)
+    db = preprocessed.PreprocessedContentFiles("sqlite:///{}".format(path), must_exist = True)
+    with db.Session() as session:
+      db.RecomputeStats(session)
+    l.getLogger().info("{}: {} of {} files pre-processed, {} chars, {} lines.".format(
+      path, db.size, db.input_size, db.char_count, db.line_count)
+    )
+  for path in FLAGS.recompute_encoded_db:
+    path = pathlib.Path(path).resolve()
+    if not path.exists():
+      raise FileNotFoundError(path)
+    db = encoded.EncodedContentFiles("sqlite:///{}".format(path), is_pre_train = True, must_exist = True)
+    with db.Session() as session:
+      db.RecomputeStats(session)
+    l.getLogger().info("{}: {} files, {} tokens.".format(path, db.size, db.token_count))
+  return
+
+if __name__ == "__main__":
+  app.run(main)
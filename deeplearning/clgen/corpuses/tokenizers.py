@@ -18,6 +18,7 @@ An tokenizer converts a block of text into a sequence of vocbulary tokens.
 """
 import pathlib
 import pickle
+import re
 import typing
 import json
 import multiprocessing
@@ -146,6 +147,23 @@ class TokenizerBase(object):
     """
     raise NotImplementedError("abstract class")
 
+  def TokenizeMany(self, texts: typing.List[str]) -> typing.Tuple[np.array, np.array]:
+    """Tokenize a batch of texts into a single flat array.
+
+    Args:
+      texts: Input texts.
+
+    Returns:
+      A tuple of the int32 array of all texts' indices, concatenated, and an
+      int64 array of len(texts) + 1 offsets, such that the encoding of
+      texts[i] is tokens[offsets[i]:offsets[i + 1]].
+    """
+    encoded = [self.TokenizeString(text) for text in texts]
+    offsets = np.zeros(len(encoded) + 1, dtype = np.int64)
+    np.cumsum([len(x) for x in encoded], out = offsets[1:])
+    tokens = np.concatenate(encoded).astype(np.int32) if encoded else np.zeros(0, dtype = np.int32)
+    return tokens, offsets
+
   def AtomizeString(self, text: str) -> typing.List[str]:
     """Split the text into atoms, but do not encode to indices.
 
@@ -383,67 +401,77 @@ class WordTokenizer(TokenizerBase):
     super(WordTokenizer, self).__init__(vocab, metaTokens)
 
     self.determine_chars = determine_chars
-    multichars = set(k for k in self.atoms if len(k) > 1)
-    first_chars = set(a[0] for a in multichars)
-    self.lookup = dict(
-      (c, [a for a in multichars if a[0] == c]) for c in first_chars
-    )
+    self._matcher = self._CompileMatcher()
 
   def __repr__(self) -> str:
     return f"WordTokenizer[{self.vocab_size} tokens]"
 
+  def _CompileMatcher(self) -> typing.Pattern:
+    """Compile the multi-character atoms into a prefix trie, expressed as a regex.
+
+    Every trie node becomes an alternation over its children, with the
+    subtree of a child that terminates an atom made optional. The regex engine
+    walks a single path of the trie and greedily backtracks to the deepest
+    atom on it, which gives the longest multi-character atom starting at the
+    current position. Positions where no such atom starts fall back to a
+    single character.
+    """
+    trie = {}
+    for atom in self.atoms:
+      if len(atom) > 1:
+        node = trie
+        for char in atom:
+          node = node.setdefault(char, {})
+        node[None] = True
+
+    def _ToPattern(node: typing.Dict) -> str:
+      branches = []
+      for char, child in sorted((k, v) for k, v in node.items() if k is not None):
+        branch = re.escape(char)
+        if len(child) > 1 or None not in child:
+          sub = _ToPattern(child)
+          branch += "(?:{})?".format(sub) if None in child else "(?:{})".format(sub)
+        branches.append(branch)
+      return "|".join(branches)
+
+    pattern = _ToPattern(trie)
+    return re.compile("(?:{})|.".format(pattern) if pattern else ".", re.DOTALL)
+
+  def __getstate__(self) -> typing.Dict[str, typing.Any]:
+    # The matcher is derived from the vocabulary and rebuilt on load, which
+    # also keeps tokenizers pickled before it existed loadable.
+    state = self.__dict__.copy()
+    state.pop("_matcher", None)
+    return state
+
+  def __setstate__(self, state: typing.Dict[str, typing.Any]) -> None:
+    state.pop("lookup", None)
+    self.__dict__.update(state)
+    self._matcher = self._CompileMatcher()
+
   def TokenizeString(self, text: str) -> np.array:
     """Tokenize a text into an array of vocabulary indices.
 
+    Tokenization is greedy: at every position the longest multi-character
+    atom of the vocabulary is taken, otherwise a single character.
+
     Args:
       text: Input text.
 
     Returns:
       An array of indices into vocabulary for all atoms in text.
     """
-
-    def _AddToVocab(token: str) -> int:
-      """Add a token to the vocabulary and return its index."""
-      if self.determine_chars and token not in self.vocab:
-        max_index = max(self.vocab.values())
-        self.vocab[token] = max_index + 1
-      return self.vocab[token]
-
-    indices = []
-    i = 0
-    j = 2
+    atoms = self._matcher.findall(text)
     try:
-      while i < len(text):
-        if self.lookup.get(text[i]):
-          if j <= len(text) and any(
-            x.startswith(text[i:j]) for x in self.lookup[text[i]]
-          ):
-            j += 1
-          else:
-            while j > i + 1:
-              if any(x == text[i:j] for x in self.lookup[text[i]]):
-                indices.append(self.vocab[text[i:j]])
-                i = j
-                j += 2
-                break
-              else:
-                j -= 1
-            else:
-              indices.append(_AddToVocab(text[i]))
-              i += 1
-              j += 2
-        else:
-          indices.append(_AddToVocab(text[i]))
-          i += 1
-          j += 2
+      if self.determine_chars:
+        for atom in atoms:
+          if atom not in self.vocab:
+            self.vocab[atom] = max(self.vocab.values()) + 1
+        self._UpdateVocabulary()
+      return np.fromiter((self.vocab[atom] for atom in atoms), dtype = np.int32, count = len(atoms))
     except KeyError:
       raise ValueError
 
-    if self.determine_chars:
-      self._UpdateVocabulary()
-
-    return np.array(indices, dtype=np.int32)
-
 class ASTokenizer(TokenizerBase):
   """A Clang AST tokenizer fully supports language grammar."""
 
@@ -1,6 +1,8 @@
 """
 Feature extraction tools for active learning.
 """
+import functools
+import multiprocessing
 import subprocess
 import tempfile
 import typing
@@ -8,6 +10,9 @@ import typing
 from deeplearning.clgen.features import grewe
 from deeplearning.clgen.features import instcount
 from deeplearning.clgen.features import autophase
+from deeplearning.clgen.preprocessors import clang
+from deeplearning.clgen.preprocessors import opencl
+from deeplearning.clgen.util import compile_cache
 from deeplearning.clgen.util import crypto
 
 from eupy.hermes import client
@@ -18,6 +23,65 @@ extractors = {
   'AutophaseFeatures' : autophase.AutophaseFeatures
 }
 
+# Extractors implemented as opt passes over the kernel's LLVM IR. These share a
+# single compilation of the source to bitcode.
+ir_passes = {
+  'InstCountFeatures' : instcount.INSTCOUNT,
+  'AutophaseFeatures' : autophase.AUTOPHASE,
+}
+
+def _ComputeRawFeatures(src: str,
+                        ext: typing.List[str],
+                        header_file: str,
+                        use_aux_headers: bool,
+                        ) -> typing.Dict[str, str]:
+  """
+  Run the requested extractors on a source. The kernel is compiled to
+  LLVM IR once and every IR pass runs on that same artifact.
+  """
+  raw = {
+    xt: extractors[xt].ExtractRawFeatures(src, header_file = header_file, use_aux_headers = use_aux_headers)
+    for xt in ext if xt not in ir_passes
+  }
+  ir_ext = [xt for xt in ext if xt in ir_passes]
+  if ir_ext:
+    try:
+      outputs = opencl.CompileOptimizerMany(
+        src, [ir_passes[xt] for xt in ir_ext], header_file = header_file, use_aux_headers = use_aux_headers
+      )
+    except ValueError:
+      outputs = [""] * len(ir_ext)
+    raw.update({xt: "" if isinstance(out, ValueError) else out for xt, out in zip(ir_ext, outputs)})
+  return raw
+
+def _ExtractRawFeatures(src: str,
+                        ext: typing.List[str],
+                        header_file: str,
+                        use_aux_headers: bool,
+                        ) -> typing.Dict[str, str]:
+  """
+  Collect raw features of each extractor in ext, serving the ones
+  already computed for this source from the compile cache.
+  """
+  cc = compile_cache.GetCompileCache()
+  if cc is None:
+    return _ComputeRawFeatures(src, ext, header_file, use_aux_headers)
+  key = cc.Key(src, opencl.GetCompileCacheArgs(use_aux_headers), header_file)
+  raw = cc.GetRawFeatures(key, ext)
+  missing = _ComputeRawFeatures(src, [xt for xt in ext if xt not in raw], header_file, use_aux_headers)
+  cc.SetRawFeatures(key, missing)
+  raw.update(missing)
+  return raw
+
+def _ExtractRawFeaturesWorker(src: str,
+                              ext: typing.List[str],
+                              header_file: str,
+                              use_aux_headers: bool,
+                              ) -> str:
+  """Pool worker of ExtractRawFeaturesMany."""
+  raw = _ExtractRawFeatures(src, ext, header_file, use_aux_headers)
+  return '\n'.join(["{}:\n{}".format(xt, raw[xt]) for xt in ext])
+
 def ExtractFeatures(src: str,
                     ext: typing.List[str] = None,
                     header_file: str = None,
@@ -29,7 +93,8 @@ def ExtractFeatures(src: str,
   """
   if not ext:
     ext = list(extractors.keys())
-  return {xt: extractors[xt].ExtractFeatures(src, header_file = header_file, use_aux_headers = use_aux_headers) for xt in ext}
+  raw = _ExtractRawFeatures(src, ext, header_file, use_aux_headers)
+  return {xt: extractors[xt].RawToDictFeats(raw[xt]) for xt in ext}
 
 def ExtractRawFeatures(src: str,
                        ext: typing.List[str] = None,
@@ -42,7 +107,7 @@ def ExtractRawFeatures(src: str,
   """
   if not ext:
     ext = list(extractors.keys())
-  return '\n'.join(["{}:\n{}".format(xt, extractors[xt].ExtractRawFeatures(src, header_file = header_file, use_aux_headers = use_aux_headers)) for xt in ext])
+  return _ExtractRawFeaturesWorker(src, ext, header_file, use_aux_headers)
 
 def RawToDictFeats(str_feats: str) -> typing.Dict[str, typing.Dict[str, float]]:
   """
@@ -51,3 +116,21 @@ def RawToDictFeats(str_feats: str) -> typing.Dict[str, typing.Dict[str, float]]:
   """
   feats = {b.split(":\n")[0]: ''.join(b.split(':\n')[1:]) for b in str_feats.split('\n\n') if b.split(':\n')[1:]}
   return {xt: extractors[xt].RawToDictFeats(feat) for xt, feat in feats.items()}
+
+def ExtractRawFeaturesMany(srcs: typing.List[str],
+                           ext: typing.List[str] = None,
+                           header_file: str = None,
+                           use_aux_headers: bool = True,
+                           ) -> typing.List[str]:
+  """
+  Batched ExtractRawFeatures. Sources are distributed over the
+  long-lived clang worker pool, each compiled to bitcode once.
+  Returns one raw feature string per source.
+  """
+  if not ext:
+    ext = list(extractors.keys())
+  worker = functools.partial(_ExtractRawFeaturesWorker, ext = ext, header_file = header_file, use_aux_headers = use_aux_headers)
+  pool = clang.GetWorkerPool()
+  if pool is None or len(srcs) <= 1:
+    return [worker(src) for src in srcs]
+  return pool.map(worker, srcs, chunksize = max(1, len(srcs) // (4 * multiprocessing.cpu_count())))
@@ -13,18 +13,30 @@ import subprocess
 import functools
 import multiprocessing
 
+import numpy as np
+import sklearn.neighbors
+
 from deeplearning.clgen.features import extractor
 from deeplearning.clgen.features import normalizers
 from deeplearning.clgen.preprocessors import opencl
 from deeplearning.clgen.preprocessors import c
 from deeplearning.clgen.corpuses import corpuses
-from eupy.native import logger as l
+from deeplearning.clgen.util import crypto
 
 from absl import flags
 from eupy.native import logger as l
 
 FLAGS = flags.FLAGS
 
+flags.DEFINE_enum(
+  "feature_index",
+  "none",
+  ["none", "kd_tree", "ball_tree"],
+  "Index of corpus feature vectors for nearest neighbour lookups. "
+  "With 'none', every lookup computes distances against the whole corpus. "
+  "Trees are persisted in the sampler's workspace and rebuilt when the corpus changes."
+)
+
 targets = {
   'rodinia'      : './model_zoo/benchmarks/rodinia_3.1.tar.bz2',
   'BabelStream'  : './model_zoo/benchmarks/BabelStream.tar.bz2',
@@ -51,7 +63,7 @@ def preprocessor_worker(contentfile_batch):
     kernel_batch.append((p, k, h))
   return kernel_batch
 
-def benchmark_worker(benchmark, feature_space, reduced_git_corpus):
+def benchmark_worker(benchmark, feature_space):
   p, k, h = benchmark
   features = extractor.ExtractFeatures(
     k,
@@ -59,8 +71,7 @@ def benchmark_worker(benchmark, feature_space, reduced_git_corpus):
     header_file = h,
     use_aux_headers = False
   )
-  closest_git = sorted([(cf, calculate_distance(fts, features[feature_space], feature_space)) for cf, fts in reduced_git_corpus], key = lambda x: x[1])[0]
-  if features[feature_space] and closest_git[1] > 0:
+  if features[feature_space]:
     return Benchmark(p, p.name, k, features[feature_space])
 
 @contextlib.contextmanager
@@ -167,6 +178,103 @@ def calculate_distance(infeat: typing.Dict[str, float],
     d += abs((t**2) - (i**2))
   return math.sqrt(d)
 
+def FeatureColumns(feature_space: str) -> typing.List[str]:
+  """
+  Fixed column layout of feature vectors of a feature space.
+  """
+  return list(normalizers.normalizer[feature_space].keys())
+
+def FeatureMatrix(features: typing.Iterable[typing.Dict[str, float]],
+                  feature_space: str,
+                  ) -> np.array:
+  """
+  Pack feature dicts into a dense [N, columns] matrix.
+  Missing features are 0, features outside the layout are dropped.
+  """
+  columns = FeatureColumns(feature_space)
+  matrix = np.asarray(
+    [[fts.get(key, 0) for key in columns] for fts in features],
+    dtype = np.float64,
+  )
+  return matrix.reshape(-1, len(columns))
+
+def calculate_distances(inmatrix: np.array, tarvec: np.array) -> np.array:
+  """
+  calculate_distance between every row of a feature matrix
+  and a target feature vector.
+  """
+  return np.sqrt(np.abs(np.square(tarvec) - np.square(inmatrix)).sum(axis = -1))
+
+def TopK(distances: np.array, K: int) -> np.array:
+  """
+  Indices of the K smallest distances, closest first.
+  """
+  if K < len(distances):
+    idx = np.argpartition(distances, K)[:K]
+  else:
+    idx = np.arange(len(distances))
+  return idx[np.argsort(distances[idx], kind = 'stable')]
+
+class FeatureIndex(object):
+  """
+  Nearest neighbours of a matrix of feature vectors by calculate_distance.
+
+  The squared calculate_distance is the manhattan distance of the squared
+  feature vectors, so a KD-tree or a ball tree with the manhattan metric
+  over squared vectors answers lookups exactly. Without a tree, lookups
+  compute the distances against every row.
+  """
+  def __init__(self,
+               matrix : np.array,
+               kind   : str = "none",
+               path   : pathlib.Path = None,
+               ):
+    self.matrix = matrix
+    self.kind   = kind
+    self.tree   = None
+    if self.kind != "none" and len(self.matrix) > 0:
+      self.tree = self.loadTree(path)
+    return
+
+  def loadTree(self, path: pathlib.Path) -> typing.Union[sklearn.neighbors.KDTree, sklearn.neighbors.BallTree]:
+    """
+    Load the tree of the matrix from path, or build it and store it there.
+    """
+    digest = crypto.sha256(np.ascontiguousarray(self.matrix).tobytes())
+    if path is not None and path.exists():
+      with open(path, 'rb') as infile:
+        state = pickle.load(infile)
+      if state['digest'] == digest and state['kind'] == self.kind:
+        return state['tree']
+    l.getLogger().info("Building {} index of {} feature vectors".format(self.kind, len(self.matrix)))
+    if self.kind == "kd_tree":
+      tree = sklearn.neighbors.KDTree(np.square(self.matrix), metric = 'manhattan')
+    else:
+      tree = sklearn.neighbors.BallTree(np.square(self.matrix), metric = 'manhattan')
+    if path is not None:
+      with open(path, 'wb') as outf:
+        pickle.dump({'digest': digest, 'kind': self.kind, 'tree': tree}, outf, protocol = pickle.HIGHEST_PROTOCOL)
+    return tree
+
+  def __len__(self):
+    return len(self.matrix)
+
+  def Query(self, targets: np.array, K: int) -> typing.Tuple[np.array, np.array]:
+    """
+    Distances and indices of the K nearest rows of every target, closest first.
+    """
+    K = min(K, len(self.matrix))
+    if self.tree is not None:
+      dist, idx = self.tree.query(np.square(targets), k = K)
+      return np.sqrt(dist), idx
+    dists, idxs = [], []
+    for tarvec in targets:
+      distances = calculate_distances(self.matrix, tarvec)
+      idx = TopK(distances, K)
+      dists.append(distances[idx])
+      idxs.append(idx)
+    return np.asarray(dists).reshape(-1, K), np.asarray(idxs, dtype = np.int64).reshape(-1, K)
+
 class Benchmark(typing.NamedTuple):
   path : pathlib.Path
   name : str
@@ -190,12 +298,9 @@ class EuclideanSampler(object):
       self.path        = pathlib.Path(targets[target]).resolve()
     self.workspace     = workspace
     self.feature_space = feature_space
-    self.reduced_git_corpus = [
-      (cf, feats[self.feature_space])
-      for cf, feats in git_corpus.getFeaturesContents(sequence_length = 768)
-      if self.feature_space in feats and feats[self.feature_space]
-    ]
-    self.loadCheckpoint()
+    # The corpus is only read to pick benchmarks and is not kept,
+    # the sampler is pickled into every candidate worker.
+    self.loadCheckpoint(git_corpus)
     try:
       self.target_benchmark = self.benchmarks.pop(0)
       l.getLogger().info("Target benchmark: {}\nTarget fetures: {}".format(self.target_benchmark.name, self.target_benchmark.features))
@@ -216,6 +321,25 @@ class EuclideanSampler(object):
     l.getLogger().info("Target benchmark: {}\nTarget fetures: {}".format(self.target_benchmark.name, self.target_benchmark.features))
     return
 
+  def corpusIndex(self, git_corpus: corpuses.Corpus) -> FeatureIndex:
+    """
+    Index of the feature vectors of the git corpus.
+    Only feature vectors are needed to reject benchmarks already in the corpus.
+    """
+    matrix = FeatureMatrix(
+      (
+        feats[self.feature_space]
+        for feats in git_corpus.GetTrainingFeatures(sequence_length = 768)
+        if self.feature_space in feats and feats[self.feature_space]
+      ),
+      self.feature_space,
+    )
+    return FeatureIndex(
+      matrix,
+      FLAGS.feature_index,
+      self.workspace / "{}_{}.pkl".format(self.feature_space, FLAGS.feature_index),
+    )
+
   def calculate_distance(self, infeat: typing.Dict[str, float]) -> float:
     """
     Euclidean distance between sample feature vector
@@ -230,7 +354,8 @@ class EuclideanSampler(object):
     """
     Return top-K candidates.
     """
-    return sorted(candidates, key = lambda x: x.score)[:K]
+    scores = np.asarray([c.score for c in candidates], dtype = np.float64)
+    return [candidates[idx] for idx in TopK(scores, K)]
 
   def sample_from_set(self, 
                       candidates: typing.List[typing.TypeVar("ActiveSample")],
@@ -256,7 +381,7 @@ class EuclideanSampler(object):
       pickle.dump(self.benchmarks, outf)
     return
 
-  def loadCheckpoint(self) -> None:
+  def loadCheckpoint(self, git_corpus: corpuses.Corpus = None) -> None:
     """
     Load feature sampler state.
     """
@@ -279,16 +404,21 @@ class EuclideanSampler(object):
       else:
         kernels = yield_cl_kernels(self.path)
         pool = multiprocessing.Pool()
-        for benchmark in pool.map(
-                          functools.partial(
-                            benchmark_worker,
-                            feature_space = self.feature_space,
-                            reduced_git_corpus = self.reduced_git_corpus
-                          ), kernels
-                        ):
-          if benchmark:
-            self.benchmarks.append(benchmark)
-        self.benchmarks = sorted(self.benchmarks, key = lambda x: x.name)
+        benchmarks = [
+          b for b in pool.map(
+            functools.partial(
+              benchmark_worker,
+              feature_space = self.feature_space,
+            ), kernels
+          ) if b
+        ]
+        pool.close()
+        # Reject benchmarks whose features are already found in the corpus.
+        index = self.corpusIndex(git_corpus)
+        if len(index) > 0 and benchmarks:
+          closest_git, _ = index.Query(FeatureMatrix([b.features for b in benchmarks], self.feature_space), 1)
+          benchmarks = [b for b, d in zip(benchmarks, closest_git[:, 0]) if d > 0]
+        self.benchmarks = sorted(benchmarks, key = lambda x: x.name)
     l.getLogger().info("Loaded {}, {} benchmarks".format(self.target, len(self.benchmarks)))
     l.getLogger().info(', '.join([x for x in set([x.name for x in self.benchmarks])]))
     return
@@ -0,0 +1,366 @@
+"""Memory-mapped, sharded storage of padded training corpora.
+
+A corpus of fixed-width token sequences is stored as raw little-endian token
+matrices, '<name>_<i>.bin', next to a small JSON index '<name>.json' holding
+the sequence length, the dtype and the row count of every shard. Opening a
+corpus only reads the index; shards are memory-mapped on first access, so
+rows are paged in on demand and pages are shared between all processes, e.g.
+DataLoader workers, reading the same corpus. Corpora larger than memory are
+written one row at a time.
+
+Masked training instances, dicts of fixed-shape arrays, are stored the same
+way in record shards, with an index sidecar of their row count and the byte
+offset of every key.
+"""
+import bisect
+import json
+import os
+import pathlib
+import pickle
+import typing
+
+import numpy as np
+
+from eupy.native import logger as l
+
+def DtypeForVocabulary(vocab_size: int) -> np.dtype:
+  """Narrowest dtype that can store every index of a vocabulary."""
+  if vocab_size <= np.iinfo(np.int16).max + 1:
+    return np.dtype("<i2")
+  return np.dtype("<i4")
+
+class ShardWriter(object):
+  """Append fixed-width rows to the shards of a corpus.
+
+  The index is written when the writer is closed, so a corpus only becomes
+  visible to ShardedCorpus once it is complete.
+  """
+  def __init__(self,
+               path            : pathlib.Path,
+               name            : str,
+               sequence_length : int,
+               dtype           : np.dtype,
+               shard_size      : int = 5000000,
+               ):
+    self.path            = path
+    self.name            = name
+    self.sequence_length = sequence_length
+    self.dtype           = np.dtype(dtype).newbyteorder("<")
+    self.shard_size      = shard_size
+    self.shards          = []
+    self.file            = None
+    return
+
+  def __enter__(self) -> "ShardWriter":
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback) -> None:
+    if exc_type is None:
+      self.close()
+    elif self.file is not None:
+      self.file.close()
+    return
+
+  def write(self, row: typing.Union[np.array, typing.List[int]]) -> None:
+    """Append a single row of sequence_length tokens."""
+    self.extend(np.asarray(row).reshape(1, -1))
+    return
+
+  def extend(self, rows: np.array) -> None:
+    """Append a [num_rows, sequence_length] matrix."""
+    rows = np.asarray(rows)
+    if rows.ndim != 2 or rows.shape[1] != self.sequence_length:
+      raise ValueError("Expected rows of length {}, got shape {}".format(self.sequence_length, rows.shape))
+    while len(rows) > 0:
+      if self.file is None or self.shards[-1]["rows"] == self.shard_size:
+        self._NextShard()
+      space = self.shard_size - self.shards[-1]["rows"]
+      self.file.write(rows[:space].astype(self.dtype).tobytes())
+      self.shards[-1]["rows"] += len(rows[:space])
+      rows = rows[space:]
+    return
+
+  def close(self) -> None:
+    """Flush the last shard and write the corpus index."""
+    if self.file is not None:
+      self.file.close()
+      self.file = None
+    index = {
+      "sequence_length" : self.sequence_length,
+      "dtype"           : self.dtype.str,
+      "shards"          : self.shards,
+    }
+    tmp = self.path / "{}.json.tmp".format(self.name)
+    with open(tmp, 'w') as outf:
+      json.dump(index, outf, indent = 2)
+    os.replace(tmp, self.path / "{}.json".format(self.name))
+    return
+
+  def _NextShard(self) -> None:
+    if self.file is not None:
+      self.file.close()
+    shard = "{}_{}.bin".format(self.name, len(self.shards))
+    self.shards.append({"file": shard, "rows": 0})
+    self.file = open(self.path / shard, 'wb')
+    return
+
+def WriteShards(path: pathlib.Path,
+                name: str,
+                corpus: np.array,
+                dtype: np.dtype,
+                shard_size: int = 5000000,
+                ) -> None:
+  """Store an in-memory [num_rows, sequence_length] corpus."""
+  corpus = np.asarray(corpus)
+  with ShardWriter(path, name, corpus.shape[1], dtype, shard_size) as writer:
+    writer.extend(corpus)
+  return
+
+class ShardedCorpus(object):
+  """Read-only, memory-mapped view of a sharded corpus.
+
+  Indexing returns rows as writable int32 arrays.
+  """
+  @staticmethod
+  def Exists(path: pathlib.Path, name: str) -> bool:
+    return (path / "{}.json".format(name)).exists()
+
+  @property
+  def num_shards(self) -> int:
+    return len(self.shard_sizes)
+
+  def __init__(self, path: pathlib.Path, name: str):
+    with open(path / "{}.json".format(name), 'r') as infile:
+      index = json.load(infile)
+    self.path             = path
+    self.name             = name
+    self.sequence_length  = index["sequence_length"]
+    self.dtype            = np.dtype(index["dtype"])
+    self.shard_paths      = [path / s["file"] for s in index["shards"]]
+    self.shard_sizes      = [s["rows"] for s in index["shards"]]
+    self.cumulative_sizes = list(np.cumsum(self.shard_sizes, dtype = np.int64).tolist())
+    self._shards          = {}
+    return
+
+  def __getstate__(self) -> typing.Dict[str, typing.Any]:
+    # Memory maps are reopened by the receiving process.
+    state = self.__dict__.copy()
+    state["_shards"] = {}
+    return state
+
+  def Close(self) -> None:
+    """Drop the memory maps of the shards. They are reopened on access."""
+    self._shards = {}
+    return
+
+  def __len__(self) -> int:
+    return self.cumulative_sizes[-1] if self.cumulative_sizes else 0
+
+  def __getitem__(self, idx: int) -> np.array:
+    if idx < 0:
+      idx += len(self)
+    if not 0 <= idx < len(self):
+      raise IndexError("Index {} out of range for corpus of {} rows".format(idx, len(self)))
+    shard_idx = bisect.bisect_right(self.cumulative_sizes, idx)
+    offset    = self.cumulative_sizes[shard_idx - 1] if shard_idx > 0 else 0
+    return self.Shard(shard_idx)[idx - offset].astype(np.int32)
+
+  def __iter__(self) -> typing.Iterator[np.array]:
+    for shard_idx in range(self.num_shards):
+      for row in self.Shard(shard_idx):
+        yield row.astype(np.int32)
+
+  def Shard(self, shard_idx: int) -> np.array:
+    """Memory-map a shard as a [rows, sequence_length] matrix."""
+    if shard_idx not in self._shards:
+      if self.shard_sizes[shard_idx] == 0:
+        self._shards[shard_idx] = np.zeros((0, self.sequence_length), dtype = self.dtype)
+      else:
+        self._shards[shard_idx] = np.memmap(
+          self.shard_paths[shard_idx],
+          dtype = self.dtype,
+          mode  = 'r',
+          shape = (self.shard_sizes[shard_idx], self.sequence_length),
+        )
+    return self._shards[shard_idx]
+
+  def ToArray(self) -> np.array:
+    """Read the whole corpus into a single int32 matrix."""
+    if self.num_shards == 0:
+      return np.zeros((0, self.sequence_length), dtype = np.int32)
+    return np.concatenate([self.Shard(i) for i in range(self.num_shards)]).astype(np.int32)
+
+def RemoveShards(path: pathlib.Path, name: str) -> None:
+  """Delete the index and shards of a corpus."""
+  corpus = ShardedCorpus(path, name)
+  (path / "{}.json".format(name)).unlink()
+  for shard in corpus.shard_paths:
+    if shard.exists():
+      shard.unlink()
+  return
+
+def ShuffleShards(path: pathlib.Path,
+                  src_name: str,
+                  dst_name: str,
+                  rngen: np.random.RandomState,
+                  chunk_size: int = 65536,
+                  ) -> None:
+  """Copy a corpus with its rows in random order and delete the source.
+
+  Rows are gathered from the memory-mapped source chunk by chunk, so only the
+  permutation has to be held in memory.
+  """
+  src = ShardedCorpus(path, src_name)
+  permutation = rngen.permutation(len(src))
+  cumulative  = np.asarray(src.cumulative_sizes, dtype = np.int64)
+  with ShardWriter(path, dst_name, src.sequence_length, src.dtype) as writer:
+    for start in range(0, len(permutation), chunk_size):
+      idxs   = permutation[start: start + chunk_size]
+      shards = np.searchsorted(cumulative, idxs, side = 'right')
+      rows   = np.empty((len(idxs), src.sequence_length), dtype = src.dtype)
+      for shard_idx in np.unique(shards):
+        mask   = shards == shard_idx
+        offset = cumulative[shard_idx - 1] if shard_idx > 0 else 0
+        rows[mask] = src.Shard(shard_idx)[idxs[mask] - offset]
+      writer.extend(rows)
+  del src
+  RemoveShards(path, src_name)
+  return
+
+def ConvertPickledCorpus(path: pathlib.Path, name: str, dtype: np.dtype) -> bool:
+  """Convert '<name>.pkl' or '<name>_<i>.pkl' corpora of older caches to shards.
+
+  Returns:
+    True if a pickled corpus was found and converted.
+  """
+  if ShardedCorpus.Exists(path, name):
+    return False
+  pickled = sorted(
+    [p for p in path.glob("{}_*.pkl".format(name)) if p.stem.split('_')[-1].isdigit()],
+    key = lambda p: int(p.stem.split('_')[-1])
+  )
+  if (path / "{}.pkl".format(name)).exists():
+    pickled = [path / "{}.pkl".format(name)]
+  if not pickled:
+    return False
+  writer = None
+  for p in pickled:
+    with open(p, 'rb') as infile:
+      chunk = np.asarray(pickle.load(infile))
+    if len(chunk) == 0:
+      continue
+    if writer is None:
+      writer = ShardWriter(path, name, chunk.shape[1], dtype)
+    # Keep the chunking of the old files, which samplers shuffle within: every
+    # file becomes one shard of its own size.
+    writer.shard_size = len(chunk)
+    writer._NextShard()
+    writer.extend(chunk)
+  if writer is None:
+    return False
+  writer.close()
+  l.getLogger().info("Converted {} pickled corpus file(s) to memory-mapped shards in {}".format(len(pickled), path))
+  return True
+
+def RecordIndexPath(path: pathlib.Path) -> pathlib.Path:
+  """Path of the index sidecar of a record shard."""
+  return path.with_name("{}.index.json".format(path.name))
+
+def WriteRecordShard(path: pathlib.Path, instances: typing.List[typing.Dict[str, np.array]]) -> None:
+  """Store masked instances, dicts of fixed-shape arrays, as a record shard.
+
+  Every key of the instances is stored as a raw little-endian
+  [num_rows, *shape] matrix, one after the other. The row count and the
+  dtype, row shape and byte offset of every matrix are written to an index
+  sidecar, '<path>.index.json', so that rows can be read without loading the
+  shard.
+
+  Both files are written under temporary names and moved into place once
+  complete, the sidecar first. A crash in between leaves a sidecar that does
+  not describe the file at path, which RecordShard.Exists() rejects, so a
+  shard that is converted in place is never lost.
+  """
+  fields, offset = [], 0
+  tmp = path.with_name("{}.tmp".format(path.name))
+  with open(tmp, 'wb') as outf:
+    for key in (instances[0].keys() if instances else []):
+      matrix = np.stack([np.asarray(inst[key]) for inst in instances])
+      dtype  = matrix.dtype.newbyteorder("<")
+      data   = np.ascontiguousarray(matrix, dtype = dtype).tobytes()
+      outf.write(data)
+      fields.append({"key": key, "dtype": dtype.str, "shape": list(matrix.shape[1:]), "offset": offset})
+      offset += len(data)
+  index = {"rows": len(instances), "fields": fields}
+  index_tmp = RecordIndexPath(path).with_suffix(".tmp")
+  with open(index_tmp, 'w') as outf:
+    json.dump(index, outf, indent = 2)
+  os.replace(index_tmp, RecordIndexPath(path))
+  os.replace(tmp, path)
+  return
+
+def _RecordShardSize(index: typing.Dict[str, typing.Any]) -> int:
+  """Size in bytes of the record shard that an index describes."""
+  return max(
+    [
+      f["offset"] + index["rows"] * int(np.prod(f["shape"], dtype = np.int64)) * np.dtype(f["dtype"]).itemsize
+      for f in index["fields"]
+    ] + [0]
+  )
+
+class RecordShard(object):
+  """Read-only, memory-mapped view of a record shard.
+
+  Opening a shard only reads its index. The shard is mapped once, on first
+  access, and its matrices are views of that map at the offsets of the
+  index. Indexing returns an instance as a dict of writable arrays.
+  """
+  @staticmethod
+  def Exists(path: pathlib.Path) -> bool:
+    """True if path is a record shard of the size its index describes."""
+    if not RecordIndexPath(path).exists() or not path.exists():
+      return False
+    with open(RecordIndexPath(path), 'r') as infile:
+      index = json.load(infile)
+    return path.stat().st_size == _RecordShardSize(index)
+
+  def __init__(self, path: pathlib.Path):
+    with open(RecordIndexPath(path), 'r') as infile:
+      index = json.load(infile)
+    self.path      = path
+    self.rows      = index["rows"]
+    self.fields    = index["fields"]
+    self._buffer   = None
+    self._matrices = None
+    return
+
+  def __getstate__(self) -> typing.Dict[str, typing.Any]:
+    # Memory maps are reopened by the receiving process.
+    state = self.__dict__.copy()
+    state["_buffer"]   = None
+    state["_matrices"] = None
+    return state
+
+  def __len__(self) -> int:
+    return self.rows
+
+  def __getitem__(self, idx: int) -> typing.Dict[str, np.array]:
+    if idx < 0:
+      idx += len(self)
+    if not 0 <= idx < len(self):
+      raise IndexError("Index {} out of range for record shard of {} rows".format(idx, len(self)))
+    if self._matrices is None:
+      self._buffer   = np.memmap(self.path, dtype = np.uint8, mode = 'r')
+      self._matrices = {}
+      for f in self.fields:
+        dtype  = np.dtype(f["dtype"])
+        nbytes = self.rows * int(np.prod(f["shape"], dtype = np.int64)) * dtype.itemsize
+        self._matrices[f["key"]] = self._buffer[f["offset"]:f["offset"] + nbytes].view(dtype).reshape(
+          [self.rows] + f["shape"]
+        )
+    return {key: np.array(m[idx]) for key, m in self._matrices.items()}
+
+  def Close(self) -> None:
+    """Drop the memory map of the shard. It is reopened on access."""
+    self._matrices = None
+    self._buffer   = None
+    return
@@ -142,14 +142,15 @@ class BenchmarkDistance(BaseEvaluator):
     print(len(clgen_corpus))
     print(len(git_corpus))
     print(len(reduced_git_corpus))
+    corpora  = [bert_corpus, clgen_corpus, git_corpus, reduced_git_corpus]
+    matrices = [feature_sampler.FeatureMatrix([fts for _, fts in corpus], self.feature_space) for corpus in corpora]
     for benchmark in self.evaluated_benchmarks:
-      try:
-        bc  = sorted([(cf, feature_sampler.calculate_distance(fts, benchmark.features, self.feature_space)) for cf, fts in bert_corpus ], key = lambda x: x[1])[:topK]
-        cc  = sorted([(cf, feature_sampler.calculate_distance(fts, benchmark.features, self.feature_space)) for cf, fts in clgen_corpus], key = lambda x: x[1])[:topK]
-        gc  = sorted([(cf, feature_sampler.calculate_distance(fts, benchmark.features, self.feature_space)) for cf, fts in git_corpus  ], key = lambda x: x[1])[:topK]
-        rgc = sorted([(cf, feature_sampler.calculate_distance(fts, benchmark.features, self.feature_space)) for cf, fts in reduced_git_corpus  ], key = lambda x: x[1])[:topK]
-      except KeyError:
-        print(git_corpus)
+      tarvec  = feature_sampler.FeatureMatrix([benchmark.features], self.feature_space)[0]
+      closest = []
+      for corpus, matrix in zip(corpora, matrices):
+        distances = feature_sampler.calculate_distances(matrix, tarvec)
+        closest.append([(corpus[idx][0], distances[idx]) for idx in feature_sampler.TopK(distances, topK)])
+      bc, cc, gc, rgc = closest
 
       print(benchmark.name)
       print(benchmark.features)
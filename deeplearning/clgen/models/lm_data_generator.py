@@ -19,6 +19,7 @@ from deeplearning.clgen.util import distributions
 from deeplearning.clgen.util import monitors
 from deeplearning.clgen.features import extractor
 from deeplearning.clgen.proto import model_pb2
+from deeplearning.clgen.models import corpus_shards
 from deeplearning.clgen.models import sequence_masking
 from deeplearning.clgen.models import lm_database
 from absl import flags
@@ -43,12 +44,21 @@ flags.DEFINE_boolean(
   "Force data generator to re-mask encoded dataset and store dataset record."
 )
 
+flags.DEFINE_integer(
+  "masking_seed",
+  None,
+  "Seed hole insertion to make masked datasets reproducible. [Default]: fresh entropy per batch."
+)
+
 flags.DEFINE_boolean(
   "store_datasets_to_DB",
   False,
   "Set True to store masked datasets to SQL Database for observation."
 )
 
+# Number of sequences per task of batched hole insertion.
+HOLE_CHUNK_SIZE = 256
+
 def AssertConfigIsValid(config: model_pb2.DataGenerator,
                         ) -> model_pb2.DataGenerator:
   """
@@ -170,7 +180,7 @@ class MaskLMDataGenerator(object):
 
     self.file_extension = file_extension
     self.mask_func      = sequence_masking.MPMaskSequence
-    self.hole_func      = sequence_masking.MPHoleSequence
+    self.hole_func      = sequence_masking.MPHoleSequenceBatch
 
     self.dataset                 = None
     self.corpus                  = None
@@ -429,7 +439,8 @@ class MaskLMDataGenerator(object):
     end               = [self.tokenizer.endToken   ]
     shaped_corpus     = None
 
-    corpus_file = "{}corpus.pkl".format("pre_" if self.pre_train else "")
+    corpus_name = "{}corpus".format("pre_" if self.pre_train else "")
+    dtype       = corpus_shards.DtypeForVocabulary(self.tokenizer.vocab_size)
 
     # Monitor counts actual length distribution of kernel instances.
     kernel_length_monitor = monitors.FrequencyMonitor(path, "{}kernel_length".format("pre_" if self.pre_train else ""))
@@ -443,19 +454,24 @@ class MaskLMDataGenerator(object):
         for ftype in extractor.extractors.keys()
       }
 
-    if (path / corpus_file).exists():
-      with open(path / corpus_file, 'rb') as infile:
-        shaped_corpus = pickle.load(infile)
+    corpus_shards.ConvertPickledCorpus(path, corpus_name, dtype)
+    if corpus_shards.ShardedCorpus.Exists(path, corpus_name):
+      shaped_corpus = corpus_shards.ShardedCorpus(path, corpus_name)
+      if self.pre_train:
         if self.num_train_steps:
           self.num_epochs      = self.num_train_steps // self.config.steps_per_epoch
-          self.steps_per_epoch = self.config.steps_per_epoch
-        l.getLogger().info(
-          "Loaded from file corpus of {} examples in {} ms.".format(
-                    humanize.intcomma(len(shaped_corpus)),
-                    humanize.intcomma(int((time.time() - start_time) * 1000)),
-                )
-        )
-      return shaped_corpus
+        self.steps_per_epoch = self.config.steps_per_epoch
+      elif self.num_train_steps:
+        self.num_epochs      = self.num_train_steps // self.config.steps_per_epoch
+        self.steps_per_epoch = self.config.steps_per_epoch
+      l.getLogger().info(
+        "Loaded from file corpus of {} examples in {} ms.".format(
+                  humanize.intcomma(len(shaped_corpus)),
+                  humanize.intcomma(int((time.time() - start_time) * 1000)),
+              )
+      )
+      # Online and pre-training corpora are only read through the memory-mapped shards.
+      return shaped_corpus if self.pre_train or self.config.datapoint_time == "online" else shaped_corpus.ToArray()
 
     # generate a kernel corpus
     if (path / "text_corpus.pkl").exists():
@@ -464,47 +480,35 @@ class MaskLMDataGenerator(object):
       # right tokenizer. And that is the model's tokenizer.
       with open(path / "text_corpus.pkl", 'rb') as infile:
         encoded_corpus = [self.tokenizer.TokenizeString(x) for x in pickle.load(infile)]
+        encoded_batches = [encoded_corpus]
     else:
       if self.pre_train:
         if self.num_train_steps:
           self.num_epochs      = self.num_train_steps // self.config.steps_per_epoch
         self.steps_per_epoch = self.config.steps_per_epoch
-        if len(glob.glob(str(path / "pre_corpus_*.pkl"))) > 0:
-          return []
-        encoded_corpus = []
-        chunk_size = 5000000
-        i, ch_idx = 0, 0
-        for kernel in self.corpus.GetTrainingDataGenerator():
-          try:
-            enck = self._addStartEndToken(list(kernel[:effect_seq_length]))
-          except AssertionError:
-            continue
-          kernel_length_monitor.register(len(enck))
-          enck += pad * (sequence_length - len(enck))
-          encoded_corpus.append(np.array(enck))
-          i += 1
-          if i % chunk_size == 0:
-            encoded_corpus = np.array(encoded_corpus)
-            corpus_file = "pre_corpus_{}.pkl".format(ch_idx)
-            l.getLogger().info("Fixing chunk {}, len: {}".format(ch_idx, encoded_corpus.shape))
-            with open(path / corpus_file, 'wb') as outf:
-              pickle.dump(encoded_corpus, outf, protocol = 4)
-            ch_idx += 1
-            encoded_corpus = []
-        if encoded_corpus:
-          encoded_corpus = np.array(encoded_corpus)
-          l.getLogger().info("Fixing chunk {}, len: {}".format(ch_idx, encoded_corpus.shape))
-          corpus_file = "pre_corpus_{}.pkl".format(ch_idx)
-          with open(path / corpus_file, 'wb') as outf:
-            pickle.dump(encoded_corpus, outf, protocol = 4)
+        # Kernels are streamed to disk, so the corpus never has to fit in memory.
+        with corpus_shards.ShardWriter(path, corpus_name, sequence_length, dtype, shard_size = 5000000) as writer:
+          for kernel in self.corpus.GetTrainingDataGenerator():
+            try:
+              enck = self._addStartEndToken(list(kernel[:effect_seq_length]))
+            except AssertionError:
+              continue
+            kernel_length_monitor.register(len(enck))
+            enck += pad * (sequence_length - len(enck))
+            writer.write(enck)
+        l.getLogger().info("Stored pre-training corpus in {} shards of {} examples".format(len(writer.shards), [x['rows'] for x in writer.shards]))
         kernel_length_monitor.plot()
-        return encoded_corpus
+        return corpus_shards.ShardedCorpus(path, corpus_name)
+      elif self.config.datapoint_type == "kernel":
+        # Encoded files are streamed in bounded batches and padded straight to disk.
+        encoded_batches = self.corpus.GetTrainingDataBatches(
+          sequence_length = effect_seq_length if not self.config.truncate_large_kernels else None
+        )
       else:
         encoded_corpus  = self.corpus.GetTrainingData(sequence_length = effect_seq_length if not self.config.truncate_large_kernels else None)
 
     if self.config.datapoint_type == "kernel":
-      # Reject larger than sequence length
-      initial_length = copy.deepcopy(len(encoded_corpus))
+      initial_length, reduced_length = 0, 0
 
       if not self.pre_train:
         # Get features of fitting dataset within sequence length
@@ -512,42 +516,49 @@ class MaskLMDataGenerator(object):
           for ftype, fvector in feature.items():
             feature_monitors[ftype].register(fvector)
 
-      if self.config.truncate_large_kernels:
-        encoded_corpus     = [list(x[:effect_seq_length]) for x in encoded_corpus if len(x[:effect_seq_length]) <= effect_seq_length] # Account for start and end token
-      else:
-        encoded_corpus     = [list(x) for x in encoded_corpus if len(x) <= effect_seq_length] # Account for start and end token
-
-      reduced_length       = copy.deepcopy(len(encoded_corpus))
-      # Add start/end tokens
-      if self.config.use_start_end:
-        encoded_corpus     = [self._addStartEndToken(kf) for kf in encoded_corpus]
-      # Register the actual lengths before padding.
-      kernel_length_monitor.register([len(x) for x in encoded_corpus])
-      # pad sequences to sequence length
-      encoded_corpus       = np.array([x + pad * (sequence_length - len(x)) for x in encoded_corpus])
+      # Rows are written in corpus order and shuffled on disk afterwards.
+      written_name = "{}_unshuffled".format(corpus_name) if shuffle else corpus_name
+      with corpus_shards.ShardWriter(path, written_name, sequence_length, dtype) as writer:
+        for encoded_batch in encoded_batches:
+          # Reject larger than sequence length
+          initial_length += len(encoded_batch)
+          if self.config.truncate_large_kernels:
+            kernels = [list(x[:effect_seq_length]) for x in encoded_batch if len(x[:effect_seq_length]) <= effect_seq_length] # Account for start and end token
+          else:
+            kernels = [list(x) for x in encoded_batch if len(x) <= effect_seq_length] # Account for start and end token
+          reduced_length += len(kernels)
+          # Add start/end tokens
+          if self.config.use_start_end:
+            kernels = [self._addStartEndToken(kf) for kf in kernels]
+          # Register the actual lengths before padding.
+          kernel_length_monitor.register([len(x) for x in kernels])
+          # pad sequences to sequence length
+          if kernels:
+            writer.extend(np.array([x + pad * (sequence_length - len(x)) for x in kernels]))
       # Clone datapoints dupe_factor times
       # shaped_corpus   = np.repeat(encoded_corpus, dupe_factor, axis = 0)
-      shaped_corpus     = encoded_corpus
       # Shuffle
       if shuffle:
-        self.rngen.shuffle(shaped_corpus)
+        corpus_shards.ShuffleShards(path, written_name, corpus_name, self.rngen)
+      shaped_corpus = corpus_shards.ShardedCorpus(path, corpus_name)
       assert len(shaped_corpus) != 0, "Not enought data. All kernels have been rejected."
 
       # Set corpus epoch parameters
       if self.num_train_steps:
         self.num_epochs      = self.num_train_steps // self.config.steps_per_epoch
       self.steps_per_epoch = self.config.steps_per_epoch
-      assert shaped_corpus.ndim     == 2, "corpus dim: {}".format(shaped_corpus.shape)
-      assert shaped_corpus.shape[1] == sequence_length, "Dim 1 shape mismatch: {}, target: {}".format(shaped_corpus.shape[1], sequence_length)
+      assert shaped_corpus.sequence_length == sequence_length, "Dim 1 shape mismatch: {}, target: {}".format(shaped_corpus.sequence_length, sequence_length)
 
       l.getLogger().info("{} kernels were rejected (larger than sequence_length)".format(initial_length - reduced_length))
       l.getLogger().info(
         "Loaded corpus of shape {} multiplied by dupe factor: {} in {} ms.".format(
-                  shaped_corpus.shape,
+                  (len(shaped_corpus), shaped_corpus.sequence_length),
                   dupe_factor,
                   humanize.intcomma(int((time.time() - start_time) * 1000)),
               )
       )
+      if self.config.datapoint_time != "online":
+        shaped_corpus = shaped_corpus.ToArray()
     elif self.config.datapoint_type == "statement":
     ## This branch is legacy data processing
 
@@ -590,8 +601,8 @@ class MaskLMDataGenerator(object):
     if not self.pre_train:
       for fm in feature_monitors.values():
         fm.plot()
-    with open(path / corpus_file, 'wb') as outf:
-      pickle.dump(shaped_corpus, outf)
+    if self.config.datapoint_type == "statement":
+      corpus_shards.WriteShards(path, corpus_name, np.asarray(shaped_corpus), dtype)
     return shaped_corpus
 
   def _maskCorpus(self,
@@ -660,17 +671,25 @@ class MaskLMDataGenerator(object):
       distribution = distributions.Distribution.FromHoleConfig(
         config.hole, path, "hole_length_{}".format(set_name)
       )
-      maskedSeq    = lambda c: pool.imap_unordered(
-        functools.partial(self.hole_func,
-                          train_set            = train_set,
-                          max_predictions      = max_predictions,
-                          pickled_distribution = pickle.dumps(distribution),
-                          pickled_tokenizer    = pickle.dumps(self.tokenizer),
-                          training_opts        = self.training_opts,
-                          is_torch             = self.is_torch,
-                          ),
-        c
+      hole_func    = functools.partial(self.hole_func,
+                                       train_set            = train_set,
+                                       max_predictions      = max_predictions,
+                                       pickled_distribution = pickle.dumps(distribution),
+                                       pickled_tokenizer    = pickle.dumps(self.tokenizer),
+                                       training_opts        = self.training_opts,
+                                       is_torch             = self.is_torch,
+                                       )
+      # Holes are inserted to whole chunks of the corpus at once. With a masking seed,
+      # chunks get seeds drawn in order and results are consumed in order, to be reproducible.
+      seed_rngen    = np.random.RandomState(FLAGS.masking_seed) if FLAGS.masking_seed is not None else None
+      seeded_chunks = lambda c: (
+        (seed_rngen.randint(0, 2**31) if seed_rngen else None, c[idx: idx + HOLE_CHUNK_SIZE])
+        for idx in range(0, len(c), HOLE_CHUNK_SIZE)
       )
+      if FLAGS.masking_seed is None:
+        maskedSeq  = lambda c: (k for chunk in pool.imap_unordered(hole_func, seeded_chunks(c)) for k in chunk)
+      else:
+        maskedSeq  = lambda c: (k for chunk in pool.imap(hole_func, seeded_chunks(c)) for k in chunk)
     elif config.HasField("mask"):
       maskedSeq    = lambda c: pool.imap_unordered(
         functools.partial(self.mask_func,
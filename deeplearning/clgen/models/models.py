@@ -31,6 +31,7 @@ from deeplearning.clgen.util import pbutil
 from deeplearning.clgen.util import cache
 from deeplearning.clgen.util import crypto
 from deeplearning.clgen.util import commit
+from deeplearning.clgen.util import compile_cache
 from deeplearning.clgen.features import extractor
 from deeplearning.clgen.corpuses import tokenizers
 from deeplearning.clgen.corpuses import corpuses
@@ -424,6 +425,7 @@ class Model(object):
       obs.endSample()
     if isinstance(self.backend, torch_bert.torchBert) and sampler.is_active:
       self.backend.sample.data_generator.samples_cache_obs.endSample()
+    compile_cache.ReportHitRate()
 
     time_now = datetime.datetime.utcnow()
     l.getLogger().info( "Produced {} samples at a rate of {} ms / sample."
@@ -456,16 +458,13 @@ class Model(object):
       return True, seq_count
 
     continue_sampling = True
-    for org, inp, sample, idxs in zip(org_inputs, input_ids, samples, indices):
-
-      src = self.tokenizer.ArrayToCode(sample, with_formatting = True)
-      try:
-        stdout = opencl.Compile(src)
-        compile_flag = True
-        features = extractor.ExtractRawFeatures(src)
-      except ValueError:
-        compile_flag = False
-        features     = ""
+    srcs          = [self.tokenizer.ArrayToCode(sample, with_formatting = True) for sample in samples]
+    compile_flags = opencl.CompileMany(srcs)
+    compiling     = [src for src, compile_flag in zip(srcs, compile_flags) if compile_flag]
+    features_iter = iter(extractor.ExtractRawFeaturesMany(compiling))
+    for org, inp, sample, idxs, src, compile_flag in zip(org_inputs, input_ids, samples, indices, srcs, compile_flags):
+
+      features = next(features_iter) if compile_flag else ""
 
       end_time = datetime.datetime.utcnow()
       sample = model_pb2.Sample(
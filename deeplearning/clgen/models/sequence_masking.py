@@ -563,6 +563,214 @@ def HoleSequence(seq: np.array,
       'next_sentence_labels': next_sentence_labels,
     }
 
+def HoleSequenceBatch(batch: np.array,
+                      train_set: bool,
+                      max_predictions: int,
+                      masked_lm_prob: int,
+                      distribution: distributions.Distribution,
+                      tokenizer,
+                      rngen: np.random.RandomState = None,
+                      ) -> typing.Tuple[
+                             typing.List[typing.Dict[str, np.array]],
+                             typing.List[typing.List[MaskedLmInstance]],
+                           ]:
+  """
+  Inserts hole tokens to every sequence of a [batch_size, sequence_length] matrix.
+
+  Batched counterpart of HoleSequence. Every round draws one candidate position
+  and hole length for all sequences that still need holes and validates them at
+  once. Holes are tracked in the coordinates of the original sequences, so the
+  holed sequences are assembled with a single scatter at the end, instead of
+  slicing lists and shifting offsets per hole.
+
+  As in HoleSequence, hole lengths follow distribution, each sequence extends
+  all its holes to one randomly picked direction, holes never overlap nor cover
+  [START]/[END] tokens, and they are lengthened when needed to fit the sequence.
+
+  Pass a seeded rngen for reproducible holes. By default fresh entropy is used.
+
+  Returns:
+    One HoleSequence-like instance and one list of holes, with positions in the
+    original sequence, per row of batch.
+  """
+  batch = np.asarray(batch)
+  assert batch.ndim == 2, "Input for batch masking must be a two-dimensional array."
+  rngen = rngen or np.random.RandomState()
+  batch_size, seq_length = batch.shape
+
+  # Actual length represents the sequence length before pad begins
+  is_end  = batch == tokenizer.endToken
+  is_pad  = batch == tokenizer.padToken
+  has_end = (batch[:, 0] == tokenizer.startToken) & is_end.any(axis = 1)
+  actual_length = np.where(
+    has_end, is_end.argmax(axis = 1), np.where(is_pad.any(axis = 1), is_pad.argmax(axis = 1), seq_length)
+  ).astype(np.int64)
+  last_elem = np.where(has_end, actual_length, actual_length - 1)
+
+  # total tokens to add in holes.
+  # No more than max_predictions_per_seq (or otherwise specified), no less than actual seq length x the probability of hiding a token
+  holes_to_predict = np.minimum(
+    max_predictions, np.maximum(1, np.round(actual_length * masked_lm_prob).astype(np.int64))
+  )
+  extend_left = rngen.randint(0, 2, size = batch_size) == 1
+
+  # Tokens that can't be holed.
+  special  = (batch == tokenizer.startToken) | is_end
+  # Original tokens hidden by a hole.
+  covered  = np.zeros(batch.shape, dtype = bool)
+  # A hole token is placed right before this original token.
+  boundary = np.zeros(batch.shape, dtype = bool)
+  # Total masks placed so far and change of the sequence length they have caused.
+  total_predictions = np.zeros(batch_size, dtype = np.int64)
+  growth            = np.zeros(batch_size, dtype = np.int64)
+  holes = []
+
+  # Rounds are bounded, as a sequence with no room for holes would never finish.
+  for _ in range(4 * seq_length):
+    rows = np.where((total_predictions < holes_to_predict) & (actual_length > 0))[0]
+    if len(rows) == 0:
+      break
+    left = extend_left[rows]
+    pos  = (rngen.random_sample(len(rows)) * actual_length[rows]).astype(np.int64)
+    # Do not target an index already holed, or a [START]/[END] token.
+    valid = ~(covered[rows, pos] | boundary[rows, pos] | special[rows, pos])
+
+    # Sampled number from distribution to represent the actual hole length,
+    # increased if too many empty holes have pushed rightmost elements over the edge.
+    min_length  = np.maximum(0, last_elem[rows] + growth[rows] + 2 - seq_length)
+    hole_length = np.maximum(distribution.sample_batch(actual_length[rows], rngen), min_length)
+
+    # Shorten holes that would run into another hole, a [START]/[END] token or the sequence bounds.
+    steps  = np.arange(int(hole_length.max()) + 1)
+    idx    = np.where(left[:, None], pos[:, None] - steps, pos[:, None] + steps)
+    oob    = np.where(left[:, None], idx < 1, idx >= last_elem[rows][:, None])
+    cidx   = np.clip(idx, 0, seq_length - 1)
+    bidx   = np.clip(np.where(left[:, None], idx + 1, idx), 0, seq_length - 1)
+    stop   = (oob
+      | covered[rows[:, None], cidx]
+      | special[rows[:, None], cidx]
+      | (boundary[rows[:, None], bidx] & (steps > 0))
+    )
+    hole_length = np.minimum(hole_length, np.where(stop.any(axis = 1), stop.argmax(axis = 1), len(steps)))
+    # This hole can't help but explode the sequence. Go find a new position.
+    valid &= hole_length >= min_length
+
+    rows, left, pos, hole_length, cidx = rows[valid], left[valid], pos[valid], hole_length[valid], cidx[valid]
+    start  = np.where(left & (hole_length > 0), pos - hole_length + 1, pos)
+    # Target token for classifier is either the first token of the hole, or endholeToken if hole is empty
+    target = np.where(hole_length > 0, batch[rows, start], tokenizer.endholeToken)
+
+    hidden = steps < hole_length[:, None]
+    covered[np.broadcast_to(rows[:, None], cidx.shape)[hidden], cidx[hidden]] = True
+    boundary[rows, start] = True
+    total_predictions[rows] += np.maximum(1, hole_length)
+    growth[rows]            += 1 - hole_length
+    holes.append((rows, start, hole_length, target, left))
+
+  # Every original position emits its hole token, if any, followed by itself if not hidden.
+  emitted   = boundary.astype(np.int64) + ~covered
+  first_idx = np.cumsum(emitted, axis = 1) - emitted
+  token_idx = first_idx + boundary
+  input_ids = np.full(batch.shape, tokenizer.padToken, dtype = np.int64)
+  kept      = ~covered & (token_idx < seq_length)
+  input_ids[np.nonzero(kept)[0], token_idx[kept]] = batch[kept]
+  hole_tok  = boundary & (first_idx < seq_length)
+  input_ids[np.nonzero(hole_tok)[0], first_idx[hole_tok]] = tokenizer.holeToken
+
+  input_pad  = input_ids == tokenizer.padToken
+  first_pad  = np.where(input_pad.any(axis = 1), input_pad.argmax(axis = 1), seq_length)
+  input_mask = (np.arange(seq_length) < first_pad[:, None]).astype(np.int64)
+
+  if holes:
+    h_rows, h_start, h_length, h_target, h_left = [np.concatenate(x) for x in zip(*holes)]
+  else:
+    h_rows, h_start, h_length, h_target, h_left = [np.zeros(0, dtype = np.int64)] * 5
+  order  = np.lexsort((h_start, h_rows))
+  h_rows, h_start, h_length, h_target, h_left = h_rows[order], h_start[order], h_length[order], h_target[order], h_left[order]
+  h_pos  = first_idx[h_rows, h_start]
+  bounds = np.searchsorted(h_rows, np.arange(batch_size + 1))
+
+  mask_labels = np.full(batch.shape, -100, dtype = np.int64)
+  in_seq = h_pos < seq_length
+  mask_labels[h_rows[in_seq], h_pos[in_seq]] = h_target[in_seq]
+
+  if (bounds[1:] == bounds[:-1]).any():
+    l.getLogger().warn("No HOLE added to {} datapoint(s). Increase probability of hole occuring.".format(
+      int((bounds[1:] == bounds[:-1]).sum()))
+    )
+
+  seen_in_training     = np.int64([1] if train_set else [0])
+  next_sentence_labels = np.int64([0])
+  position_ids         = np.arange(seq_length, dtype = np.int64)
+  kernels, hole_analytics = [], []
+  for row in range(batch_size):
+    s, e = bounds[row], bounds[row + 1]
+    masked_lm_lengths = np.full(holes_to_predict[row], -1, dtype = np.int64)
+    lengths = h_length[s:e][in_seq[s:e]]
+    masked_lm_lengths[:len(lengths)] = lengths
+    kernels.append({
+      'seen_in_training'    : seen_in_training,
+      'original_input'      : batch[row],
+      'input_ids'           : input_ids[row],
+      'input_mask'          : input_mask[row],
+      'position_ids'        : position_ids,
+      'mask_labels'         : mask_labels[row],
+      'masked_lm_lengths'   : masked_lm_lengths,
+      'next_sentence_labels': next_sentence_labels,
+    })
+    hole_analytics.append([
+      MaskedLmInstance(pos_index = int(p), token_id = int(t), hole_length = int(hl), extend_left = bool(el))
+      for p, t, hl, el in zip(h_start[s:e], h_target[s:e], h_length[s:e], h_left[s:e])
+    ])
+  return kernels, hole_analytics
+
+def MPHoleSequenceBatch(seeded_batch: typing.Tuple[typing.Optional[int], np.array],
+                        train_set: bool,
+                        max_predictions: int,
+                        pickled_distribution: distributions.Distribution,
+                        pickled_tokenizer,
+                        training_opts,
+                        is_torch: bool,
+                        ) -> typing.List[
+                               typing.Tuple[
+                                 typing.Union[typing.Dict[str, np.array], tfSequence],
+                                 typing.List[MaskedLmInstance],
+                               ]
+                             ]:
+  """
+  Multiprocessing wrapper of HoleSequenceBatch, mapped over (seed, batch) tuples.
+
+  A seed of None draws fresh entropy. Otherwise holes are reproducible, no matter
+  which worker processes the batch.
+  """
+  seed, batch  = seeded_batch
+  distribution = pickle.loads(pickled_distribution)
+  tokenizer    = pickle.loads(pickled_tokenizer)
+  kernels, hole_analytics = HoleSequenceBatch(
+    batch, train_set, max_predictions, training_opts.masked_lm_prob, distribution, tokenizer,
+    rngen = np.random.RandomState(seed) if seed is not None else None,
+  )
+  if not is_torch: # TF 1.X, 2.[0-2]
+    kernels = [_TorchToTfSequence(k, tokenizer, training_opts.max_predictions_per_seq) for k in kernels]
+  return list(zip(kernels, hole_analytics))
+
+def _TorchToTfSequence(kernel: typing.Dict[str, np.array], tokenizer, max_predictions_per_seq: int) -> tfSequence:
+  """Convert an instance of HoleSequenceBatch to the tfSequence MPHoleSequence returns."""
+  masked_lm_positions = np.where(kernel['mask_labels'] != -100)[0]
+  num_holes           = len(masked_lm_positions)
+  pad                 = max_predictions_per_seq - num_holes
+  return tfSequence(
+    np.int32(kernel['seen_in_training'][0]),
+    kernel['original_input'],
+    kernel['input_ids'],
+    kernel['input_mask'],
+    np.concatenate([masked_lm_positions, np.zeros(pad, dtype = np.int64)]),
+    np.concatenate([kernel['mask_labels'][masked_lm_positions], np.full(pad, tokenizer.padToken, dtype = np.int64)]),
+    np.concatenate([np.ones(num_holes, dtype = np.float32), np.zeros(pad, dtype = np.float32)]),
+    np.concatenate([kernel['masked_lm_lengths'][:num_holes], np.full(pad, -1, dtype = np.int64)]),
+    np.int32(0),
+  )
+
 def MaskedSeqToBlob(enc_text: np.array,
                     tokenizer,
                     sequence_length: int,
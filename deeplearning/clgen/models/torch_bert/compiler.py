@@ -1,14 +1,15 @@
+import collections
+import concurrent.futures
+import time
 import numpy as np
 import typing
-import concurrent.futures
 
+from deeplearning.clgen.features import extractor
 from deeplearning.clgen.preprocessors import opencl
 from deeplearning.clgen.corpuses import tokenizers
 from deeplearning.clgen.util import pytorch
 from deeplearning.clgen.util.pytorch import torch
 
-from eupy.native import logger as l
-
 class CompilationSampler(object):
   """
   Compilation driven generation handler.
@@ -46,14 +47,10 @@ class CompilationSampler(object):
     return torch.argmax(t, dim = -1)
 
   def checkIfBatchCompiles(self,
-                           sample: np.array
-                           ) -> int:
-    """Sends a filled sequence to the compiler"""
-    try:
-      stdout = opencl.Compile(self.tokenizer.ArrayToCode(sample))
-      return 1
-    except ValueError:
-      return 0
+                           samples: typing.List[np.array]
+                           ) -> typing.List[int]:
+    """Sends a batch of filled sequences to the compiler worker pool"""
+    return [int(x) for x in opencl.CompileMany([self.tokenizer.ArrayToCode(s) for s in samples])]
 
   def generateTrainingBatch(self,
                             model             : typing.TypeVar("model.BertPreTrainedModel"),
@@ -62,23 +59,18 @@ class CompilationSampler(object):
                             prediction_scores : torch.FloatTensor,
                             position_ids      : torch.LongTensor,
                             masked_lm_labels  : torch.LongTensor,
-                            ) -> typing.Tuple[typing.List[np.array], typing.List[int]]:
-    batch_size, sequence_length = tuple(input_ids.shape)
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-      jobs = [executor.submit(self.iterTrainingSeq,
-                              model             = model,
-                              device            = device,
-                              input_ids         = input_ids        [i],
-                              prediction_scores = prediction_scores[i],
-                              position_ids      = position_ids     [i],
-                              masked_lm_labels  = masked_lm_labels [i],
-                          ) for i in range(batch_size)]
-
-      results          = [j.result() for j in jobs]
-      samples          = [x.numpy() for (x, _, _) in results]
-      compile_flag     = [y         for (_, y, _) in results]
-      masked_lm_labels = torch.LongTensor([z for (_, _, z) in results]).to(device)
-      return samples, compile_flag, masked_lm_labels
+                            ) -> typing.Tuple[typing.List[np.array], typing.List[int], torch.LongTensor, float]:
+    samples = list(self.BatchFill(model, input_ids, prediction_scores, position_ids).cpu().numpy())
+    # Filled sequences are compiled all at once, to share the worker pool.
+    t = time.time()
+    compile_flag = self.checkIfBatchCompiles(samples)
+    compile_ms   = 1000 * (time.time() - t)
+    masked_lm_labels = np.copy(masked_lm_labels)
+    for i, flag in enumerate(compile_flag):
+      if flag:
+        masked_lm_labels[i] = -100
+    masked_lm_labels = torch.LongTensor(masked_lm_labels).to(device)
+    return samples, compile_flag, masked_lm_labels, compile_ms
 
   def iterTrainingSeq(self,
                       model             : typing.TypeVar("model.BertPreTrainedModel"),
@@ -86,8 +78,7 @@ class CompilationSampler(object):
                       input_ids         : torch.LongTensor,
                       prediction_scores : torch.FloatTensor,
                       position_ids      : torch.LongTensor,
-                      masked_lm_labels  : torch.LongTensor,
-                      ) -> typing.Tuple[torch.LongTensor, int]:
+                      ) -> torch.LongTensor:
     """
     Main training sequence filling loop.
     
@@ -96,10 +87,9 @@ class CompilationSampler(object):
     iteratively for predictions until target [MASK] or [HOLE] tokens
     are closed.
 
-    Compiler is invoked for final sequence to get binary compilation status.
-    ##!! This function is designed to work with multithreading and exercises
-         said functionalities on a single sequence. CANNOT be applied to the
-         whole batch at the same time.
+    Compilation of the final sequence is left to the caller, so that
+    the whole batch is compiled at once.
+    Single sequence version of BatchFill.
     """
     new_holes, next_input_ids, attention_mask = self.StepTrainingSeq(input_ids, prediction_scores)
     with torch.no_grad():
@@ -110,10 +100,7 @@ class CompilationSampler(object):
         new_holes, next_input_ids, attention_mask = self.StepTrainingSeq(
           next_input_ids[0], next_prediction_scores[0],
         )
-    compile_flag = self.checkIfBatchCompiles(next_input_ids[0].numpy())
-    if compile_flag:
-      masked_lm_labels = np.full(masked_lm_labels.shape, -100, dtype = np.int64)
-    return next_input_ids[0], compile_flag, masked_lm_labels
+    return next_input_ids[0]
 
   def StepTrainingSeq(self,
                       seq               : torch.LongTensor,
@@ -123,67 +110,9 @@ class CompilationSampler(object):
     Applies step predictions to input sequence.
     Specifically optimized for training; does not compute sample indices for speed-up.
     """
-    seq_length   = tuple(seq.shape)[0]
-    allowed_incr = (seq_length - int(torch.where(seq==self.tokenizer.padToken)[0][0])
-                    if self.tokenizer.padToken in seq
-                    else 0)
-
-    endTokens   = self.tokenizer.metaTokenValues
-    closed_hole = np.zeros(seq_length, dtype=np.bool)
-    new_hole = np.zeros(seq_length, dtype=np.bool)
-    temp_seq = seq.numpy().copy()
-
-    for target_idx in torch.where((seq == self.tokenizer.holeToken) | (seq == self.tokenizer.maskToken))[0]:
-      idx        = int(target_idx)
-      prediction = int(self.argmax(prediction_scores[target_idx]))
-      is_hole = temp_seq[idx] == self.tokenizer.holeToken
-
-      if prediction in endTokens:
-        # Model predicted sth that will close the hole.
-        closed_hole[idx] = True
-        continue
-
-      # We replace the hole with a prediction
-      temp_seq[idx] = prediction
-      rem_adds = allowed_incr + np.sum(closed_hole) - np.sum(new_hole)
-      if is_hole and rem_adds:
-        # if this was a hole and we have more empty space, reinsert the hole
-        new_hole[idx] = True
-
-    new_seq = np.full(seq_length, self.tokenizer.padToken, dtype=np.int64)
-    new_idx = 0
-    for idx, t in enumerate(temp_seq):
-      if closed_hole[idx]:
-        continue
-      try:
-        new_seq[new_idx] = t
-      except IndexError:
-        l.getLogger().info("seq: {}".format(self.tokenizer.tokensToString([x for x in seq.cpu().numpy()])))
-        l.getLogger().info("temp_seq {}".format(self.tokenizer.tokensToString([x for x in temp_seq])))
-        l.getLogger().info("pred idx: {}".format(torch.where((seq == self.tokenizer.holeToken) | (seq == self.tokenizer.maskToken))[0]))
-        l.getLogger().info("pred_toks {}".format(self.tokenizer.tokensToString([int(self.argmax(prediction_scores[idx])) for idx in torch.where((seq == self.tokenizer.holeToken) | (seq == self.tokenizer.maskToken))[0]])))
-        l.getLogger().info("allowed_incr: {}".format(allowed_incr))
-        l.getLogger().info("new_hole: {}".format(new_hole))
-        l.getLogger().info("closed_hole: {}".format(closed_hole))
-      new_idx += 1
-      if new_hole[idx]:
-        try:
-          new_seq[new_idx] = self.tokenizer.holeToken
-        except IndexError:
-          l.getLogger().warn("seq: {}".format(self.tokenizer.tokensToString([x for x in seq.cpu().numpy()])))
-          l.getLogger().warn("temp_seq {}".format(self.tokenizer.tokensToString([x for x in temp_seq])))
-          l.getLogger().warn("pred idx: {}".format(torch.where((seq == self.tokenizer.holeToken) | (seq == self.tokenizer.maskToken))[0]))
-          l.getLogger().warn("pred_toks {}".format(self.tokenizer.tokensToString([int(self.argmax(prediction_scores[idx])) for idx in torch.where((seq == self.tokenizer.holeToken) | (seq == self.tokenizer.maskToken))[0]])))
-          l.getLogger().warn("allowed_incr: {}".format(allowed_incr))
-          l.getLogger().warn("new_hole: {}".format(new_hole))
-          l.getLogger().warn("closed_hole: {}".format(closed_hole))
-        new_idx += 1
-      if new_idx >= seq_length:
-        break
-
-    new_seq = torch.LongTensor([new_seq])
+    new_seq, new_holes, _, _, _ = self.BatchStep(seq.unsqueeze(0), prediction_scores.unsqueeze(0))
     attention_mask = (new_seq != self.tokenizer.padToken)
-    return np.any(new_hole), new_seq, attention_mask
+    return bool(new_holes[0]), new_seq, attention_mask
 
   def generateSampleBatch(self,
                           model             : typing.TypeVar("model.BertPreTrainedModel"),
@@ -303,44 +232,41 @@ class CompilationSampler(object):
     iteratively for predictions until target [MASK] or [HOLE] tokens
     are closed.
 
-    Compiler is invoked for final sequence to get binary compilation status.
-    ##!! This function is designed to work with multithreading and exercises
-         said functionalities on a single sequence. CANNOT be applied to the
-         whole batch at the same time.
+    Whole batch version of iterSampleSeq, built on BatchFill.
     """
     sample_indices = []
     for inpids in input_ids:
       sample_indices.append([
         [] for _ in range(len(torch.where((inpids == self.tokenizer.holeToken) | (inpids == self.tokenizer.maskToken))[0]))
       ])
-    res_idx = 0
-    results = torch.zeros_like(input_ids)
-
-    new_holes = self.BatchStepSampleSeq(input_ids, prediction_scores, device)
-    open_holes = torch.where(new_holes == True)[0]
-    closed_holes = torch.where(new_holes == False)[0]
-
-    results[res_idx: res_idx + len(closed_holes)] = input_ids[closed_holes]
-    res_idx += len(closed_holes)
-    input_ids = torch.index_select(input_ids, 0, open_holes.to(device))
-    attention_mask = (input_ids != self.tokenizer.padToken)
-
-    while torch.any(new_holes):
-
-      prediction_scores, _, _, _ = model.get_output(
-        input_ids, attention_mask, position_ids[:len(input_ids)],
-      )
-
-      new_holes = self.BatchStepSampleSeq(input_ids, prediction_scores, device)
-      open_holes = torch.where(new_holes == True)[0]
-      closed_holes = torch.where(new_holes == False)[0]
+    results = self.BatchFill(model, input_ids, prediction_scores, position_ids)
+    return results, sample_indices, None
 
-      results[res_idx: res_idx + len(closed_holes)] = input_ids[closed_holes]
-      res_idx += len(closed_holes)
-      input_ids = torch.index_select(input_ids, 0, open_holes.to(device))
-      attention_mask = (input_ids != self.tokenizer.padToken)
+  def BatchFill(self,
+                model             : typing.TypeVar("model.BertPreTrainedModel"),
+                input_ids         : torch.LongTensor,
+                prediction_scores : torch.FloatTensor,
+                position_ids      : torch.LongTensor,
+                ) -> torch.LongTensor:
+    """
+    Fills all holes of a batch of sequences.
 
-    return results, sample_indices, None
+    Every step applies the predictions of the whole batch with BatchStep and
+    only rows that still have open holes are fed back to the model. Filled rows
+    are returned in their input order, on the device of input_ids.
+    """
+    results, new_holes, _, _, _ = self.BatchStep(input_ids, prediction_scores)
+    rows = torch.where(new_holes)[0]
+    with torch.no_grad():
+      while len(rows) > 0:
+        step_input_ids = results[rows]
+        prediction_scores, _, _, _ = model.get_output(
+          step_input_ids, step_input_ids != self.tokenizer.padToken, position_ids[rows],
+        )
+        step_input_ids, new_holes, _, _, _ = self.BatchStep(step_input_ids, prediction_scores)
+        results[rows] = step_input_ids
+        rows = rows[new_holes]
+    return results
 
   def WorkloaditerSampleSeq(self,
                             model              : typing.TypeVar("model.BertPreTrainedModel"),
@@ -359,62 +285,38 @@ class CompilationSampler(object):
     iteratively for predictions until target [MASK] or [HOLE] tokens
     are closed.
 
-    Compiler is invoked for final sequence to get binary compilation status.
-    ##!! This function is designed to work with multithreading and exercises
-         said functionalities on a single sequence. CANNOT be applied to the
-         whole batch at the same time.
+    Sequences of the workload are fed batch_size at a time; a finished
+    sequence is replaced by the next pending one, so batches stay full.
     """
-    input_ids      = workload_input_ids[0]# .to(device)
-    attention_mask = workload_attention_mask[0]# .to(device)
-
     wload_size, batch_size, sequence_length = tuple(workload_input_ids.shape)
     nseq  = wload_size * batch_size
     w_idx = batch_size
 
-    queue_input_ids      = torch.reshape(workload_input_ids, (1, nseq, sequence_length)).squeeze()
-    queue_attention_mask = torch.reshape(workload_attention_mask, (1, nseq, sequence_length)).squeeze()
+    queue_input_ids = torch.reshape(workload_input_ids, (nseq, sequence_length))
+    input_ids       = workload_input_ids[0]
 
-    queue = torch.zeros(tuple(queue_input_ids.shape)).to(device)
+    # Closed sequences are appended to the queue as they finish, a whole step at a time.
+    queue = torch.zeros((nseq, sequence_length), dtype = torch.long, device = workload_input_ids.device)
     q_idx = 0
 
-    new_holes    = self.BatchStepSampleSeq(input_ids, prediction_scores, device)
-    open_holes   = torch.where(new_holes == True)[0]
-    closed_holes = torch.where(new_holes == False)[0]
+    while True:
+      input_ids, new_holes, _, _, _ = self.BatchStep(input_ids, prediction_scores)
+      closed = input_ids[~new_holes]
+      queue[q_idx: q_idx + len(closed)] = closed
+      q_idx += len(closed)
 
-    for i in closed_holes:
-      queue[q_idx] = input_ids[i]
-      q_idx += 1
-
-    input_ids      = torch.index_select(input_ids, 0, open_holes.to(device))
-    attention_mask = (input_ids != self.tokenizer.padToken)
-
-    res = batch_size - len(input_ids)
-    if res > 0:
-      input_ids      = torch.cat((input_ids, queue_input_ids[w_idx: w_idx + res]), 0)
-      attention_mask = torch.cat((attention_mask, queue_attention_mask[w_idx: w_idx + res]), 0)
-      w_idx += res
-
-    while w_idx < nseq or torch.any(new_holes):
-
-      prediction_scores, _, _, _ = model.get_output(
-        input_ids, attention_mask, position_ids[:len(input_ids)],
-      )
-      new_holes    = self.BatchStepSampleSeq(input_ids, prediction_scores, device)
-      open_holes   = torch.where(new_holes == True)[0]
-      closed_holes = torch.where(new_holes == False)[0]
-
-      for i in closed_holes:
-        queue[q_idx] = input_ids[i]
-        q_idx += 1
-
-      input_ids      = torch.index_select(input_ids, 0, open_holes.to(device))
-      attention_mask = (input_ids != self.tokenizer.padToken)
-
-      res = batch_size - len(input_ids)
+      # Refill the batch with pending sequences of the workload.
+      input_ids = input_ids[new_holes]
+      res = min(batch_size - len(input_ids), nseq - w_idx)
       if res > 0:
-        input_ids      = torch.cat((input_ids, queue_input_ids[w_idx: w_idx + res]), 0)
-        attention_mask = torch.cat((attention_mask, queue_attention_mask[w_idx: w_idx + res]), 0)
+        input_ids = torch.cat((input_ids, queue_input_ids[w_idx: w_idx + res]), 0)
         w_idx += res
+      if len(input_ids) == 0:
+        break
+      with torch.no_grad():
+        prediction_scores, _, _, _ = model.get_output(
+          input_ids, input_ids != self.tokenizer.padToken, position_ids[:len(input_ids)],
+        )
     return queue
 
   def StepSampleSeq(self,
@@ -430,53 +332,21 @@ class CompilationSampler(object):
     """
     Applies sample step predictions to input sequence.
     """
-    step_indices  = []
-    seq_length    = tuple(seq.shape)[0]
-    allowed_incr  = (seq_length - int(torch.where(seq==self.tokenizer.padToken)[0][0])
-                     if self.tokenizer.padToken in seq
-                     else 0)
-
-    endTokens = self.tokenizer.metaTokenValues
-    closed_hole = np.zeros(seq_length, dtype=np.bool)
-    new_hole = np.zeros(seq_length, dtype=np.bool)
-    temp_seq = seq.numpy().copy()
-
-    for target_idx in torch.where((seq == self.tokenizer.holeToken) | (seq == self.tokenizer.maskToken))[0]:
-      idx        = int(target_idx)
-      if scores_history is not None:
-        scores_history.append(prediction_scores[target_idx].numpy())
-      prediction = int(self.argmax(prediction_scores[target_idx]))
-      step_indices.append([prediction])
-      is_hole = temp_seq[idx] == self.tokenizer.holeToken
-
-      if prediction in endTokens:
-        # Model predicted sth that will close the hole.
-        closed_hole[idx] = True
-        continue
-
-      # We replace the hole with a prediction
-      temp_seq[idx] = prediction
-      rem_adds = allowed_incr + np.sum(closed_hole) - np.sum(new_hole)
-      if is_hole and rem_adds:
-        # if this was a hole and we have more empty space, reinsert the hole
-        new_hole[idx] = True
+    new_seq, new_holes, targets, predictions, reinserted = self.BatchStep(
+      seq.unsqueeze(0), prediction_scores.unsqueeze(0)
+    )
+    target_idxs = torch.where(targets[0])[0]
+    if scores_history is not None:
+      scores_history.extend(prediction_scores[target_idxs].cpu().numpy())
+
+    endTokens    = self.tokenizer.metaTokenValues
+    step_indices = []
+    for prediction, is_reinserted in zip(predictions[0][target_idxs].tolist(), reinserted[0][target_idxs].tolist()):
+      if prediction in endTokens or is_reinserted:
+        step_indices.append([prediction])
       else:
-        step_indices[-1].append(self.tokenizer.endholeToken)
-
-    new_seq = np.full(seq_length, self.tokenizer.padToken, dtype=np.int64)
-    new_idx = 0
-    for idx, t in enumerate(temp_seq):
-      if closed_hole[idx]:
-        continue
-      new_seq[new_idx] = t
-      new_idx += 1
-      if new_hole[idx]:
-        new_seq[new_idx] = self.tokenizer.holeToken
-        new_idx += 1
-      if new_idx >= seq_length:
-        break
+        step_indices.append([prediction, self.tokenizer.endholeToken])
 
-    new_seq = torch.LongTensor([new_seq])
     attention_mask = (new_seq != self.tokenizer.padToken)
 
     # Update sample indices
@@ -486,36 +356,157 @@ class CompilationSampler(object):
         sample_indices[target_indices] += step_indices[t_idx]
         t_idx += 1
 
-    return np.any(new_hole), new_seq, attention_mask
+    return bool(new_holes[0]), new_seq, attention_mask
 
   def BatchStepSampleSeq(self,
                          batch             : torch.LongTensor,
                          prediction_scores : torch.LongTensor,
-                         device,
-                         ) -> typing.Tuple[
-                                bool,
-                                torch.LongTensor,
-                                np.array,
-                              ]:
+                         ) -> typing.Tuple[torch.LongTensor, torch.BoolTensor]:
     """
     Applies sample step predictions to input batch of sequences.
+
+    Returns:
+      The new batch and a [batch_size] mask of the rows that still have open holes.
     """
-    endTokens = self.tokenizer.metaTokenValues
-    new_hole = torch.zeros(len(batch), dtype=np.bool)
-
-    idxs, targets = torch.where(batch == self.tokenizer.holeToken)
-    predictions = self.argmax(prediction_scores[(idxs, targets)])
-
-    for seq_idx, el_idx in zip(idxs, targets):
-      if int(predictions[seq_idx]) in endTokens:
-        # Close hole, shift left one position, add pad to the end.
-        batch[seq_idx] = torch.cat((batch[seq_idx][:el_idx], batch[seq_idx][el_idx+1:], torch.LongTensor([self.tokenizer.padToken]).to(device)), 0)
-      elif int(batch[seq_idx][-1]) != self.tokenizer.padToken:
-        # No pads remaining to the right, replace hole with prediction but don't insert new hole.
-        batch[seq_idx] = torch.cat((batch[seq_idx][:el_idx], predictions[seq_idx].unsqueeze(0), batch[seq_idx][el_idx+1:]), 0)
-      else:
-        # Replace with prediction and keep hole.
-        batch[seq_idx] = torch.cat((batch[seq_idx][:el_idx], predictions[seq_idx].unsqueeze(0), batch[seq_idx][el_idx:][:-1]), 0)
-        new_hole[seq_idx] = True
+    new_batch, new_holes, _, _, _ = self.BatchStep(batch, prediction_scores)
+    return new_batch, new_holes
+
+  def BatchStep(self,
+                batch             : torch.LongTensor,
+                prediction_scores : torch.FloatTensor,
+                ) -> typing.Tuple[
+                       torch.LongTensor,
+                       torch.BoolTensor,
+                       torch.BoolTensor,
+                       torch.LongTensor,
+                       torch.BoolTensor,
+                     ]:
+    """
+    Applies one step of predictions to a [batch_size, sequence_length] batch.
+
+    Every [HOLE] or [MASK] token is replaced by its prediction, or it is removed
+    if a meta token was predicted. A replaced [HOLE] is re-inserted right after
+    its prediction while the row has room left, i.e. the pads of the row plus
+    the holes closed to its left, minus the holes re-inserted so far. Rows are
+    then compacted with a single scatter. Everything runs as tensor operations
+    on the device of batch, with no per-hole Python work.
+
+    Returns:
+      The new batch, a [batch_size] mask of rows with re-inserted holes, the
+      [batch_size, sequence_length] mask of targets, predictions, valid at
+      targets, and the mask of targets whose hole was re-inserted.
+    """
+    batch_size, seq_length = tuple(batch.shape)
+    device = batch.device
+
+    is_hole     = batch == self.tokenizer.holeToken
+    targets     = is_hole | (batch == self.tokenizer.maskToken)
+    rows, cols  = torch.where(targets)
+    predictions = torch.full_like(batch, self.tokenizer.padToken)
+    if len(rows) > 0:
+      predictions[rows, cols] = self.argmax(prediction_scores[rows, cols]).to(device)
+
+    # Model predicted sth that will close the hole.
+    endTokens = torch.LongTensor(list(self.tokenizer.metaTokenValues)).to(device)
+    closed    = targets & (predictions.unsqueeze(-1) == endTokens).any(dim = -1)
+
+    # The room left before each position is a walk that decreases with every
+    # candidate hole and increases with every closed one, reflected at zero as
+    # candidates are refused when there is no room left.
+    candidate = is_hole & ~closed
+    is_pad    = batch == self.tokenizer.padToken
+    allowed   = torch.where(
+      is_pad.any(dim = 1),
+      seq_length - torch.argmax(is_pad.long(), dim = 1),
+      torch.zeros(batch_size, dtype = torch.long, device = device),
+    )
+    step       = closed.long() - candidate.long()
+    walk       = allowed.unsqueeze(1) + torch.cumsum(step, dim = 1) - step
+    room       = walk - torch.clamp(torch.cummin(walk, dim = 1).values, max = 0)
+    reinserted = candidate & (room > 0)
+
+    # Every position emits its token unless it was closed, followed by a hole if re-inserted.
+    tokens    = torch.where(targets, predictions, batch)
+    emitted   = (~closed).long() + reinserted.long()
+    dest      = torch.cumsum(emitted, dim = 1) - emitted
+    new_batch = torch.full_like(batch, self.tokenizer.padToken)
+    kept      = ~closed & (dest < seq_length)
+    rows, cols = torch.where(kept)
+    new_batch[rows, dest[rows, cols]] = tokens[rows, cols]
+    holes     = reinserted & (dest + 1 < seq_length)
+    rows, cols = torch.where(holes)
+    new_batch[rows, dest[rows, cols] + 1] = self.tokenizer.holeToken
+    return new_batch, reinserted.any(dim = 1), targets, predictions, reinserted
+
+class CompileRewardQueue(object):
+  """
+  Compiles filled training batches in the background.
 
-    return new_hole
+  Used during training with a compilation reward lag. Batches are filled
+  with the current weights and queued, and are trained on `lag` steps
+  later, so that clang compiles them while the batches in between are
+  trained on. Feature vectors of the samples that compile are extracted
+  along with them, for the correct samples database.
+  """
+  def __init__(self,
+               tokenizer        : tokenizers.TokenizerBase,
+               lag              : int,
+               extract_features : bool,
+               ):
+    self.tokenizer        = tokenizer
+    self.lag              = lag
+    self.extract_features = extract_features
+    self.pending          = collections.deque()
+    # One thread is enough, CompileMany spreads every batch over the clang worker pool.
+    self.executor         = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+    return
+
+  def __len__(self) -> int:
+    return len(self.pending)
+
+  @property
+  def is_full(self) -> bool:
+    """True once a batch is queued for every step of the lag, besides the one to train on."""
+    return len(self.pending) > self.lag
+
+  def compileBatch(self,
+                   samples: typing.List[np.array],
+                   ) -> typing.Tuple[typing.List[int], typing.List[typing.Dict[str, typing.Dict[str, float]]]]:
+    """Compilation status and, for samples that compile, feature vectors of a filled batch."""
+    srcs         = [self.tokenizer.ArrayToCode(s) for s in samples]
+    compile_flag = [int(x) for x in opencl.CompileMany(srcs)]
+    features     = [None] * len(srcs)
+    if self.extract_features:
+      compiled = [idx for idx, flag in enumerate(compile_flag) if flag]
+      for idx, raw in zip(compiled, extractor.ExtractRawFeaturesMany([srcs[idx] for idx in compiled])):
+        features[idx] = extractor.RawToDictFeats(raw)
+    return compile_flag, features
+
+  def Submit(self,
+             inputs  : typing.Dict[str, torch.Tensor],
+             samples : typing.List[np.array],
+             ) -> None:
+    """Queue a batch and its filled sequences for compilation."""
+    self.pending.append((inputs, samples, self.executor.submit(self.compileBatch, samples)))
+    return
+
+  def Pop(self) -> typing.Tuple[typing.Dict[str, torch.Tensor], typing.List[np.array], typing.List[int], typing.List[typing.Dict[str, typing.Dict[str, float]]], float]:
+    """
+    Oldest queued batch, once compiled.
+
+    Returns:
+      The batch, its filled sequences, their compilation status, their
+      feature vectors and the milliseconds spent waiting on clang.
+    """
+    inputs, samples, future = self.pending.popleft()
+    t = time.time()
+    compile_flag, features = future.result()
+    return inputs, samples, compile_flag, features, 1000 * (time.time() - t)
+
+  def Close(self) -> None:
+    """Drop the queued batches."""
+    for _, _, future in self.pending:
+      future.cancel()
+    self.pending.clear()
+    self.executor.shutdown(wait = False)
+    return
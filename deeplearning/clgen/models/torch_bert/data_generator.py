@@ -5,6 +5,7 @@ a reasonable size, the full training data may not fit in memory. This modules
 provides Python Generator classes for use by a sequential Keras model's
 fit_generator() method to stream batches of training data.
 """
+import collections
 import os
 import typing
 import datetime
@@ -20,16 +21,19 @@ import progressbar
 
 from deeplearning.clgen.util import pytorch
 from deeplearning.clgen.util.pytorch import torch
+from deeplearning.clgen.util import compile_cache
 from deeplearning.clgen.util import distributions
 from deeplearning.clgen.util import monitors
 from deeplearning.clgen.proto import model_pb2
 from deeplearning.clgen.features import extractor
 from deeplearning.clgen.features import feature_sampler
 from deeplearning.clgen.features import active_feed_database
+from deeplearning.clgen.models import corpus_shards
 from deeplearning.clgen.models import lm_data_generator
 from deeplearning.clgen.models import sequence_masking
 from deeplearning.clgen.models.torch_bert import datasets
 from deeplearning.clgen.samplers import sample_observers
+from deeplearning.clgen.preprocessors import clang
 from deeplearning.clgen.preprocessors import opencl
 from absl import flags
 from eupy.native import logger as l
@@ -48,6 +52,34 @@ flags.DEFINE_integer(
   "Select size of workload per inference step."
 )
 
+flags.DEFINE_integer(
+  "active_pipeline_depth",
+  1,
+  "Number of sampled workloads whose candidates are compiled and scored while the model "
+  "samples the next one during active sampling. 0 alternates between sampling and compiling."
+)
+
+flags.DEFINE_integer(
+  "dataloader_num_workers",
+  0,
+  "Number of worker processes that load and mask training and sampling batches ahead of the "
+  "model. 0 loads them on the main process, between steps."
+)
+
+flags.DEFINE_integer(
+  "dataloader_prefetch_factor",
+  2,
+  "Number of batches every dataloader worker process loads in advance."
+)
+
+flags.DEFINE_boolean(
+  "dataloader_persistent_workers",
+  True,
+  "Set to keep dataloader worker processes alive between epochs."
+)
+
+_COLLATE_POOL = None
+
 class ActiveSampleFeed(typing.NamedTuple):
   """
   Representation of an active learning input to the model.
@@ -141,6 +173,83 @@ def dataload_worker(x              : int,
   except Exception:
     return None
 
+def GetCollatePool() -> typing.Optional[multiprocessing.Pool]:
+  """Get the long-lived pool that masks the input feeds of active sampling.
+
+  It is kept apart from the clang worker pool, so that masking the inputs of a
+  workload does not queue behind the candidates of the previous one.
+
+  Returns:
+    The worker pool, or None if called from a daemonic worker process.
+  """
+  global _COLLATE_POOL
+  if multiprocessing.current_process().daemon:
+    return None
+  if _COLLATE_POOL is None:
+    _COLLATE_POOL = multiprocessing.Pool()
+  return _COLLATE_POOL
+
+def TerminateCollatePool() -> None:
+  """Kill the collate pool. A new one is created by the next workload."""
+  global _COLLATE_POOL
+  if _COLLATE_POOL is not None:
+    _COLLATE_POOL.terminate()
+    _COLLATE_POOL.join()
+    _COLLATE_POOL = None
+  return
+
+def SubmitCandidates(worker : typing.Callable[[np.array], typing.Optional[ActiveSample]],
+                     samples: typing.List[np.array],
+                     ) -> typing.Union["multiprocessing.pool.AsyncResult", typing.List[typing.Optional[ActiveSample]]]:
+  """Hand the samples of a workload to the clang workers without waiting for them.
+
+  Returns:
+    A handle for CollectCandidates(). Without a worker pool, the samples are
+    processed before returning.
+  """
+  pool = clang.GetWorkerPool()
+  if pool is None:
+    return [worker(x) for x in samples]
+  return pool.map_async(worker, samples)
+
+def CollectCandidates(pending: typing.Union["multiprocessing.pool.AsyncResult", typing.List[typing.Optional[ActiveSample]]]
+                      ) -> typing.List[typing.Optional[ActiveSample]]:
+  """Wait for the candidates of a workload given to SubmitCandidates()."""
+  if isinstance(pending, list):
+    return pending
+  return pending.get()
+
+def WorkerKwargs() -> typing.Dict[str, typing.Any]:
+  """DataLoader arguments that set up the worker processes given by flags."""
+  if FLAGS.dataloader_num_workers <= 0:
+    return {'num_workers': 0}
+  return {
+    'num_workers'        : FLAGS.dataloader_num_workers,
+    'prefetch_factor'    : FLAGS.dataloader_prefetch_factor,
+    'persistent_workers' : FLAGS.dataloader_persistent_workers,
+    'worker_init_fn'     : datasets.WorkerInit,
+  }
+
+def BatchKwargs(dataset   : torch.utils.data.Dataset,
+                sampler   : torch.utils.data.Sampler,
+                batch_size: int,
+                ) -> typing.Dict[str, typing.Any]:
+  """DataLoader arguments that batch the indices of sampler.
+
+  Online datasets that insert holes to a whole batch at once are indexed with
+  the list of indices of a batch, through a BatchSampler, and return the
+  collated batch. Distributed samplers are left as they are, their epoch is
+  set through the DataLoader's sampler.
+  """
+  if (isinstance(dataset, (datasets.OnlineDataset, datasets.LazyOnlineDataset))
+      and dataset.batch_func is not None
+      and not isinstance(sampler, torch.utils.data.distributed.DistributedSampler)):
+    return {
+      'batch_size' : None,
+      'sampler'    : torch.utils.data.BatchSampler(sampler, batch_size, drop_last = False),
+    }
+  return {'batch_size': batch_size, 'sampler': sampler}
+
 def write_samples_cache(db_sample_obs: sample_observers.SamplesDatabaseObserver,
                         tokenizer,
                         samples: typing.List[typing.List[int]]
@@ -164,6 +273,8 @@ def write_samples_cache(db_sample_obs: sample_observers.SamplesDatabaseObserver,
       date_added           = datetime.datetime.utcnow().strftime("%m/%d/%Y, %H:%M:%S"),
     )
     db_sample_obs.OnSample(s)
+  # Runs in a child process, which exits without running atexit handlers.
+  db_sample_obs.Flush()
   return
 
 class torchLMDataGenerator(lm_data_generator.MaskLMDataGenerator):
@@ -312,22 +423,31 @@ class torchLMDataGenerator(lm_data_generator.MaskLMDataGenerator):
     else:
       raise ValueError(self.config.datapoint_time)
 
+    if pytorch.num_nodes > 1 and pytorch.torch_tpu_available and pytorch.torch_xla.xrt_world_size() > 1:
+      sampler = torch.utils.data.distributed.DistributedSampler(
+        dataset      = dataset,
+        num_replicas = pytorch.num_nodes if not pytorch.torch_tpu_available else pytorch.torch_xla.xrt_world_size(),
+        rank         = pytorch.torch.distributed.get_rank() if not pytorch.torch_tpu_available else pytorch.torch_xla.get_ordinal()
+      )
     dataloader = torch.utils.data.dataloader.DataLoader(
       dataset    = dataset,
-      batch_size = self.training_opts.batch_size,
-      sampler    = (sampler
-        if pytorch.num_nodes <= 1 or not pytorch.torch_tpu_available or pytorch.torch_xla.xrt_world_size() <= 1
-        else torch.utils.data.distributed.DistributedSampler(
-          dataset      = dataset,
-          num_replicas = pytorch.num_nodes if not pytorch.torch_tpu_available else pytorch.torch_xla.xrt_world_size(),
-          rank         = pytorch.torch.distributed.get_rank() if not pytorch.torch_tpu_available else pytorch.torch_xla.get_ordinal()
-        )
-      ),
-      num_workers = 0,
-      drop_last   = False,
+      drop_last  = False,
+      **BatchKwargs(dataset, sampler, self.training_opts.batch_size),
+      **WorkerKwargs(),
     )
     return dataloader
 
+  def MonitorBatch(self, batch: typing.Dict[str, torch.Tensor]) -> None:
+    """Register a training batch loaded by a worker process to the dataset monitors.
+
+    Worker processes don't keep the monitors of their dataset copy, so the
+    main process registers their batches instead.
+    """
+    dataset = self.dataloader.dataset
+    if self.dataloader.num_workers > 0 and isinstance(dataset, (datasets.OnlineDataset, datasets.LazyOnlineDataset)):
+      dataset.monitorBatch(batch)
+    return
+
   def eval_dataloaders(self) -> torch.utils.data.dataloader:
     """Pytorch dataloader used for validation."""
     if self.config.datapoint_time == "online":
@@ -391,8 +511,8 @@ class torchLMDataGenerator(lm_data_generator.MaskLMDataGenerator):
           rank         = pytorch.torch.distributed.get_rank() if not pytorch.torch_tpu_available else pytorch.torch_xla.get_ordinal()
           )
       ),
-      num_workers = 0,
       drop_last   = False,
+      **WorkerKwargs(),
       )
     return dataloader
 
@@ -459,30 +579,51 @@ class torchLMDataGenerator(lm_data_generator.MaskLMDataGenerator):
           self.exec_time[feed.gen_id] = 0.0
 
         # Iterate until you get a better sample or surpass the limit.
+        # Candidates of up to FLAGS.active_pipeline_depth workloads are compiled
+        # and scored on the clang workers while the model samples the next one.
         better_found, write_cache_proc, it = None, None, 0
+        pending, in_flight, step_candidates = collections.deque(), 0, []
+        # Candidates of the workload that produced better_found, or else of
+        # the last one. Workloads still in flight are drained after it.
+        feed_candidates = []
         l.getLogger().info("Current input feed score: {}".format(str(round(feed.input_score, 2))))
-        while not better_found and cmp_rate[1] < 160000:
-          # Pre-process inputs
-          wsize = FLAGS.sample_workload_size // self.sample_batch_size
-          inputs = self.collateInputData(feed.input_feed, wsize, sample_batch_per_feed)
-          # Workload inference.
-          outputs, time = mwrapper.sample_model_step(
-            estimator.model,
-            inputs,
-            iteration = it,
-          )
-          # Post-process outputs.
+        while True:
+          if not better_found and cmp_rate[1] + in_flight < 160000:
+            # Pre-process inputs
+            wsize = FLAGS.sample_workload_size // self.sample_batch_size
+            inputs = self.collateInputData(feed.input_feed, wsize, sample_batch_per_feed)
+            # Workload inference.
+            outputs, time = mwrapper.sample_model_step(
+              estimator.model,
+              inputs,
+              iteration = it,
+            )
+            exec_time += time
+            pending.append((self.submitOutputData(outputs, feed), len(outputs['generated_samples'])))
+            in_flight += pending[-1][1]
+            it += 1
+            if len(pending) <= FLAGS.active_pipeline_depth:
+              continue
+          if not pending:
+            break
+          # Post-process outputs of the oldest workload.
+          step, step_size = pending.popleft()
+          in_flight -= step_size
           step_candidates = []
-          bar = progressbar.ProgressBar(max_value = wsize * self.sample_batch_size)
+          bar = progressbar.ProgressBar(max_value = step_size)
           bar.update(0)
-          (tcs, ts), better_found = self.registerOutputData(outputs, feed, step_candidates, bar)
-          if better_found:
-            self.tsne_monitor.register((better_found.features, "gen_{}_accepted".format(str(feed.gen_id)), str(better_found.score)))
+          (tcs, ts), step_better = self.registerOutputData(step, feed, step_candidates, bar)
+          if step_better:
+            self.tsne_monitor.register((step_better.features, "gen_{}_accepted".format(str(feed.gen_id)), str(step_better.score)))
+            if better_found is None or step_better.score < better_found.score:
+              better_found    = step_better
+              feed_candidates = step_candidates
+          if better_found is None:
+            feed_candidates = step_candidates
           for c in step_candidates:
             self.tsne_monitor.register((c.features, "gen_{}".format(str(feed.gen_id))))
           cmp_rate[0] += tcs
           cmp_rate[1] += ts
-          exec_time   += time
 
           if write_cache_proc:
             write_cache_proc.join()
@@ -497,8 +638,8 @@ class torchLMDataGenerator(lm_data_generator.MaskLMDataGenerator):
           )
           write_cache_proc.start()
 
-          if better_found and feed.gen_id > 0:
-            l.getLogger().info("Improved score {} -> {} in {} iterations".format(round(feed.input_score, 3), round(better_found.score, 3), it))
+          if step_better and feed.gen_id > 0:
+            l.getLogger().info("Improved score {} -> {} in {} iterations".format(round(feed.input_score, 3), round(step_better.score, 3), it))
           # Calculate how many more to infer.
           try:
             rcands = active_limit_per_feed - len(step_candidates)
@@ -506,7 +647,6 @@ class torchLMDataGenerator(lm_data_generator.MaskLMDataGenerator):
             wsize = max(2, int((rcands // self.sample_batch_size) / crate))
           except ZeroDivisionError:
             pass
-          it += 1
 
         if write_cache_proc:
           write_cache_proc.join()
@@ -518,10 +658,11 @@ class torchLMDataGenerator(lm_data_generator.MaskLMDataGenerator):
         self.comp_rate_mon.plot()
         self.exec_time_mon.plot()
         self.tsne_monitor.plot()
+        compile_cache.ReportHitRate()
 
         # Top-k candidates of ith generation.
         if feed.gen_id == 0:
-          best_cands = self.feat_sampler.sample_from_set(step_candidates, active_search_width)
+          best_cands = self.feat_sampler.sample_from_set(feed_candidates, active_search_width)
           l.getLogger().info("Starting scores: {}".format(', '.join([str(round(c.score, 3)) for c in best_cands])))
         else:
           if not better_found:
@@ -574,6 +715,8 @@ class torchLMDataGenerator(lm_data_generator.MaskLMDataGenerator):
               [[]] * len(total_cand))
     except KeyboardInterrupt:
       self.raised_keyboard_int = True
+      # Drop the workloads still being compiled.
+      clang.TerminateWorkerPool()
       return (np.repeat([org_inp], len(total_cand), axis = 0),
               np.repeat([org_ids], len(total_cand), axis = 0),
               [x.sample for x in total_cand],
@@ -650,15 +793,19 @@ class torchLMDataGenerator(lm_data_generator.MaskLMDataGenerator):
         'input_ids': [], 'input_mask': [], 'position_ids': [],
         'mask_labels': [], 'masked_lm_lengths': [], 'next_sentence_labels': []
       }
+      worker = functools.partial(
+        dataload_worker, feed  = feed,
+        func  = self.func, batch = self.sample_batch_size,
+        batch_per_feed = sample_batch_per_feed
+      )
+      # Feeds are masked on long-lived workers.
+      pool = GetCollatePool()
       try:
-        pool = multiprocessing.Pool()
-        for batch in pool.imap_unordered(
-                          functools.partial(
-                            dataload_worker, feed  = feed,
-                            func  = self.func, batch = self.sample_batch_size,
-                            batch_per_feed = sample_batch_per_feed
-                          ),range(wload_size)
-                         ):
+        if pool is None:
+          batches = map(worker, range(wload_size))
+        else:
+          batches = pool.imap_unordered(worker, range(wload_size))
+        for batch in batches:
           if batch:
             out = {
               k: torch.from_numpy(v).unsqueeze(0)
@@ -672,26 +819,53 @@ class torchLMDataGenerator(lm_data_generator.MaskLMDataGenerator):
               inputs[k].append(out[k])
         for k, v in inputs.items():
           inputs[k] = torch.stack(v)
-        pool.close()
       except KeyboardInterrupt as e:
-        pool.close()
-        pool.terminate()
+        TerminateCollatePool()
         raise e
     return inputs
 
+  def submitOutputData(self,
+                       outputs : typing.Dict[str, typing.List[np.array]],
+                       feed    : ActiveSampleFeed,
+                       ) -> typing.Union["multiprocessing.pool.AsyncResult", typing.List[typing.Optional[ActiveSample]]]:
+    """
+    Gets workload output from model.
+    Every sample is sent to the long-lived clang workers, to be checked for
+    compilability and have its features extracted, without waiting for them.
+
+    Args:
+      outputs: Dictionary output of workload
+      feed: The input feed of the workload.
+
+    Returns:
+      A handle of the pending candidates, for registerOutputData.
+    """
+    # it = zip(
+    #   outputs['generated_samples'], outputs['sample_indices'],
+    #   outputs['input_ids'], outputs['masked_lm_lengths']
+    # )
+    if self.feat_sampler.feature_space != "GreweFeatures":
+      candidate_worker = functools.partial(
+        IR_candidate_worker, feed = feed, tokenizer = self.tokenizer, feat_sampler = self.feat_sampler,
+      )
+    else:
+      candidate_worker = functools.partial(
+        text_candidate_worker, feed = feed, tokenizer = self.tokenizer, feat_sampler = self.feat_sampler,
+      )
+    return SubmitCandidates(candidate_worker, outputs['generated_samples'])
+
   def registerOutputData(self,
-                         outputs    : typing.Dict[str, typing.List[np.array]],
+                         pending    : typing.Union["multiprocessing.pool.AsyncResult", typing.List[typing.Optional[ActiveSample]]],
                          feed       : ActiveSampleFeed,
                          candidates : typing.List[ActiveSample],
                          bar: progressbar.ProgressBar,
                          ) -> typing.List[int]:
     """
-    Gets workload output from model.
-    In parallel, every sample is checked for compilability and features are extracted.
+    Waits for the samples of a workload given to submitOutputData.
     If sample compiles, it is stored as an active learning candidate.
 
     Args:
-      outputs: Dictionary output of workload
+      pending: Handle returned by submitOutputData.
       candidates: Passed by reference and filled within this function
       bar: progressbar for status checking
 
@@ -701,23 +875,11 @@ class torchLMDataGenerator(lm_data_generator.MaskLMDataGenerator):
                1st el: Total samples.
     """
     cm_rate = [0, 0]
-    pool = multiprocessing.Pool()
-    cm_rate[1] += len(outputs['generated_samples'])
     better_found = None
     try:
-      # it = zip(
-      #   outputs['generated_samples'], outputs['sample_indices'],
-      #   outputs['input_ids'], outputs['masked_lm_lengths']
-      # )
-      if self.feat_sampler.feature_space != "GreweFeatures":
-        candidate_worker = functools.partial(
-          IR_candidate_worker, feed = feed, tokenizer = self.tokenizer, feat_sampler = self.feat_sampler,
-        )
-      else:
-        candidate_worker = functools.partial(
-          text_candidate_worker, feed = feed, tokenizer = self.tokenizer, feat_sampler = self.feat_sampler,
-        )
-      for idx, batch in enumerate(pool.map(candidate_worker, outputs['generated_samples'])):
+      results = CollectCandidates(pending)
+      cm_rate[1] += len(results)
+      for idx, batch in enumerate(results):
         if batch is not None:
           cm_rate[0] += 1
           candidates.append(batch)
@@ -725,10 +887,8 @@ class torchLMDataGenerator(lm_data_generator.MaskLMDataGenerator):
             if better_found is None or batch.score < better_found.score:
               better_found = batch
       bar.update(bar.max_value)
-      pool.close()
     except KeyboardInterrupt as e:
-      pool.close()
-      pool.terminate()
+      clang.TerminateWorkerPool()
       raise e
     return cm_rate, better_found
 
@@ -774,12 +934,9 @@ class torchLMDataGenerator(lm_data_generator.MaskLMDataGenerator):
     return
 
   def _saveCorpusRecord(self, masked_corpus: typing.Dict) -> None:
-    """Converts corpus nparrays to torch tensors and stores corpus to pt_record"""
+    """Stores corpus nparrays to a pt_record shard, see datasets.LazyConcatDataset"""
 
-    torch.save(
-      [{k: torch.from_numpy(v) for (k, v) in inst.items()} for inst in masked_corpus['corpus']],
-      masked_corpus['file']
-    )
+    corpus_shards.WriteRecordShard(masked_corpus['file'], masked_corpus['corpus'])
     if FLAGS.write_text_dataset:
       with open(masked_corpus['txt'], 'w') as file_writer:
         for instance in masked_corpus['corpus']:
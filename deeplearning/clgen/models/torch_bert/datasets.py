@@ -7,15 +7,17 @@ fit_generator() method to stream batches of training data.
 """
 import typing
 import pickle
+import collections
 import functools
+import random
 import numpy as np
 import pathlib
-import glob
 
 from deeplearning.clgen.util import pytorch
 from deeplearning.clgen.util.pytorch import torch
 from deeplearning.clgen.util import distributions
 from deeplearning.clgen.util import monitors
+from deeplearning.clgen.models import corpus_shards
 from deeplearning.clgen.models import sequence_masking
 from deeplearning.clgen.models import lm_data_generator
 from absl import flags
@@ -23,6 +25,23 @@ from eupy.native import logger as l
 
 FLAGS = flags.FLAGS
 
+# Most record shards that a LazyConcatDataset keeps mapped at a time.
+MAX_OPEN_SHARDS = 64
+
+def WorkerInit(worker_id: int) -> None:
+  """worker_init_fn of DataLoaders with worker processes.
+
+  Seeds numpy and random with the seed torch picks for every worker, so that
+  workers forked from the same process do not draw the same random numbers,
+  and makes the worker open its own shard handles.
+  """
+  info = torch.utils.data.get_worker_info()
+  np.random.seed(info.seed % 2**32)
+  random.seed(info.seed)
+  if isinstance(info.dataset, (OnlineDataset, LazyOnlineDataset, LazyConcatDataset)):
+    info.dataset.workerInit()
+  return
+
 class OnlineDataset(torch.utils.data.Dataset):
   r"""Online pre-processing dataset of raw corpus.
 
@@ -35,16 +54,16 @@ class OnlineDataset(torch.utils.data.Dataset):
   """
   def __init__(self, dg: lm_data_generator.MaskLMDataGenerator, is_train: bool):
     super(OnlineDataset, self).__init__()
-    full_dataset         = self.load_data(dg.cache.path / "{}corpus.pkl".format("pre_" if dg.pre_train else ""))
+    self.dataset         = self.load_data(dg.cache.path, "{}corpus".format("pre_" if dg.pre_train else ""))
     """
     TODO you've better change is_train check to something more generic.
     """
+    split_idx            = int(len(self.dataset) * (1 - (dg.config.validation_split / 100)))
     if is_train:
-      self.dataset       = full_dataset[:int(len(full_dataset) * (1 - (dg.config.validation_split / 100)))]
+      self.offset, self.size = 0, split_idx
     else:
-      self.dataset       = full_dataset[int(len(full_dataset) * (1 - (dg.config.validation_split / 100))):]
+      self.offset, self.size = split_idx, len(self.dataset) - split_idx
     self.cache_path      = dg.cache.path
-    self.size            = len(self.dataset)
     self.cur_step        = 0
     self.steps_per_epoch = dg.steps_per_epoch * dg.training_opts.batch_size
 
@@ -60,6 +79,7 @@ class OnlineDataset(torch.utils.data.Dataset):
     TODO, add custom config just like in lm_data_generator
     for val sets / sample sets etc.
     """
+    self.batch_func = None
     if dg.config.HasField("mask"):
       self.func = functools.partial(sequence_masking.MaskSequence,
                                     train_set         = is_train,
@@ -80,6 +100,13 @@ class OnlineDataset(torch.utils.data.Dataset):
                                     distribution    = distribution,
                                     tokenizer       = dg.tokenizer,
         )
+      self.batch_func = functools.partial(sequence_masking.HoleSequenceBatch,
+                                    train_set       = is_train,
+                                    max_predictions = dg.training_opts.max_predictions_per_seq,
+                                    masked_lm_prob  = dg.training_opts.masked_lm_prob,
+                                    distribution    = distribution,
+                                    tokenizer       = dg.tokenizer,
+        )
     return
 
   def __len__(self):
@@ -87,29 +114,62 @@ class OnlineDataset(torch.utils.data.Dataset):
 
   def __getitem__(self, idx):
 
+    if isinstance(idx, list):
+      return self.getBatch(idx)
     self.cur_step += 1
     if idx < 0:
       if -idx > len(self):
         raise ValueError("absolute value of index should not exceed dataset length")
       idx = len(self) + idx
-    k = self.func(self.dataset[idx])
+    k = self.func(self.dataset[self.offset + idx])
+    self._monitorHoles(k)
+
+    # raise NotImplementedError("Fix a) init state of rngen)
+    return k
 
-    if self.hlen_monitor:
+  def getBatch(self, idxs: typing.List[int]) -> typing.Dict[str, torch.Tensor]:
+    """
+    Collated batch of a list of indices, for DataLoaders over a BatchSampler.
+    Holes are inserted to all sequences of the batch at once.
+    """
+    if self.batch_func is None:
+      return torch.utils.data.dataloader.default_collate([self[idx] for idx in idxs])
+    if any(-idx > len(self) for idx in idxs):
+      raise ValueError("absolute value of index should not exceed dataset length")
+    idxs = [len(self) + idx if idx < 0 else idx for idx in idxs]
+    kernels, _ = self.batch_func(np.stack([self.dataset[self.offset + idx] for idx in idxs]))
+    for k in kernels:
+      self.cur_step += 1
+      self._monitorHoles(k)
+    return torch.utils.data.dataloader.default_collate(kernels)
+
+  def workerInit(self) -> None:
+    """Drop the shard handles inherited by a DataLoader worker process."""
+    self.dataset.Close()
+    return
+
+  def monitorBatch(self, batch: typing.Dict[str, torch.Tensor]) -> None:
+    """Register the holes of a batch that a DataLoader worker process loaded."""
+    for lengths in batch['masked_lm_lengths'].tolist():
+      self.cur_step += 1
+      self._monitorHoles({'masked_lm_lengths': lengths})
+    return
+
+  def _monitorHoles(self, k: typing.Dict[str, np.array]) -> None:
+    # Monitors are only kept by the main process, see monitorBatch().
+    if self.hlen_monitor and torch.utils.data.get_worker_info() is None:
       self.hlen_monitor.register([x for x in k['masked_lm_lengths'] if x >= 0])
       if self.cur_step % self.steps_per_epoch == 0:
         self.hlen_monitor.plot()
         with open(self.cache_path / "hole_length_mon.pkl", 'wb') as outf:
           pickle.dump(self.hlen_monitor, outf)
+    return
 
-    # raise NotImplementedError("Fix a) init state of rngen)
-    return k
-
-  def load_data(self, dataset: pathlib.Path) -> typing.List[np.array]:
-    if dataset.exists():
-      with open(dataset, 'rb') as infile:
-        return pickle.load(infile)
+  def load_data(self, path: pathlib.Path, name: str) -> corpus_shards.ShardedCorpus:
+    if corpus_shards.ShardedCorpus.Exists(path, name):
+      return corpus_shards.ShardedCorpus(path, name)
     else:
-      raise FileNotFoundError(dataset)
+      raise FileNotFoundError(path / "{}.json".format(name))
 
 class LazyOnlineDataset(torch.utils.data.Dataset):
   r"""Dataset as a concatenation of multiple datasets.
@@ -122,17 +182,6 @@ class LazyOnlineDataset(torch.utils.data.Dataset):
     datasets (sequence): List of paths for datasets to be concatenated
   """
 
-  @staticmethod
-  def cumsum(sequence: typing.List[pathlib.Path]):
-    r, s = [], 0
-    for e in sequence:
-      with open(e, 'rb') as infile:
-        lt = len(pickle.load(infile))
-      assert lt > 0, "Dataset {} is empty".format(e)
-      r.append(lt + s)
-      s += lt
-    return r
-
   @property
   def num_datasets(self):
     return len(self.datasets)
@@ -140,11 +189,13 @@ class LazyOnlineDataset(torch.utils.data.Dataset):
   def __init__(self, dg: lm_data_generator.MaskLMDataGenerator, is_train: bool):
     super(LazyOnlineDataset, self).__init__()
 
-    self.datasets = glob.glob(str(dg.cache.path / "{}corpus_*.pkl".format("pre_" if dg.pre_train else "")))
-    self.cumulative_sizes = self.cumsum(self.datasets)
+    # Shard sizes come from the corpus index, shards are memory-mapped on access.
+    self.dataset          = corpus_shards.ShardedCorpus(dg.cache.path, "{}corpus".format("pre_" if dg.pre_train else ""))
+    self.datasets         = self.dataset.shard_paths
+    self.cumulative_sizes = self.dataset.cumulative_sizes
+    for path, size in zip(self.datasets, self.dataset.shard_sizes):
+      assert size > 0, "Dataset {} is empty".format(path)
 
-    self.curr_dset_idx = None
-    self.dataset       = None
     self.is_train      = is_train
     """
     TODO you've better change is_train check to something more generic.
@@ -167,6 +218,7 @@ class LazyOnlineDataset(torch.utils.data.Dataset):
     for val sets / sample sets etc.
     """
     self.tokenizer = dg.tokenizer
+    self.batch_func = None
     if dg.config.HasField("mask"):
       self.func = functools.partial(sequence_masking.MaskSequence,
                                     train_set         = is_train,
@@ -187,6 +239,13 @@ class LazyOnlineDataset(torch.utils.data.Dataset):
                                     distribution    = distribution,
                                     tokenizer       = dg.tokenizer,
         )
+      self.batch_func = functools.partial(sequence_masking.HoleSequenceBatch,
+                                    train_set       = is_train,
+                                    max_predictions = dg.training_opts.max_predictions_per_seq,
+                                    masked_lm_prob  = dg.training_opts.masked_lm_prob,
+                                    distribution    = distribution,
+                                    tokenizer       = dg.tokenizer,
+        )
     return
 
   def __len__(self):
@@ -194,32 +253,54 @@ class LazyOnlineDataset(torch.utils.data.Dataset):
 
   def __getitem__(self, idx):
 
+    if isinstance(idx, list):
+      return self.getBatch(idx)
     self.cur_step += 1
     if idx < 0:
       if -idx > len(self):
         raise ValueError("absolute value of index should not exceed dataset length")
       idx = len(self) + idx
-    import bisect
-    dataset_idx = bisect.bisect_right(self.cumulative_sizes, idx)
-    
-    if self.curr_dset_idx != dataset_idx:
-      self.curr_dset_idx = dataset_idx
-      with open(self.datasets[dataset_idx], 'rb') as infile:
-        self.dataset = pickle.load(infile)
+    k = self.func(self.dataset[idx])
+    self._monitorHoles(k)
+    return k
 
-    if dataset_idx == 0:
-      sample_idx = idx
-    else:
-      sample_idx = idx - self.cumulative_sizes[dataset_idx - 1]
-    k = self.func(self.dataset[sample_idx])
+  def getBatch(self, idxs: typing.List[int]) -> typing.Dict[str, torch.Tensor]:
+    """
+    Collated batch of a list of indices, for DataLoaders over a BatchSampler.
+    Holes are inserted to all sequences of the batch at once.
+    """
+    if self.batch_func is None:
+      return torch.utils.data.dataloader.default_collate([self[idx] for idx in idxs])
+    if any(-idx > len(self) for idx in idxs):
+      raise ValueError("absolute value of index should not exceed dataset length")
+    idxs = [len(self) + idx if idx < 0 else idx for idx in idxs]
+    kernels, _ = self.batch_func(np.stack([self.dataset[idx] for idx in idxs]))
+    for k in kernels:
+      self.cur_step += 1
+      self._monitorHoles(k)
+    return torch.utils.data.dataloader.default_collate(kernels)
+
+  def workerInit(self) -> None:
+    """Drop the shard handles inherited by a DataLoader worker process."""
+    self.dataset.Close()
+    return
 
-    if self.hlen_monitor:
+  def monitorBatch(self, batch: typing.Dict[str, torch.Tensor]) -> None:
+    """Register the holes of a batch that a DataLoader worker process loaded."""
+    for lengths in batch['masked_lm_lengths'].tolist():
+      self.cur_step += 1
+      self._monitorHoles({'masked_lm_lengths': lengths})
+    return
+
+  def _monitorHoles(self, k: typing.Dict[str, np.array]) -> None:
+    # Monitors are only kept by the main process, see monitorBatch().
+    if self.hlen_monitor and torch.utils.data.get_worker_info() is None:
       self.hlen_monitor.register([x for x in k['masked_lm_lengths'] if x >= 0])
       if self.cur_step % self.steps_per_epoch == 0:
         self.hlen_monitor.plot()
         with open(self.cache_path / "hole_length_mon.pkl", 'wb') as outf:
           pickle.dump(self.hlen_monitor, outf)
-    return k
+    return
 
 class LazyConcatDataset(torch.utils.data.Dataset):
   r"""Dataset as a concatenation of multiple datasets.
@@ -228,19 +309,25 @@ class LazyConcatDataset(torch.utils.data.Dataset):
   and instantiate them lazily, to avoid loading them all in
   memory at the same time/
 
+  Datasets are pt_record shards, read through corpus_shards.RecordShard:
+  opening them only reads their index sidecar and every row is read on its
+  own. Shards of older caches, saved whole with torch.save, are converted on
+  first use. At most MAX_OPEN_SHARDS shards are mapped at a time, the least
+  recently read one is closed to make room.
+
   Arguments:
     datasets (sequence): List of paths for datasets to be concatenated
   """
 
   @staticmethod
-  def cumsum(sequence: typing.List[pathlib.Path]):
-    r, s = [], 0
-    for e in sequence:
-      lt = len(torch.load(e))
-      assert lt > 0, "Dataset {} is empty".format(e)
-      r.append(lt + s)
-      s += lt
-    return r
+  def OpenShard(path: pathlib.Path) -> corpus_shards.RecordShard:
+    """Open a pt_record shard, converting it first if it was saved whole with torch.save."""
+    if not corpus_shards.RecordShard.Exists(path):
+      corpus_shards.WriteRecordShard(
+        path, [{k: v.numpy() for (k, v) in inst.items()} for inst in torch.load(path)]
+      )
+      l.getLogger().info("Converted {} to a record shard.".format(path))
+    return corpus_shards.RecordShard(path)
 
   @property
   def num_datasets(self):
@@ -250,14 +337,31 @@ class LazyConcatDataset(torch.utils.data.Dataset):
     super(LazyConcatDataset, self).__init__()
     assert len(datasets) > 0, 'Empty list of datasets provided.'
     self.datasets = datasets
-    self.cumulative_sizes = self.cumsum(self.datasets)
-
-    self.curr_dset_idx = None
-    self.dataset       = None
+    self.shards   = [self.OpenShard(pathlib.Path(e)) for e in self.datasets]
+    self._open    = collections.OrderedDict()
+    for e, shard in zip(self.datasets, self.shards):
+      assert len(shard) > 0, "Dataset {} is empty".format(e)
+    self.cumulative_sizes = list(np.cumsum([len(shard) for shard in self.shards]).tolist())
 
   def __len__(self):
     return self.cumulative_sizes[-1]
 
+  def workerInit(self) -> None:
+    """Drop the shard handles inherited by a DataLoader worker process."""
+    for shard in self.shards:
+      shard.Close()
+    self._open.clear()
+    return
+
+  def _Shard(self, dataset_idx: int) -> corpus_shards.RecordShard:
+    """Get a shard, closing the least recently read one past MAX_OPEN_SHARDS."""
+    self._open[dataset_idx] = self.shards[dataset_idx]
+    self._open.move_to_end(dataset_idx)
+    if len(self._open) > MAX_OPEN_SHARDS:
+      _, oldest = self._open.popitem(last = False)
+      oldest.Close()
+    return self.shards[dataset_idx]
+
   def __getitem__(self, idx):
 
     import bisect
@@ -266,16 +370,12 @@ class LazyConcatDataset(torch.utils.data.Dataset):
         raise ValueError("absolute value of index should not exceed dataset length")
       idx = len(self) + idx
     dataset_idx = bisect.bisect_right(self.cumulative_sizes, idx)
-    
-    if self.curr_dset_idx != dataset_idx:
-      self.curr_dset_idx = dataset_idx
-      self.dataset = torch.load(self.datasets[dataset_idx])
 
     if dataset_idx == 0:
       sample_idx = idx
     else:
       sample_idx = idx - self.cumulative_sizes[dataset_idx - 1]
-    return self.dataset[sample_idx]
+    return {k: torch.from_numpy(v) for (k, v) in self._Shard(dataset_idx)[sample_idx].items()}
 
 class LazyRandomSampler(torch.utils.data.Sampler):
   r"""Samples elements randomly. If without replacement, then sample from a shuffled dataset.
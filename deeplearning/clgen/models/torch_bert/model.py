@@ -793,6 +793,8 @@ class BertForPreTraining(BertPreTrainedModel):
     is_validation        = False,
     is_live              = False,
     step                 = -1,
+    fill_only            = False,
+    compile_status       = None,
     **kwargs
   ):
     r"""
@@ -806,6 +808,11 @@ class BertForPreTraining(BertPreTrainedModel):
       Indices should be in ``[0, 1]``.
       ``0`` indicates sequence B is a continuation of sequence A,
       ``1`` indicates sequence B is a random sequence.
+    fill_only (:obj:`bool`, `optional`, defaults to :obj:`False`):
+      With compilation rewards, only fill the holes of the batch and return the ``generated_samples``.
+    compile_status (``torch.LongTensor`` of shape ``(batch_size,)``, `optional`, defaults to :obj:`None`):
+      With compilation rewards, compilation status of the batch, filled with ``fill_only`` in an earlier step.
+      The batch is not filled again and the loss of sequences that compiled is zero-ed.
     kwargs (:obj:`Dict[str, any]`, optional, defaults to `{}`):
       Used to hide legacy arguments that have been deprecated.
 
@@ -846,14 +853,27 @@ class BertForPreTraining(BertPreTrainedModel):
     )
     device = input_ids.get_device()
     if not is_validation and self.compile_sampler and step >= self.config.reward_compilation and not self.config.is_sampling:
-      samples, compile_flag, masked_lm_labels = self.compile_sampler.generateTrainingBatch(
-        self,
-        device,
-        input_ids.cpu(),
-        prediction_scores.cpu(),
-        torch.clone(position_ids),
-        masked_lm_labels.cpu().numpy(),
-      )
+      if fill_only:
+        return {
+          'generated_samples' : self.compile_sampler.BatchFill(
+            self, input_ids, prediction_scores.detach(), torch.clone(position_ids)
+          ),
+        }
+      if compile_status is None:
+        samples, compile_flag, masked_lm_labels, compile_ms = self.compile_sampler.generateTrainingBatch(
+          self,
+          device,
+          input_ids,
+          prediction_scores.detach(),
+          torch.clone(position_ids),
+          masked_lm_labels.cpu().numpy(),
+        )
+        generated_samples = torch.LongTensor(samples).to(device)
+        compile_status    = torch.LongTensor(compile_flag).to(device)
+      else:
+        # The batch was compiled in the background, see compiler.CompileRewardQueue.
+        generated_samples, compile_ms = None, 0.0
+        masked_lm_labels  = masked_lm_labels.masked_fill(compile_status.unsqueeze(-1).bool(), -100)
       loss_fct = torch.nn.CrossEntropyLoss()
       masked_lm_loss     = loss_fct(prediction_scores.view(-1, self.config.vocab_size), masked_lm_labels.view(-1))
       next_sentence_loss = loss_fct(seq_relationship_score.view(-1, 2), next_sentence_labels.view(-1))
@@ -866,9 +886,10 @@ class BertForPreTraining(BertPreTrainedModel):
         'seq_relationship_logits' : seq_relationship_score,
         'hidden_states'           : hidden_states,
         'attentions'              : attentions,
-        'compile_status'          : torch.LongTensor(compile_flag).to(device),
-        'generated_samples'       : torch.LongTensor(samples).to(device),
-        'batch_compilation_rate'  : torch.full((1,), float(sum(compile_flag)) / len(compile_flag), dtype = torch.float).to(device),
+        'compile_status'          : compile_status,
+        'generated_samples'       : generated_samples,
+        'batch_compilation_rate'  : torch.full((1,), float(compile_status.sum().item()) / len(compile_status), dtype = torch.float).to(device),
+        'compile_wait_ms'         : torch.full((1,), compile_ms, dtype = torch.float).to(device),
         # 'sample_indices'          : [0],
       }
     elif not is_validation and self.compile_sampler and self.config.is_sampling:
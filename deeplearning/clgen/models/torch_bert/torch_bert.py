@@ -32,6 +32,7 @@ import tqdm
 from deeplearning.clgen.samplers import samplers
 from deeplearning.clgen.samplers import sample_observers
 from deeplearning.clgen.samplers import validation_database
+from deeplearning.clgen.util import compile_cache
 from deeplearning.clgen.util import pbutil
 from deeplearning.clgen.util import plotter
 from deeplearning.clgen.proto import model_pb2
@@ -43,6 +44,7 @@ from deeplearning.clgen.models import telemetry
 from deeplearning.clgen.models import bert_flags
 from deeplearning.clgen.preprocessors import opencl
 from deeplearning.clgen.models.torch_bert import model
+from deeplearning.clgen.models.torch_bert import compiler
 from deeplearning.clgen.models.torch_bert import config
 from deeplearning.clgen.models.torch_bert import optimizer
 from deeplearning.clgen.models.torch_bert import hooks
@@ -65,6 +67,15 @@ flags.DEFINE_integer(
   "Any integer >= 0: Kick-in this mode after this training step. 0 uses this method from start."
 )
 
+flags.DEFINE_integer(
+  "reward_compilation_lag",
+  0,
+  "Number of steps by which compilation rewards lag behind, with --reward_compilation. "
+  "[Default: 0]: every filled batch is compiled before its backward pass. "
+  "Any integer > 0: batches are filled with the weights of this many steps ago and compiled in the background, "
+  "while the batches in between are trained on. Costs an extra forward pass per step."
+)
+
 flags.DEFINE_boolean(
   "validate_per_epoch",
   True,
@@ -292,10 +303,14 @@ class torchBert(backends.BackendBase):
                  is_validation : bool = False,
                  step          : int  = -1,
                  is_live       : bool = False,
+                 fill_only     : bool = False,
+                 compile_status: typing.TypeVar('torch.Tensor') = None,
                  ) -> typing.Dict[str, typing.TypeVar('torch.Tensor')]:
     """
     Perform a training step on a batch of inputs.
     """
+    if compile_status is not None:
+      compile_status = compile_status.to(self.pytorch.device)
     inputs['input_ids']            = inputs['input_ids'].to(self.pytorch.device)
     inputs['input_mask']           = inputs['input_mask'].to(self.pytorch.device)
     inputs['position_ids']         = inputs['position_ids'].to(self.pytorch.device)
@@ -311,6 +326,8 @@ class torchBert(backends.BackendBase):
                 is_validation        = is_validation,
                 step                 = step,
                 is_live              = is_live,
+                fill_only            = fill_only,
+                compile_status       = compile_status,
               )
     return outputs
 
@@ -490,6 +507,24 @@ class torchBert(backends.BackendBase):
         )
       else:
         correct_sample_obs = None
+      if correct_sample_obs is not None and FLAGS.reward_compilation_lag > 0:
+        reward_queue = compiler.CompileRewardQueue(
+          self.tokenizer, FLAGS.reward_compilation_lag, extract_features = self.is_world_process_zero()
+        )
+      else:
+        reward_queue = None
+
+      def next_batch():
+        nonlocal batch_iterator
+        try:
+          inputs = next(batch_iterator)
+        except StopIteration:
+          # dataloader has different len() than steps_per_epoch.
+          # This is the easiest way to infinite-loop dataloaders in pytorch.
+          batch_iterator = iter(loader)
+          inputs = next(batch_iterator)
+        self.train.data_generator.MonitorBatch(inputs)
+        return inputs
       
       total_steps = self.config.training.num_pretrain_steps if pre_train else self.config.training.num_train_steps
       l.getLogger().info(
@@ -508,15 +543,28 @@ class torchBert(backends.BackendBase):
           for step in tqdm.auto.trange(self.steps_per_epoch, desc="Batch", leave = False):
             if self.is_world_process_zero():
               start = datetime.datetime.utcnow()
-            try:
-              inputs = next(batch_iterator)
-            except StopIteration:
-              # dataloader has different len() than steps_per_epoch.
-              # This is the easiest way to infinite-loop dataloaders in pytorch.
-              batch_iterator = iter(loader)
-              inputs = next(batch_iterator)
-
-            step_out = self.model_step(self.train.model, inputs, step = epoch * self.steps_per_epoch + step)
+            inputs = next_batch()
+
+            global_step = epoch * self.steps_per_epoch + step
+            is_rewarded = correct_sample_obs is not None and FLAGS.reward_compilation <= global_step
+            if is_rewarded and reward_queue is not None:
+              # Fill new batches with the current weights for clang to compile in the background,
+              # and train on the oldest one, which was filled reward_compilation_lag steps ago.
+              while not reward_queue.is_full:
+                with self.torch.no_grad():
+                  fill_out = self.model_step(self.train.model, inputs, step = global_step, fill_only = True)
+                reward_queue.Submit(inputs, list(fill_out['generated_samples'].cpu().numpy()))
+                if not reward_queue.is_full:
+                  inputs = next_batch()
+              inputs, samples, compile_flag, features, clang_wait_ms = reward_queue.Pop()
+              step_out = self.model_step(
+                self.train.model, inputs, step = global_step, compile_status = self.torch.LongTensor(compile_flag)
+              )
+            else:
+              step_out = self.model_step(self.train.model, inputs, step = global_step)
+              if is_rewarded:
+                samples, features = None, None
+                clang_wait_ms = step_out['compile_wait_ms'].max().item()
             total_loss = step_out['total_loss'].mean()
             total_loss.backward()
 
@@ -534,10 +582,19 @@ class torchBert(backends.BackendBase):
                 self.torch.distributed.all_reduce(step_out["next_sentence_loss"])
                 self.torch.distributed.all_reduce(total_loss)
                 self.torch.distributed.all_reduce(inputs['masked_lm_lengths'])
-              if FLAGS.reward_compilation >= 0 and FLAGS.reward_compilation <= epoch * self.steps_per_epoch + step and not pre_train:
-                correct_samples = [(x, y) for en, (x, y) in enumerate(zip(inputs['input_ids'].cpu().numpy(), step_out['generated_samples'].cpu().numpy())) if step_out['compile_status'][en] == 1]
+              if is_rewarded:
+                if samples is None:
+                  samples      = list(step_out['generated_samples'].cpu().numpy())
+                  compile_flag = step_out['compile_status'].cpu().numpy()
+                  t = time.time()
+                  features = [
+                    extractor.ExtractFeatures(self.tokenizer.ArrayToCode(s)) if flag == 1 else None
+                    for s, flag in zip(samples, compile_flag)
+                  ]
+                  clang_wait_ms += 1000 * (time.time() - t)
+                correct_samples = [(x, y, fts) for x, y, fts in zip(inputs['input_ids'].cpu().numpy(), samples, features) if fts is not None]
                 for s in correct_samples:
-                  feature_vector = extractor.ExtractFeatures(self.tokenizer.ArrayToCode(s[1]))
+                  feature_vector = s[2]
                   correct_sample_obs.OnSample(model_pb2.Sample(
                       train_step             = self.current_step,
                       sample_feed            = self.tokenizer.tokensToString(s[0], ignore_token = self.tokenizer.padToken).replace("\\n", "\n"),
@@ -561,6 +618,7 @@ class torchBert(backends.BackendBase):
                   learning_rate           = self.train.scheduler.get_last_lr()[0],
                   compilation_rate        = step_out['batch_compilation_rate'].mean().item(),
                   num_correct_samples     = (correct_sample_obs.sample_id if correct_sample_obs is not None else None),
+                  clang_wait_ms           = (clang_wait_ms if is_rewarded else None),
                   batch_avg_hole_len      = sum([sum([int(l) for l in b if l != -1]) / len([int(l) for l in b if l != -1])
                                                  for b in inputs['masked_lm_lengths']]) / len(inputs['masked_lm_lengths']),
                   batch_execution_time_ms = exec_time_ms,
@@ -616,14 +674,11 @@ class torchBert(backends.BackendBase):
               self.InitSampleBatch(sampler)
               org_inputs, input_ids, samples, indices = self.SampleNextIndices()
               end_time = datetime.datetime.utcnow()
-              for org, inp, sample, idxs in zip(org_inputs, input_ids, samples, indices):
-                try:
-                  stdout = opencl.Compile(self.tokenizer.ArrayToCode(sample))
-                  compile_flag = 1
-                except ValueError:
-                  compile_flag = 0
-
-                feature_vector = extractor.ExtractFeatures(self.tokenizer.ArrayToCode(sample))
+              srcs          = [self.tokenizer.ArrayToCode(sample) for sample in samples]
+              compile_flags = opencl.CompileMany(srcs)
+              for org, inp, sample, idxs, src, compile_flag in zip(org_inputs, input_ids, samples, indices, srcs, compile_flags):
+                compile_flag   = int(compile_flag)
+                feature_vector = extractor.ExtractFeatures(src) if compile_flag else {}
                 sample_proto = model_pb2.Sample(
                   train_step             = self.current_step,
                   sample_feed            = sampler.start_text,
@@ -641,8 +696,12 @@ class torchBert(backends.BackendBase):
                 )
                 for obs in observers:
                   obs.OnSample(sample_proto)
+          # Compilation rewards and per-epoch samples of this epoch.
+          compile_cache.ReportHitRate()
       except KeyboardInterrupt:
         pass
+      if reward_queue is not None:
+        reward_queue.Close()
 
       if not FLAGS.force_eval:
         _, _ = self.Validate(pre_train = pre_train)
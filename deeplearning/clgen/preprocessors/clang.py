@@ -19,7 +19,11 @@ wrappers around Clang binaries, which preprocessor functions can use to
 implement specific behavior. See deeplearning.clgen.preprocessors.cxx.Compile()
 for an example.
 """
+import functools
 import json
+import multiprocessing
+import os
+import pathlib
 import re
 import humanize
 import subprocess
@@ -62,6 +66,86 @@ CLANG_FORMAT = environment.CLANG_FORMAT
 OPT          = environment.OPT
 LLVM_EXTRACT = environment.LLVM_EXTRACT
 
+# Virtual paths of in-memory sources passed to libclang as unsaved files.
+# They never touch the filesystem.
+UNSAVED_SRC_PATH    = "/clgen_unsaved/input"
+UNSAVED_HEADER_PATH = "/clgen_unsaved/header.h"
+
+# libclang index of this process, created lazily and kept warm for all parses.
+_INDEX = None
+# Long-lived worker pool, shared by all batch compile/atomize requests.
+_WORKER_POOL = None
+
+def _GetIndex() -> clang.cindex.Index:
+  """Get the libclang index of this process."""
+  global _INDEX
+  if _INDEX is None:
+    _INDEX = clang.cindex.Index.create()
+  return _INDEX
+
+def _InitWorker() -> None:
+  """Pool initializer. Every worker creates its own libclang index once."""
+  global _INDEX
+  _INDEX = clang.cindex.Index.create()
+  return
+
+def GetWorkerPool() -> typing.Optional[multiprocessing.Pool]:
+  """Get the long-lived clang worker pool.
+
+  The pool is created on first use and lives until TerminateWorkerPool() or
+  the end of the process. Each worker keeps a libclang index warm, so batch
+  requests pay neither process startup nor libclang initialization per call.
+
+  Returns:
+    The worker pool, or None if called from a daemonic worker process, which
+    is not allowed to have children. Callers should then work in-process.
+  """
+  global _WORKER_POOL
+  if multiprocessing.current_process().daemon:
+    return None
+  if _WORKER_POOL is None:
+    _WORKER_POOL = multiprocessing.Pool(initializer = _InitWorker)
+  return _WORKER_POOL
+
+def TerminateWorkerPool() -> None:
+  """Kill the clang worker pool. A new one is created by the next request."""
+  global _WORKER_POOL
+  if _WORKER_POOL is not None:
+    _WORKER_POOL.terminate()
+    _WORKER_POOL.join()
+    _WORKER_POOL = None
+  return
+
+def _ParseUnsaved(src: str,
+                  suffix: str,
+                  cflags: typing.List[str],
+                  header_file: str = None,
+                  ) -> clang.cindex.TranslationUnit:
+  """Parse in-memory source code with the warm libclang index of this process.
+
+  Args:
+    src: The source code to parse.
+    suffix: The suffix of the virtual source file. E.g. '.c' for a C program.
+    cflags: A list of flags to be passed to clang.
+    header_file: Optional in-memory header, force-included before src.
+
+  Returns:
+    The parsed translation unit.
+
+  Raises:
+    ValueError: If libclang fails to parse src.
+  """
+  src_path = UNSAVED_SRC_PATH + suffix
+  unsaved  = [(src_path, src)]
+  args     = list(cflags)
+  if header_file:
+    unsaved.append((UNSAVED_HEADER_PATH, header_file))
+    args.append('-include{}'.format(UNSAVED_HEADER_PATH))
+  try:
+    return _GetIndex().parse(src_path, args = args, unsaved_files = unsaved)
+  except clang.cindex.TranslationUnitLoadError as e:
+    raise ValueError(e)
+
 def StripPreprocessorLines(src: str) -> str:
   """Strip preprocessor remnants from clang frontend output.
 
@@ -136,6 +220,79 @@ def Preprocess(
   else:
     return stdout
 
+def BuildPrecompiledHeader(headers: typing.List[str],
+                           cflags: typing.List[str],
+                           pch_path: pathlib.Path,
+                           use_libclang: bool,
+                           timeout_seconds: int = 300,
+                           ) -> pathlib.Path:
+  """Precompile a set of headers into a single clang PCH file.
+
+  The headers are wrapped into one umbrella header, in the order given, so
+  that passing '-include-pch <pch_path>' is equivalent to passing an
+  '-include' for each one of them. PCH files are not portable across clang
+  versions, therefore the same frontend that will consume the PCH must build
+  it: the libclang python bindings if use_libclang is set, otherwise the
+  clang system binary.
+
+  The PCH is written to a temporary file and atomically moved to pch_path, so
+  concurrent workers racing to build the same header never observe a partial
+  file.
+
+  Args:
+    headers: Paths of header files to precompile.
+    cflags: A list of flags to be passed to clang. Must not contain the
+      '-include' flags of the headers themselves.
+    pch_path: Destination path of the precompiled header.
+    use_libclang: Select libclang instead of the clang binary as frontend.
+    timeout_seconds: The number of seconds to allow before killing clang.
+
+  Returns:
+    The path of the precompiled header.
+
+  Raises:
+    ValueError: In case of an error.
+  """
+  tmp_path = pathlib.Path("{}.{}.tmp".format(pch_path, os.getpid()))
+  with tempfile.NamedTemporaryFile("w", prefix="clgen_preprocessors_clang_pch_", suffix=".h") as f:
+    f.write(''.join('#include "{}"\n'.format(h) for h in headers))
+    f.flush()
+    if use_libclang:
+      try:
+        unit = clang.cindex.TranslationUnit.from_source(
+          f.name,
+          args = cflags,
+          options = clang.cindex.TranslationUnit.PARSE_INCOMPLETE,
+        )
+      except clang.cindex.TranslationUnitLoadError as e:
+        raise ValueError(e)
+      diagnostics = [str(d) for d in unit.diagnostics if d.severity > 2]
+      if len(diagnostics) > 0:
+        raise ValueError('\n'.join(diagnostics))
+      try:
+        unit.save(str(tmp_path))
+      except clang.cindex.TranslationUnitSaveError as e:
+        raise ValueError(e)
+    else:
+      cmd = (
+        ["timeout", "-s9", str(timeout_seconds), str(CLANG), "-c"]
+        + cflags
+        + ["-Xclang", "-emit-pch", "-o", str(tmp_path), f.name]
+      )
+      process = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+      )
+      stdout, stderr = process.communicate()
+      if process.returncode == 9:
+        raise ValueError(f"Clang timed out after {timeout_seconds}s")
+      elif process.returncode != 0:
+        raise ValueError(stderr)
+  os.replace(str(tmp_path), str(pch_path))
+  return pch_path
+
 def CompileLlvmBytecode(src: str,
                         suffix: str,
                         cflags: typing.List[str],
@@ -212,6 +369,35 @@ def CompileOptimizer(src: str,
     ValueError: In case of an error.
     ValueError: If clang does not complete before timeout_seconds.
   """
+  stdout = CompileOptimizerMany(src, suffix, cflags, [optimization], header_file, timeout_seconds)[0]
+  if isinstance(stdout, ValueError):
+    raise stdout
+  return stdout
+
+def CompileOptimizerMany(src: str,
+                         suffix: str,
+                         cflags: typing.List[str],
+                         optimizations: typing.List[typing.List[str]],
+                         header_file: str = None,
+                         timeout_seconds: int = 60,
+                         ) -> typing.List[typing.Union[str, ValueError]]:
+  """Compile source code to IR once and apply each of a list of optimization passes to it.
+
+  Args:
+    src: The source code to compile.
+    suffix: The suffix to append to the source code temporary file. E.g. '.c'
+      for a C program.
+    cflags: A list of flags to be passed to clang.
+    optimizations: A list of opt arguments, one for each pass to run.
+    timeout_seconds: The number of seconds to allow before killing clang.
+
+  Returns:
+    The stdout of opt for each optimization, or the ValueError raised
+    by that pass.
+
+  Raises:
+    ValueError: If the source does not compile.
+  """
   try:
     bc = CompileLlvmBytecode(src, suffix, cflags, header_file, timeout_seconds)
   except ValueError as e:
@@ -241,23 +427,27 @@ def CompileOptimizer(src: str,
       if ext_err:
         raise ValueError(ext_err)
 
-    cmd = (
-      ["timeout", "-s9", str(timeout_seconds), str(OPT)]
-      + optimization
-      + [f.name, "-o", "/dev/null"]
-    )
-    process = subprocess.Popen(
-      cmd,
-      stdout=subprocess.PIPE,
-      stderr=subprocess.PIPE,
-      universal_newlines=True,
-    )
-    stdout, stderr = process.communicate()
-  if process.returncode == 9:
-    raise ValueError(f"Clang timed out after {timeout_seconds}s")
-  elif process.returncode != 0:
-    raise ValueError("/*\n{}\n*/\n{}".format(stderr, src))
-  return stdout
+    outputs = []
+    for optimization in optimizations:
+      cmd = (
+        ["timeout", "-s9", str(timeout_seconds), str(OPT)]
+        + optimization
+        + [f.name, "-o", "/dev/null"]
+      )
+      process = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+      )
+      stdout, stderr = process.communicate()
+      if process.returncode == 9:
+        outputs.append(ValueError(f"Clang timed out after {timeout_seconds}s"))
+      elif process.returncode != 0:
+        outputs.append(ValueError("/*\n{}\n*/\n{}".format(stderr, src)))
+      else:
+        outputs.append(stdout)
+  return outputs
 
 def Compile(src: str,
             suffix: str,
@@ -280,35 +470,56 @@ def Compile(src: str,
     ValueError: In case of an error.
   """
   builtin_cflags = ["-S", "-emit-llvm", "-o", "-"]
-  with tempfile.NamedTemporaryFile("w", prefix="clgen_preprocessors_clang_", suffix=suffix) as f:
-    f.write(src)
-    f.flush()
+  unit = _ParseUnsaved(src, suffix, builtin_cflags + cflags, header_file = header_file)
+  diagnostics = [str(d) for d in unit.diagnostics if d.severity > 2]
+  # diagnostics = [str(d) for d in unit.diagnostics if d.severity > 2 and not "implicit declaration of function" not in str(d)]
 
-    extra_args = []
-    if header_file:
-      htf = tempfile.NamedTemporaryFile('w', prefix = "clgen_preprocessors_clang_header_", suffix = ".h")
-      htf.write(header_file)
-      htf.flush()
-      extra_args = ['-include{}'.format(htf.name)]
+  if len(diagnostics) > 0:
+    if return_diagnostics:
+      return src, [(d.location.line, d.location.column) for d in unit.diagnostics if d.severity > 2]
+    else:
+      raise ValueError("/*\n{}\n*/\n{}".format('\n'.join(diagnostics), src))
+  else:
+    if return_diagnostics:
+      return src, []
+    else:
+      return src
+
+def _CompileWorker(src: str,
+                   suffix: str,
+                   cflags: typing.List[str],
+                   header_file: str = None,
+                   ) -> bool:
+  """Pool worker of CompileMany."""
+  try:
+    Compile(src, suffix, cflags, header_file = header_file)
+    return True
+  except ValueError:
+    return False
 
-    try:
-      unit = clang.cindex.TranslationUnit.from_source(f.name, args = builtin_cflags + cflags + extra_args)
-    except clang.cindex.TranslationUnitLoadError as e:
-      raise ValueError(e)
+def CompileMany(srcs: typing.List[str],
+                suffix: str,
+                cflags: typing.List[str],
+                header_file: str = None,
+                ) -> typing.List[bool]:
+  """Check a batch of source codes for whether they compile.
 
-    diagnostics = [str(d) for d in unit.diagnostics if d.severity > 2]
-    # diagnostics = [str(d) for d in unit.diagnostics if d.severity > 2 and not "implicit declaration of function" not in str(d)]
+  Sources are distributed over the long-lived worker pool.
 
-    if len(diagnostics) > 0:
-      if return_diagnostics:
-        return src, [(d.location.line, d.location.column) for d in unit.diagnostics if d.severity > 2]
-      else:
-        raise ValueError("/*\n{}\n*/\n{}".format('\n'.join(diagnostics), src))
-    else:
-      if return_diagnostics:
-        return src, []
-      else:
-        return src
+  Args:
+    srcs: The source codes to compile.
+    suffix: The suffix of the virtual source files. E.g. '.c' for a C program.
+    cflags: A list of flags to be passed to clang.
+    header_file: Optional in-memory header, force-included before every src.
+
+  Returns:
+    A list of compilation status, one for each element in srcs.
+  """
+  worker = functools.partial(_CompileWorker, suffix = suffix, cflags = cflags, header_file = header_file)
+  pool = GetWorkerPool()
+  if pool is None or len(srcs) <= 1:
+    return [worker(x) for x in srcs]
+  return pool.map(worker, srcs, chunksize = max(1, len(srcs) // (4 * multiprocessing.cpu_count())))
 
 def Parse(src: str,
           suffix: str,
@@ -487,29 +698,20 @@ def DeriveSourceVocab(src: str,
     ValueError: In case of an error.
   """
   builtin_cflags = ["-S", "-emit-llvm", "-o", "-"]
-  with tempfile.NamedTemporaryFile(
-    "w", prefix="clgen_preprocessors_clang_", suffix=suffix
-  ) as f:
-    f.write(src)
-    f.flush()
-    try:
-      unit = clang.cindex.TranslationUnit.from_source(f.name, args = builtin_cflags + cflags)
-    except clang.cindex.TranslationUnitLoadError as e:
-      raise ValueError(e)
-
-    tokens = {}
-    for ch in string.printable:
-      # Store all printable characters as char-based, to save time iterating literals.
-      tokens["{}-char-based".format(ch)] = ''
-    for idx, t in enumerate(unit.get_tokens(extent = unit.cursor.extent)):
-      str_t = str(t.spelling)
-      if str_t in token_list or t.kind in {clang.cindex.TokenKind.KEYWORD, clang.cindex.TokenKind.PUNCTUATION}:
+  unit = _ParseUnsaved(src, suffix, builtin_cflags + cflags)
+  tokens = {}
+  for ch in string.printable:
+    # Store all printable characters as char-based, to save time iterating literals.
+    tokens["{}-char-based".format(ch)] = ''
+  for idx, t in enumerate(unit.get_tokens(extent = unit.cursor.extent)):
+    str_t = str(t.spelling)
+    if str_t in token_list or t.kind in {clang.cindex.TokenKind.KEYWORD, clang.cindex.TokenKind.PUNCTUATION}:
+      tokens[str_t] = ' '
+    else:
+      if t.kind != clang.cindex.TokenKind.LITERAL and clang.cindex.Cursor.from_location(unit, t.extent.end).kind not in {clang.cindex.CursorKind.CALL_EXPR}:
         tokens[str_t] = ' '
-      else:
-        if t.kind != clang.cindex.TokenKind.LITERAL and clang.cindex.Cursor.from_location(unit, t.extent.end).kind not in {clang.cindex.CursorKind.CALL_EXPR}:
-          tokens[str_t] = ' '
 
-    return tokens
+  return tokens
 
 def AtomizeSource(src: str,
                   vocab: typing.Set[str],
@@ -533,33 +735,61 @@ def AtomizeSource(src: str,
     ValueError: In case of an error.
   """
   builtin_cflags = ["-S", "-emit-llvm", "-o", "-"]
-  with tempfile.NamedTemporaryFile(
-    "w", prefix="clgen_preprocessors_clang_", suffix=suffix
-  ) as f:
-    f.write(src)
-    f.flush()
-    try:
-      unit = clang.cindex.TranslationUnit.from_source(f.name, args = builtin_cflags + cflags)
-    except clang.cindex.TranslationUnitLoadError as e:
-      raise ValueError(e)
-    tokens = []
-    lookout_metaToken, cmt = False, None
-    for idx, t in enumerate(unit.get_tokens(extent = unit.cursor.extent)):
-      str_t = t.spelling
-      if str_t in {'START', 'MASK', 'HOLE', 'END', 'PAD'} and tokens[-1] == '[':
-        cmt = str_t
-        lookout_metaToken = True
-      elif str_t in vocab:
-        if lookout_metaToken and str_t == ']':
-          tokens[-1] = "[{}]".format(cmt)
-          lookout_metaToken = False
-        else:
-          tokens.append(str(t.spelling))
+  unit = _ParseUnsaved(src, suffix, builtin_cflags + cflags)
+  tokens = []
+  lookout_metaToken, cmt = False, None
+  for idx, t in enumerate(unit.get_tokens(extent = unit.cursor.extent)):
+    str_t = t.spelling
+    if str_t in {'START', 'MASK', 'HOLE', 'END', 'PAD'} and tokens[-1] == '[':
+      cmt = str_t
+      lookout_metaToken = True
+    elif str_t in vocab:
+      if lookout_metaToken and str_t == ']':
+        tokens[-1] = "[{}]".format(cmt)
+        lookout_metaToken = False
       else:
-        for ch in str_t:
-          tokens.append("{}-char-based".format(ch))
+        tokens.append(str(t.spelling))
+    else:
+      for ch in str_t:
+        tokens.append("{}-char-based".format(ch))
+
+  return tokens
+
+def _AtomizeWorker(src: str,
+                   vocab: typing.Set[str],
+                   suffix: str,
+                   cflags: typing.List[str],
+                   ) -> typing.Optional[typing.List[str]]:
+  """Pool worker of AtomizeMany."""
+  try:
+    return AtomizeSource(src, vocab, suffix, cflags)
+  except ValueError:
+    return None
+
+def AtomizeMany(srcs: typing.List[str],
+                vocab: typing.Set[str],
+                suffix: str,
+                cflags: typing.List[str],
+                ) -> typing.List[typing.Optional[typing.List[str]]]:
+  """
+  Split a batch of source codes into token atoms with clang's lexer.
+
+  Sources are distributed over the long-lived worker pool.
+
+  Args:
+    srcs: The source codes to atomize.
+    vocab: Optional set of learned vocabulary of tokenizer.
+    suffix: The suffix of the virtual source files. E.g. '.c' for a C program.
+    cflags: A list of flags to be passed to clang.
 
-    return tokens
+  Returns:
+    A list of token atoms for every element in srcs, or None where parsing failed.
+  """
+  worker = functools.partial(_AtomizeWorker, vocab = vocab, suffix = suffix, cflags = cflags)
+  pool = GetWorkerPool()
+  if pool is None or len(srcs) <= 1:
+    return [worker(x) for x in srcs]
+  return pool.map(worker, srcs, chunksize = max(1, len(srcs) // (4 * multiprocessing.cpu_count())))
 
 def GreweFeatureExtraction(src: str,
                            suffx: str,
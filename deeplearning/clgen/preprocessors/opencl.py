@@ -16,16 +16,28 @@
 import typing
 import os
 # import glob
-# import pathlib
+import pathlib
 
+from deeplearning.clgen.util import cache
+from deeplearning.clgen.util import compile_cache
+from deeplearning.clgen.util import crypto
 from deeplearning.clgen.util import environment
 from deeplearning.clgen.preprocessors import clang
 from deeplearning.clgen.preprocessors import normalizer
 from deeplearning.clgen.preprocessors import public
 from absl import flags
+from eupy.native import logger as l
 
 FLAGS = flags.FLAGS
 
+flags.DEFINE_boolean(
+  "use_opencl_pch",
+  True,
+  "Compile, atomize and lex OpenCL kernels against a precompiled header of "
+  "the OpenCL standard headers, built once and stored in the clgen cache, "
+  "instead of re-parsing the headers for every kernel.",
+)
+
 # LibCLC
 LIBCLC         = environment.LIBCLC
 # OpenCL standard headers
@@ -40,37 +52,136 @@ OPENCL_C_BASE  = os.path.join(environment.DATA_CL_INCLUDE, "opencl-c-base.h")
 SHIMFILE       = os.path.join(environment.DATA_CL_INCLUDE, "opencl-shim.h")
 STRUCTS        = os.path.join(environment.DATA_CL_INCLUDE, "structs.h")
 
-def GetClangArgs(use_shim: bool, use_aux_headers: bool) -> typing.List[str]:
-  """Get the arguments to pass to clang for handling OpenCL.
+# Precompiled header paths resolved by this process, keyed by
+# (use_aux_headers, pch_frontend). None marks a PCH that failed to build.
+_PCH_PATHS: typing.Dict[typing.Tuple[bool, str], typing.Optional[pathlib.Path]] = {}
+# Compile cache key arguments of this process, keyed by use_aux_headers.
+_CACHE_KEY_ARGS: typing.Dict[bool, typing.List[str]] = {}
 
-  Args:
-    use_shim: If true, inject the shim OpenCL header.
-    error_limit: The number of errors to print before arboting
+def _GetIncludeHeaders(use_aux_headers: bool) -> typing.List[str]:
+  """Get the headers that are force-included in every OpenCL compilation, in order."""
+  headers = [OPENCL_C_H, OPENCL_C_BASE, CL_H]
+  if use_aux_headers:
+    headers.append(STRUCTS)
+  return headers
 
-  Returns:
-    A list of command line arguments to pass to Popen().
-  """
+def _GetBaseClangArgs(use_aux_headers: bool) -> typing.List[str]:
+  """Get clang arguments for OpenCL, without any force-included header."""
   args = [
     "-xcl",
     "--target=nvptx64-nvidia-nvcl",
     "-cl-std=CL2.0",
     "-ferror-limit=0",
-    "-include{}".format(OPENCL_C_H),
-    "-include{}".format(OPENCL_C_BASE),
-    "-include{}".format(CL_H),
     "-I{}".format(str(OPENCL_HEADERS)),
     "-I{}".format(str(LIBCLC)),
     "-Wno-everything",
   ]
   if use_aux_headers:
-    args += [
-      "-include{}".format(STRUCTS),
-      "-I{}".format(str(AUX_INCLUDE)),
+    args += ["-I{}".format(str(AUX_INCLUDE))]
+  return args
+
+def GetPrecompiledHeader(use_aux_headers: bool, pch_frontend: str) -> typing.Optional[pathlib.Path]:
+  """Get the precompiled header of the OpenCL standard headers.
+
+  The PCH is built once and stored in the clgen cache. Its name is the hash of
+  the headers' content, the clang flags and the frontend that consumes it, so
+  any change to either of them silently builds a new one. A PCH that fails to
+  build or to compile a trivial kernel is disabled for the rest of the process
+  and callers fall back to plain '-include' flags.
+
+  Args:
+    use_aux_headers: Include the auxiliary struct definitions.
+    pch_frontend: The consumer of the PCH: "libclang" or "clang".
+
+  Returns:
+    Path to the PCH, or None if it is not available.
+  """
+  key = (use_aux_headers, pch_frontend)
+  if key in _PCH_PATHS:
+    return _PCH_PATHS[key]
+
+  headers  = _GetIncludeHeaders(use_aux_headers)
+  cflags   = _GetBaseClangArgs(use_aux_headers)
+  if pch_frontend == "libclang":
+    frontend_id = "libclang-{}-{}".format(environment.LLVM_VERSION, environment.LLVM_LIB)
+  elif pch_frontend == "clang":
+    frontend_id = "clang-{}".format(clang.CLANG)
+  else:
+    raise ValueError("Unrecognized PCH frontend: {}".format(pch_frontend))
+  pch_hash = crypto.sha256_list(
+    frontend_id,
+    ' '.join(cflags),
+    *["{}:{}".format(idx, crypto.sha256_file(h)) for idx, h in enumerate(headers)],
+  )
+  pch_path = cache.cachepath("opencl_pch", "{}.pch".format(pch_hash))
+
+  try:
+    if not pch_path.exists():
+      pch_path.parent.mkdir(parents = True, exist_ok = True)
+      l.getLogger().info("Building OpenCL precompiled header for {}: {}".format(pch_frontend, pch_path))
+      clang.BuildPrecompiledHeader(headers, cflags, pch_path, use_libclang = pch_frontend == "libclang")
+    # A stale or incompatible PCH is rejected by clang. Verify it once here,
+    # so that it does not cause every kernel to be reported as uncompilable.
+    check_args = cflags + ["-include-pch", str(pch_path)]
+    if pch_frontend == "libclang":
+      clang.Compile("kernel void A(global int* a) {}", ".cl", check_args)
+    else:
+      clang.CompileLlvmBytecode("kernel void A(global int* a) {}", ".cl", check_args)
+  except ValueError as e:
+    l.getLogger().warn("OpenCL precompiled header is disabled: {}".format(e))
+    pch_path = None
+  _PCH_PATHS[key] = pch_path
+  return pch_path
+
+def GetClangArgs(use_shim: bool, use_aux_headers: bool, pch_frontend: str = None) -> typing.List[str]:
+  """Get the arguments to pass to clang for handling OpenCL.
+
+  Args:
+    use_shim: If true, inject the shim OpenCL header.
+    use_aux_headers: If true, inject the auxiliary struct definitions.
+    pch_frontend: If set and --use_opencl_pch is enabled, replace the standard
+      header includes with their precompiled header built for this frontend
+      ("libclang" or "clang").
+
+  Returns:
+    A list of command line arguments to pass to Popen().
+  """
+  pch_path = None
+  if pch_frontend and FLAGS.use_opencl_pch:
+    pch_path = GetPrecompiledHeader(use_aux_headers, pch_frontend)
+  if pch_path:
+    args = _GetBaseClangArgs(use_aux_headers) + ["-include-pch", str(pch_path)]
+  else:
+    args = _GetBaseClangArgs(use_aux_headers) + [
+      "-include{}".format(h) for h in _GetIncludeHeaders(use_aux_headers)
     ]
   if use_shim:
     args += ["-include", str(SHIMFILE)]
   return args
 
+def GetCompileCacheArgs(use_aux_headers: bool) -> typing.List[str]:
+  """Get the arguments that identify an OpenCL compilation in the compile cache.
+
+  Besides the clang flags, these cover the content of the force-included
+  headers and the clang toolchain, so that a changed header or an upgraded
+  clang does not serve stale results.
+
+  Args:
+    use_aux_headers: If true, the auxiliary struct definitions are included.
+
+  Returns:
+    A list of strings to pass to compile_cache.CompileCache.Key().
+  """
+  if use_aux_headers not in _CACHE_KEY_ARGS:
+    toolchain = ["llvm-{}".format(environment.LLVM_VERSION)]
+    for path in (clang.CLANG, environment.LLVM_LIB):
+      st = os.stat(path)
+      toolchain.append("{}:{}:{}".format(path, st.st_size, st.st_mtime_ns))
+    _CACHE_KEY_ARGS[use_aux_headers] = toolchain + _GetBaseClangArgs(use_aux_headers) + [
+      "-include{}:{}".format(h, crypto.sha256_file(h)) for h in _GetIncludeHeaders(use_aux_headers)
+    ]
+  return _CACHE_KEY_ARGS[use_aux_headers]
+
 def _ClangPreprocess(text: str, use_shim: bool, use_aux_headers: bool) -> str:
   """Private preprocess OpenCL source implementation.
 
@@ -127,7 +238,7 @@ def DeriveSourceVocab(text: str, token_list: typing.Set[str] = set()) -> typing.
   Returns:
     Set of unique source code tokens.
   """
-  return clang.DeriveSourceVocab(text, token_list, ".cl", GetClangArgs(use_shim = False, use_aux_headers=True))
+  return clang.DeriveSourceVocab(text, token_list, ".cl", GetClangArgs(use_shim = False, use_aux_headers=True, pch_frontend = "libclang"))
 
 def AtomizeSource(text: str, vocab: typing.Set[str]) -> typing.List[str]:
   """
@@ -140,7 +251,20 @@ def AtomizeSource(text: str, vocab: typing.Set[str]) -> typing.List[str]:
   Returns:
     Source code as a list of tokens.
   """
-  return clang.AtomizeSource(text, vocab, ".cl", GetClangArgs(use_shim = False, use_aux_headers=True))
+  return clang.AtomizeSource(text, vocab, ".cl", GetClangArgs(use_shim = False, use_aux_headers=True, pch_frontend = "libclang"))
+
+def AtomizeMany(texts: typing.List[str], vocab: typing.Set[str]) -> typing.List[typing.Optional[typing.List[str]]]:
+  """
+  Atomize a batch of OpenCL sources on the long-lived clang worker pool.
+
+  Args:
+    texts: The source codes to atomize.
+    vocab: Optional set of learned vocabulary of tokenizer.
+
+  Returns:
+    A list of token atoms for every source, or None where parsing failed.
+  """
+  return clang.AtomizeMany(texts, vocab, ".cl", GetClangArgs(use_shim = False, use_aux_headers=True, pch_frontend = "libclang"))
 
 @public.clgen_preprocessor
 def ClangPreprocess(text: str) -> str:
@@ -181,8 +305,8 @@ def CompileLlvmBytecode(text: str, header_file = None, use_aux_headers: bool = T
   return clang.CompileLlvmBytecode(
     text,
     ".cl",
-    GetClangArgs(use_shim=False, use_aux_headers = use_aux_headers),# + ["-Werror=implicit-function-declaration"],
-    return_diagnostics = return_diagnostics,
+    GetClangArgs(use_shim=False, use_aux_headers = use_aux_headers, pch_frontend = "clang"),# + ["-Werror=implicit-function-declaration"],
+    header_file = header_file,
   )
 
 def CompileOptimizer(text: str,
@@ -201,16 +325,41 @@ def CompileOptimizer(text: str,
   return clang.CompileOptimizer(
     src = text,
     suffix = ".cl",
-    cflags = GetClangArgs(use_shim=False, use_aux_headers = use_aux_headers),
+    cflags = GetClangArgs(use_shim=False, use_aux_headers = use_aux_headers, pch_frontend = "clang"),
     optimization = optimization,
     header_file = header_file,
   )
 
+def CompileOptimizerMany(text: str,
+                         optimizations: typing.List[typing.List[str]],
+                         timeout_seconds: int = 60,
+                         header_file: str = None,
+                         use_aux_headers: bool = True,
+                         ) -> typing.List[typing.Union[str, ValueError]]:
+  """Compile source code to IR once and apply several optimization passes to it.
+  Args:
+    src: The source code to compile.
+    optimizations: optimization passes to apply.
+  Returns:
+    Output of each pass, or the ValueError it raised.
+  Raises:
+    ValueError: If the source does not compile.
+  """
+  return clang.CompileOptimizerMany(
+    src = text,
+    suffix = ".cl",
+    cflags = GetClangArgs(use_shim=False, use_aux_headers = use_aux_headers, pch_frontend = "clang"),
+    optimizations = optimizations,
+    header_file = header_file,
+    timeout_seconds = timeout_seconds,
+  )
+
 @public.clgen_preprocessor
 def Compile(text: str, header_file = None, use_aux_headers = True, return_diagnostics = False) -> str:
   """Check that the OpenCL source compiles.
 
-  This does not modify the input.
+  This does not modify the input. Results are memoized in the shared compile
+  cache, unless return_diagnostics is set.
 
   Args:
     text: OpenCL source to check.
@@ -220,13 +369,59 @@ def Compile(text: str, header_file = None, use_aux_headers = True, return_diagno
   """
   # We must override the flag -Wno-implicit-function-declaration from
   # GetClangArgs() to ensure that undefined functions are treated as errors.
-  return clang.Compile(
-    text,
-    ".cl",
-    GetClangArgs(use_shim=False, use_aux_headers = use_aux_headers),# + ["-Werror=implicit-function-declaration"],
-    header_file = header_file,
-    return_diagnostics = return_diagnostics,
-  )
+  cflags = GetClangArgs(use_shim=False, use_aux_headers = use_aux_headers, pch_frontend = "libclang")# + ["-Werror=implicit-function-declaration"],
+  # Diagnostic locations are not cached, so that path always compiles.
+  cc = None if return_diagnostics else compile_cache.GetCompileCache()
+  if cc is None:
+    return clang.Compile(
+      text,
+      ".cl",
+      cflags,
+      header_file = header_file,
+      return_diagnostics = return_diagnostics,
+    )
+  key = cc.Key(text, GetCompileCacheArgs(use_aux_headers), header_file)
+  status, diagnostics = cc.GetCompileStatus([key]).get(key, (None, ""))
+  if status:
+    return text
+  elif status is False and diagnostics:
+    raise ValueError(diagnostics)
+  # Not cached, or a failure cached by CompileMany which keeps no diagnostics.
+  try:
+    clang.Compile(text, ".cl", cflags, header_file = header_file)
+  except ValueError as e:
+    cc.SetCompileStatus({key: (False, str(e))})
+    raise e
+  cc.SetCompileStatus({key: (True, "")})
+  return text
+
+def CompileMany(texts: typing.List[str], header_file = None, use_aux_headers = True) -> typing.List[bool]:
+  """Check a batch of OpenCL sources for whether they compile.
+
+  Sources found in the compile cache are not recompiled. The rest are
+  distributed over the long-lived clang worker pool.
+
+  Args:
+    texts: OpenCL sources to check.
+
+  Returns:
+    A list of compilation status, one for each source.
+  """
+  cflags = GetClangArgs(use_shim=False, use_aux_headers = use_aux_headers, pch_frontend = "libclang")
+  cc = compile_cache.GetCompileCache()
+  if cc is None:
+    return clang.CompileMany(texts, ".cl", cflags, header_file = header_file)
+
+  key_flags = GetCompileCacheArgs(use_aux_headers)
+  keys      = [cc.Key(text, key_flags, header_file) for text in texts]
+  cached    = cc.GetCompileStatus(keys)
+  # Compile each uncached source once, even if it appears multiple times.
+  misses    = list({k: t for k, t in zip(keys, texts) if k not in cached}.items())
+  if misses:
+    compiled = clang.CompileMany([t for _, t in misses], ".cl", cflags, header_file = header_file)
+    cc.SetCompileStatus({k: (status, "") for (k, _), status in zip(misses, compiled)})
+    cached.update({k: (status, "") for (k, _), status in zip(misses, compiled)})
+  return [cached[k][0] for k in keys]
 
 @public.clgen_preprocessor
 def ClangFormat(text: str) -> str:
@@ -1,5 +1,7 @@
 """Preprocess source code files for machine learning."""
 import importlib
+import inspect
+import os
 import pathlib
 import typing
 from importlib import util as importlib_util
@@ -7,6 +9,9 @@ from detect_secrets import main as secrets_main
 from detect_secrets.plugins.common import initialize as secrets_init
 
 from deeplearning.clgen.preprocessors import public
+from deeplearning.clgen.util import compile_cache
+from deeplearning.clgen.util import crypto
+from deeplearning.clgen.util import environment
 from absl import flags
 from eupy.native import logger as l
 
@@ -15,6 +20,9 @@ FLAGS = flags.FLAGS
 # Import type alias to public module.
 PreprocessorFunction = public.PreprocessorFunction
 
+# Digests of preprocessor pipelines, computed once per process.
+_PIPELINE_DIGESTS: typing.Dict[typing.Tuple[str, ...], str] = {}
+
 
 def _ImportPreprocessorFromFile(module_path: pathlib.Path, function_name: str):
   """Import module from an absolute path to file, e.g. '/foo/bar.py'."""
@@ -83,6 +91,31 @@ def GetPreprocessorFunction(name: str) -> public.PreprocessorFunction:
     return _ImportPreprocessorFromModule(module_name, function_name)
 
 
+def PipelineDigest(preprocessors: typing.List[str]) -> str:
+  """Digest of the code that a preprocessor pipeline runs.
+
+  Covers the source of the modules that define the preprocessors and of this
+  package, which they build on, and the size and mtime of the clang tools and
+  headers they call, so that stored outputs of a pipeline are not reused once
+  any of them changes.
+  """
+  key = tuple(preprocessors)
+  if key not in _PIPELINE_DIGESTS:
+    sources = set(pathlib.Path(__file__).parent.glob("*.py"))
+    for name in preprocessors:
+      sources.add(pathlib.Path(inspect.getsourcefile(GetPreprocessorFunction(name))))
+    toolchain = [
+      environment.CLANG, environment.CLANG_REWRITER, environment.CLANG_FORMAT, environment.LLVM_LIB,
+    ] + sorted(str(p) for p in pathlib.Path(environment.DATA_CL_INCLUDE).iterdir())
+    stats = [(path, os.stat(path)) for path in toolchain]
+    _PIPELINE_DIGESTS[key] = crypto.sha256_list(
+      "llvm-{}".format(environment.LLVM_VERSION),
+      *["{}:{}".format(p, crypto.sha256_file(p)) for p in sorted(sources)],
+      *["{}:{}:{}".format(p, st.st_size, st.st_mtime_ns) for p, st in stats],
+    )
+  return _PIPELINE_DIGESTS[key]
+
+
 def Preprocess(text: str, preprocessors: typing.List[str]) -> str:
   """Preprocess a text using the given preprocessor pipeline.
 
@@ -111,7 +144,9 @@ def Preprocess(text: str, preprocessors: typing.List[str]) -> str:
     for idx, pr in enumerate(preprocessors):
       if isinstance(text, str):
         try:
-          text = pr(text)
+          # Pipeline outputs are memoized by the preprocess cache instead.
+          with compile_cache.Bypass():
+            text = pr(text)
         except ValueError as e:
           yield str(e), False
           return
@@ -13,7 +13,13 @@
 # You should have received a copy of the GNU General Public License
 # along with clgen.  If not, see <https://www.gnu.org/licenses/>.
 """This file contains the SampleObserver interface and concrete subclasses."""
+import atexit
+import os
 import pathlib
+import time
+import typing
+
+import sqlalchemy as sql
 
 from deeplearning.clgen.proto import model_pb2
 from absl import flags
@@ -21,6 +27,7 @@ from deeplearning.clgen.util import crypto
 from deeplearning.clgen.util import pbutil
 from deeplearning.clgen.util import monitors
 from deeplearning.clgen.util import fs
+from deeplearning.clgen.util import sqlutil
 from deeplearning.clgen.samplers import samples_database
 from deeplearning.clgen.features import extractor
 
@@ -120,7 +127,14 @@ class SamplesDatabaseObserver(SampleObserver):
   """A sample observer that imports samples to a database.
 
   The observer buffers the records that it recieves and commits them to the
-  database in batches.
+  database in batches, from a background writer thread. Every process gets
+  its own writer, so an observer handed to a child process must be flushed
+  with Flush() before the child exits.
+
+  Samples are collected in chunks of commit_sample_frequency, and a chunk is
+  checked against the sha256s of the database with one query before it is
+  handed to the writer, so samples written by other processes are skipped
+  without loading the sha256s of the whole database.
   """
 
   def __init__(
@@ -133,32 +147,99 @@ class SamplesDatabaseObserver(SampleObserver):
   ):
     self.db = samples_database.SamplesDatabase("sqlite:///{}".format(str(path)), must_exist = must_exist)
     self.sample_id = self.db.count
+    self.flush_secs = flush_secs
+    self.commit_sample_frequency = commit_sample_frequency
     self.plot_sample_status = plot_sample_status
     if self.plot_sample_status:
       self.saturation_monitor = monitors.CumulativeHistMonitor(path.parent, "cumulative_sample_count")
+    self._writer     = None
+    self._writer_pid = None
+    self._pending    = None
+    self._added      = None
+    self._last_chunk = time.time()
+    return
+
+  def __getstate__(self) -> typing.Dict[str, typing.Any]:
+    # Writer threads don't cross process boundaries.
+    state = self.__dict__.copy()
+    state["_writer"]     = None
+    state["_writer_pid"] = None
+    state["_pending"]    = None
+    state["_added"]      = None
+    return state
+
+  @property
+  def writer(self) -> sqlutil.BufferedDatabaseWriter:
+    """This process's writer."""
+    if self._writer is None or self._writer_pid != os.getpid():
+      # Samples of this chunk, by sha256, and sha256s handed to the writer
+      # that it has not committed yet.
+      self._pending = {}
+      self._added   = set()
+      self._writer = sqlutil.BufferedDatabaseWriter(
+        self.db,
+        max_buffer_length       = self.commit_sample_frequency,
+        max_seconds_since_flush = self.flush_secs,
+        daemon                  = True,
+      )
+      self._writer_pid = os.getpid()
+      atexit.register(self.Flush)
+    return self._writer
 
   def OnSample(self, sample: model_pb2.Sample) -> bool:
     """Sample receive callback."""
+    # Start this process's writer, and its chunk, on its first sample.
+    self.writer
+    db_sample = samples_database.Sample(
+      **samples_database.Sample.FromProto(self.sample_id, sample)
+    )
+    self._pending.setdefault(db_sample.sha256, db_sample)
+    if (len(self._pending) >= self.commit_sample_frequency
+        or time.time() - self._last_chunk >= self.flush_secs):
+      self._WriteChunk()
+    if self.plot_sample_status:
+      self.saturation_monitor.register(self.sample_id)
+      self.saturation_monitor.plot()
+    return True
 
-    with self.db.Session(commit = True) as session:
-      db_sample = samples_database.Sample(
-        **samples_database.Sample.FromProto(self.sample_id, sample)
-      )
-      try:
-        exists = session.query(samples_database.Sample.sha256).filter_by(sha256 = db_sample.sha256).scalar() is not None
-      except sqlalchemy.orm.exc.MultipleResultsFound as e:
-        l.getLogger().error("Selected sha256 has been already found more than once.")
-        raise e
-      if not exists:
-        session.add(db_sample)
+  def Flush(self) -> None:
+    """Commit all buffered samples of this process."""
+    if self._writer is not None and self._writer_pid == os.getpid():
+      self._WriteChunk()
+      self._writer.Flush()
+    return
+
+  def _WriteChunk(self) -> None:
+    """Hand the pending samples whose sha256 is not in the database to the writer."""
+    self._last_chunk = time.time()
+    if not self._pending:
+      return
+    sha256s = list(self._pending.keys())
+    known   = set()
+    with self.db.Session() as session:
+      # Stay below SQLite's limit of 999 query parameters.
+      for i in range(0, len(sha256s), 500):
+        known.update(x for x, in session.query(samples_database.Sample.sha256).filter(
+          samples_database.Sample.sha256.in_(sha256s[i:i + 500])
+        ))
+    added = []
+    for sha256, db_sample in self._pending.items():
+      if sha256 not in known and sha256 not in self._added:
+        db_sample.id = self.sample_id
+        self._writer.AddOne(db_sample)
+        self._added.add(sha256)
+        added.append(sha256)
         self.sample_id += 1
-      if self.plot_sample_status:
-        self.saturation_monitor.register(self.sample_id)
-        self.saturation_monitor.plot()
-    return True
+    if added:
+      # Runs on the writer thread once the samples before it are committed,
+      # from then on the query above finds them.
+      self._writer.AddLambdaOp(lambda session: self._added.difference_update(added))
+    self._pending = {}
+    return
 
   def endSample(self) -> None:
     """Write final summed data about sampling session."""
+    self.Flush()
     # Create feature vector plots
     db_path = pathlib.Path(self.db.url[len("sqlite:///"):]).parent
     # feature_monitor = monitors.CategoricalDistribMonitor(db_path, "samples_feature_vector_distribution")
@@ -186,7 +267,7 @@ class SamplesDatabaseObserver(SampleObserver):
       mon.plot()
 
     with self.db.Session() as session:
-      compiled_count = session.query(samples_database.Sample.compile_status).filter_by(compile_status = 1).count()
+      compiled_count = session.query(sql.func.count(samples_database.Sample.id)).filter_by(compile_status = True).scalar()
     try:
       r = [
         'compilation rate: {}'.format(compiled_count / self.sample_id),
@@ -51,7 +51,7 @@ class Sample(Base, sqlutil.ProtoBackedMixin):
   # Encoded generated tokens
   encoded_sample_indices : str = sql.Column(sqlutil.ColumnTypes.UnboundedUnicodeText(), nullable = False)
   # Whether the generated sample compiles or not.
-  compile_status         : bool = sql.Column(sql.Boolean,  nullable = False)
+  compile_status         : bool = sql.Column(sql.Boolean,  nullable = False, index = True)
   # Sample's vector of features.
   feature_vector         : str = sql.Column(sqlutil.ColumnTypes.UnboundedUnicodeText(), nullable = False)
   # Length of total sequence in number of tokens
@@ -88,12 +88,13 @@ class SamplesDatabase(sqlutil.Database):
 
   def __init__(self, url: str, must_exist: bool = False):
     super(SamplesDatabase, self).__init__(url, Base, must_exist = must_exist)
+    self.CreateMissingIndexes()
 
   @property
   def count(self):
     """Number of samples in DB."""
     with self.Session() as s:
-      count = s.query(Sample).count()
+      count = s.query(sql.func.count(Sample.id)).scalar()
     return count
 
   @property
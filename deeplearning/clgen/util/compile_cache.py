@@ -0,0 +1,292 @@
+"""A persistent cache of compilation results and extracted features.
+
+Sampling, active learning and training re-compile and re-extract features for
+the same kernels many times. Results are keyed on the sha256 of the source,
+the compiler flags, the content of the headers and the clang toolchain (see
+opencl.GetCompileCacheArgs()) and the optional in-memory header, so any change
+in the toolchain or its arguments yields a fresh entry. The cache is shared between processes through
+an SQLite database in the clgen cache directory and it is bounded: once it
+grows past --compile_cache_size entries, the least recently used ones are
+evicted.
+
+The cache is best effort. Failures to read or write the database are logged
+and the caller falls back to compiling. Preprocessor pipelines run with the
+cache bypassed, see Bypass().
+"""
+import contextlib
+import multiprocessing
+import os
+import pathlib
+import time
+import typing
+
+import sqlalchemy as sql
+from sqlalchemy.ext import declarative
+from absl import flags
+
+from deeplearning.clgen.util import cache
+from deeplearning.clgen.util import crypto
+from deeplearning.clgen.util import sqlutil
+
+from eupy.native import logger as l
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer(
+  "compile_cache_size",
+  1000000,
+  "Maximum number of kernels kept in the on-disk compile result cache. "
+  "Least recently used entries are evicted. Set to 0 to disable the cache.",
+)
+
+Base = declarative.declarative_base()
+
+# Number of inserts between two checks of the cache size.
+EVICTION_INTERVAL = 5000
+# Minimum age, in seconds, of an entry's access time before a hit refreshes it.
+# Keeps reads from turning into writes while preserving approximate LRU order.
+TOUCH_INTERVAL = 3600
+# Maximum number of bound parameters per IN() clause.
+QUERY_CHUNK = 500
+
+# Lookups since the last ReportHitRate(), counted per source: [hits, misses].
+# Shared with the worker processes forked from this one, e.g. the clang pool.
+_LOOKUPS = multiprocessing.Array('q', 2)
+# Inserts since the last eviction check, shared like _LOOKUPS.
+_INSERTS = multiprocessing.Value('q', 0)
+
+def _CountLookups(hits: int, misses: int) -> None:
+  with _LOOKUPS.get_lock():
+    _LOOKUPS[0] += hits
+    _LOOKUPS[1] += misses
+  return
+
+def ReportHitRate() -> None:
+  """Log the hit rate of the lookups since the last report and reset it.
+
+  Lookups are counted per source, in this process and in the worker
+  processes forked from it.
+  """
+  with _LOOKUPS.get_lock():
+    hits, misses = _LOOKUPS[0], _LOOKUPS[1]
+    _LOOKUPS[0], _LOOKUPS[1] = 0, 0
+  if hits + misses > 0:
+    l.getLogger().info("Compile cache: {} hits, {} misses, hit rate {:.2f}%".format(
+      hits, misses, 100 * hits / (hits + misses))
+    )
+  return
+
+class CompileResult(Base):
+  """Compilation status of a single source."""
+  __tablename__ = "compile_results"
+  # sha256 of source, compiler flags and header.
+  sha256         : str  = sql.Column(sql.String(64), primary_key = True)
+  # Whether the source compiles.
+  compile_status : bool = sql.Column(sql.Boolean, nullable = False)
+  # Compiler errors, empty if the source compiles.
+  diagnostics    : str  = sql.Column(sqlutil.ColumnTypes.UnboundedUnicodeText(), nullable = False)
+  # Seconds since epoch of the last time the entry was read or written.
+  last_access    : int  = sql.Column(sql.Integer, nullable = False, index = True)
+
+class RawFeatures(Base):
+  """Raw output of one feature extractor for a single source."""
+  __tablename__ = "raw_features"
+  # sha256 of source, compiler flags and header.
+  sha256       : str = sql.Column(sql.String(64), primary_key = True)
+  # Name of the feature extractor.
+  extractor    : str = sql.Column(sql.String(64), primary_key = True)
+  # Raw string output of the extractor.
+  raw_features : str = sql.Column(sqlutil.ColumnTypes.UnboundedUnicodeText(), nullable = False)
+  # Seconds since epoch of the last time the entry was read or written.
+  last_access  : int = sql.Column(sql.Integer, nullable = False, index = True)
+
+def _Chunks(items: typing.List[typing.Any]) -> typing.Iterator[typing.List[typing.Any]]:
+  for idx in range(0, len(items), QUERY_CHUNK):
+    yield items[idx: idx + QUERY_CHUNK]
+
+class CompileCache(sqlutil.Database):
+  """Disk-backed cache of compile status, diagnostics and raw features."""
+
+  def __init__(self, path: pathlib.Path, max_entries: int):
+    """Instantiate a compile cache.
+
+    Args:
+      path: Path of the SQLite database.
+      max_entries: Maximum number of entries kept per table.
+    """
+    super(CompileCache, self).__init__(f"sqlite:///{path.absolute()}", Base)
+    self.max_entries = max_entries
+    return
+
+  @staticmethod
+  def Key(src: str, cflags: typing.List[str], header_file: str = None) -> str:
+    """Compute the cache key of a source compiled with the given arguments.
+
+    cflags must identify the toolchain and the content of included headers,
+    header_file is the content of the in-memory header.
+    """
+    return crypto.sha256_str("{}\0{}\0{}".format(' '.join(cflags), header_file or "", src))
+
+  def GetCompileStatus(self,
+                       keys: typing.List[str],
+                       ) -> typing.Dict[str, typing.Tuple[bool, str]]:
+    """Look up compile results.
+
+    Returns:
+      Mapping from each cached key to (compile_status, diagnostics). Missing
+      keys are absent.
+    """
+    results = {}
+    try:
+      with self.Session(commit = True) as session:
+        for chunk in _Chunks(list(set(keys))):
+          rows = session.query(
+            CompileResult.sha256, CompileResult.compile_status,
+            CompileResult.diagnostics, CompileResult.last_access,
+          ).filter(CompileResult.sha256.in_(chunk)).all()
+          stale = []
+          for sha, status, diagnostics, last_access in rows:
+            results[sha] = (status, diagnostics)
+            if last_access < int(time.time()) - TOUCH_INTERVAL:
+              stale.append(sha)
+          if stale:
+            session.query(CompileResult).filter(
+              CompileResult.sha256.in_(stale)
+            ).update({CompileResult.last_access: int(time.time())}, synchronize_session = False)
+    except sql.exc.OperationalError as e:
+      l.getLogger().warn("Compile cache lookup failed: {}".format(e))
+    hits = sum(1 for k in keys if k in results)
+    _CountLookups(hits, len(keys) - hits)
+    return results
+
+  def SetCompileStatus(self, entries: typing.Dict[str, typing.Tuple[bool, str]]) -> None:
+    """Store compile results, given a mapping key -> (compile_status, diagnostics)."""
+    if not entries:
+      return
+    now = int(time.time())
+    try:
+      with self.Session(commit = True) as session:
+        for key, (status, diagnostics) in entries.items():
+          session.merge(
+            CompileResult(
+              sha256         = key,
+              compile_status = status,
+              diagnostics    = diagnostics,
+              last_access    = now,
+            )
+          )
+        self._MaybeEvict(session, len(entries))
+    except sql.exc.OperationalError as e:
+      l.getLogger().warn("Compile cache write failed: {}".format(e))
+    return
+
+  def GetRawFeatures(self, key: str, extractors: typing.List[str]) -> typing.Dict[str, str]:
+    """Look up the cached raw features of a source for a list of extractors."""
+    results = {}
+    try:
+      with self.Session(commit = True) as session:
+        rows = session.query(
+          RawFeatures.extractor, RawFeatures.raw_features, RawFeatures.last_access
+        ).filter(RawFeatures.sha256 == key).filter(RawFeatures.extractor.in_(extractors)).all()
+        stale = []
+        for ext, raw, last_access in rows:
+          results[ext] = raw
+          if last_access < int(time.time()) - TOUCH_INTERVAL:
+            stale.append(ext)
+        if stale:
+          session.query(RawFeatures).filter(RawFeatures.sha256 == key).filter(
+            RawFeatures.extractor.in_(stale)
+          ).update({RawFeatures.last_access: int(time.time())}, synchronize_session = False)
+    except sql.exc.OperationalError as e:
+      l.getLogger().warn("Compile cache lookup failed: {}".format(e))
+    # A source is a hit if the features of every extractor are cached.
+    hit = all(x in results for x in extractors)
+    _CountLookups(int(hit), int(not hit))
+    return results
+
+  def SetRawFeatures(self, key: str, features: typing.Dict[str, str]) -> None:
+    """Store raw features of a source, given a mapping extractor -> raw output."""
+    if not features:
+      return
+    now = int(time.time())
+    try:
+      with self.Session(commit = True) as session:
+        for ext, raw in features.items():
+          session.merge(
+            RawFeatures(
+              sha256       = key,
+              extractor    = ext,
+              raw_features = raw,
+              last_access  = now,
+            )
+          )
+        self._MaybeEvict(session, len(features))
+    except sql.exc.OperationalError as e:
+      l.getLogger().warn("Compile cache write failed: {}".format(e))
+    return
+
+  def _MaybeEvict(self, session: sqlutil.Session, num_inserts: int) -> None:
+    """Every EVICTION_INTERVAL inserts, trim both tables to max_entries rows.
+
+    Exactly the least recently used excess rows are deleted. Access times are
+    in whole seconds, so a cutoff time would also take every row written with
+    it.
+    """
+    with _INSERTS.get_lock():
+      _INSERTS.value += num_inserts
+      if _INSERTS.value < EVICTION_INTERVAL:
+        return
+      _INSERTS.value = 0
+    for table in (CompileResult, RawFeatures):
+      excess = session.query(sql.func.count()).select_from(table).scalar() - self.max_entries
+      if excess > 0:
+        session.execute(
+          sql.text(
+            "DELETE FROM {0} WHERE rowid IN "
+            "(SELECT rowid FROM {0} ORDER BY last_access LIMIT :excess)".format(table.__tablename__)
+          ),
+          {"excess": excess},
+        )
+        l.getLogger().info("Compile cache: evicted {} {} entries.".format(excess, table.__tablename__))
+    return
+
+_CACHE : typing.Optional[CompileCache] = None
+_CACHE_PID : typing.Optional[int] = None
+# Nesting depth of Bypass() in this process.
+_BYPASS : int = 0
+
+@contextlib.contextmanager
+def Bypass() -> typing.Iterator[None]:
+  """Disable the compile cache of this process within the context.
+
+  Outputs of preprocessor pipelines are cached whole by the preprocess cache,
+  which is written in batches by the importing process. Preprocessors that
+  compile, e.g. opencl.Compile, run in this context, so that every
+  preprocessing worker does not also look up and write each kernel in the
+  compile cache.
+  """
+  global _BYPASS
+  _BYPASS += 1
+  try:
+    yield
+  finally:
+    _BYPASS -= 1
+  return
+
+def GetCompileCache() -> typing.Optional[CompileCache]:
+  """Get this process's handle of the shared compile cache.
+
+  Database engines do not survive a fork, so a child process opens its own
+  handle the first time it asks for one.
+
+  Returns:
+    The cache, or None if it is disabled or bypassed.
+  """
+  global _CACHE
+  global _CACHE_PID
+  if FLAGS.compile_cache_size <= 0 or _BYPASS > 0:
+    return None
+  if _CACHE is None or _CACHE_PID != os.getpid():
+    _CACHE     = CompileCache(cache.cachepath("compile_cache.db"), FLAGS.compile_cache_size)
+    _CACHE_PID = os.getpid()
+  return _CACHE
@@ -0,0 +1,132 @@
+"""Parallel, incremental discovery of files in a directory tree.
+
+Directories are listed with os.scandir() on a pool of threads, which release
+the GIL while they wait on the filesystem, and the stat results of the
+DirEntry objects are reused instead of stat-ing every path again. Every
+directory's listing is recorded in a manifest along with the directory's
+mtime. A later walk with the same manifest only stats directories whose
+mtime is unchanged, and reuses their recorded listing, which is the same
+idea as hashcache.GetDirectoryMTime().
+
+A directory's mtime changes when entries are created, deleted or renamed in
+it, but not when a file is rewritten in place. Walks that need the current
+mtime of every file must pass refresh = True.
+"""
+import concurrent.futures
+import os
+import pathlib
+import pickle
+import typing
+
+from eupy.native import logger as l
+
+class FileEntry(typing.NamedTuple):
+  """A file found by Walk()."""
+  path     : str
+  mtime_ns : int
+  size     : int
+
+class _DirListing(typing.NamedTuple):
+  mtime_ns : int
+  # (name, mtime_ns, size) of matching files.
+  files    : typing.List[typing.Tuple[str, int, int]]
+  subdirs  : typing.List[str]
+
+class Manifest(object):
+  """Listings of the directories of a tree, persisted between walks."""
+
+  def __init__(self, root: pathlib.Path, path: typing.Optional[pathlib.Path] = None):
+    self.root     = str(root)
+    self.path     = path
+    self.listings = {}
+    if path is not None and path.exists():
+      try:
+        with open(path, 'rb') as infile:
+          data = pickle.load(infile)
+        if data["root"] == self.root:
+          self.listings = data["listings"]
+      except Exception as e:
+        l.getLogger().warn("Ignoring unreadable manifest {}: {}".format(path, e))
+    return
+
+  def Save(self) -> None:
+    if self.path is None:
+      return
+    tmp = self.path.with_suffix(".tmp")
+    with open(tmp, 'wb') as outf:
+      pickle.dump({"root": self.root, "listings": self.listings}, outf, protocol = pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, self.path)
+    return
+
+def _ScanDirectory(path: str,
+                   suffixes: typing.Optional[typing.Set[str]],
+                   previous: typing.Optional[_DirListing],
+                   ) -> typing.Optional[_DirListing]:
+  """List a directory, or reuse its previous listing if it has not changed."""
+  try:
+    mtime_ns = os.stat(path).st_mtime_ns
+    if previous is not None and previous.mtime_ns == mtime_ns:
+      return previous
+    files, subdirs = [], []
+    with os.scandir(path) as it:
+      for entry in it:
+        if entry.is_symlink():
+          continue
+        elif entry.is_file(follow_symlinks = False):
+          if suffixes is None or os.path.splitext(entry.name)[1] in suffixes:
+            st = entry.stat(follow_symlinks = False)
+            files.append((entry.name, st.st_mtime_ns, st.st_size))
+        elif entry.is_dir(follow_symlinks = False):
+          subdirs.append(entry.name)
+    return _DirListing(mtime_ns, files, subdirs)
+  except OSError:
+    return None
+
+def Walk(root: pathlib.Path,
+         suffixes: typing.Optional[typing.Set[str]],
+         manifest_path: typing.Optional[pathlib.Path] = None,
+         refresh: bool = False,
+         num_threads: typing.Optional[int] = None,
+         ) -> typing.Iterator[FileEntry]:
+  """Yield the files of a tree whose suffix is in suffixes.
+
+  Symlinks are not followed. Unreadable directories are skipped. The
+  manifest is updated once the walk completes.
+
+  Args:
+    root: The directory to walk.
+    suffixes: File suffixes to match, e.g. {'.c', '.cl'}, or None for all files.
+    manifest_path: If set, where the manifest of the tree is kept.
+    refresh: If True, list every directory, ignoring the manifest.
+    num_threads: Number of concurrent directory listings.
+
+  Returns:
+    An iterator over files, in no particular order, with absolute paths.
+  """
+  manifest = Manifest(root, manifest_path)
+  listings = {}
+  root = str(root)
+  num_threads = num_threads or min(32, 4 * (os.cpu_count() or 1))
+  with concurrent.futures.ThreadPoolExecutor(num_threads) as pool:
+    def submit(reldir: str) -> concurrent.futures.Future:
+      previous = None if refresh else manifest.listings.get(reldir)
+      future = pool.submit(_ScanDirectory, os.path.join(root, reldir), suffixes, previous)
+      future.reldir = reldir
+      return future
+
+    pending = {submit("")}
+    while pending:
+      done, pending = concurrent.futures.wait(pending, return_when = concurrent.futures.FIRST_COMPLETED)
+      for future in done:
+        listing = future.result()
+        if listing is None:
+          continue
+        listings[future.reldir] = listing
+        dirpath = os.path.join(root, future.reldir)
+        for subdir in listing.subdirs:
+          pending.add(submit(os.path.join(future.reldir, subdir)))
+        for name, mtime_ns, size in listing.files:
+          yield FileEntry(os.path.join(dirpath, name), mtime_ns, size)
+  manifest.listings = listings
+  manifest.Save()
+  return
@@ -53,6 +53,13 @@ class Distribution():
   def sample(self, length = None):
     raise NotImplementedError
 
+  def sample_batch(self,
+                   lengths: np.array,
+                   rngen: np.random.RandomState = None,
+                   ) -> np.array:
+    """Draw one sample per entry of lengths. Subclasses override with a vectorized draw."""
+    return np.array([self.sample(length) for length in lengths], dtype = np.int64)
+
   def register(self, actual_sample):
     if isinstance(actual_sample, list):
       for s in actual_sample:
@@ -97,6 +104,18 @@ class UniformDistribution(Distribution):
     else:
       raise ValueErrror("One of sample length and upper length must be specified.")
 
+  def sample_batch(self,
+                   lengths: np.array,
+                   rngen: np.random.RandomState = None,
+                   ) -> np.array:
+    rngen = rngen or np.random.RandomState()
+    if self.sample_length:
+      return rngen.randint(0, self.sample_length + 1, size = len(lengths)).astype(np.int64)
+    elif self.relative_length:
+      return rngen.randint(0, (np.asarray(lengths) * self.relative_length).astype(np.int64)).astype(np.int64)
+    else:
+      raise ValueError("One of sample length and upper length must be specified.")
+
 class NormalDistribution(Distribution):
   """
   Normal distribution sampler. Initialized with mean, variance.
@@ -121,6 +140,19 @@ class NormalDistribution(Distribution):
       sample = int(round(np.random.RandomState().normal(loc = self.mean, scale = self.variance)))
     return sample
 
+  def sample_batch(self,
+                   lengths: np.array,
+                   rngen: np.random.RandomState = None,
+                   ) -> np.array:
+    rngen   = rngen or np.random.RandomState()
+    samples = np.full(len(lengths), -1, dtype = np.int64)
+    # Redraw rejected samples until all of them fall within [0, sample_length].
+    rejected = np.arange(len(lengths))
+    while len(rejected) > 0:
+      samples[rejected] = np.round(rngen.normal(loc = self.mean, scale = self.variance, size = len(rejected)))
+      rejected = rejected[(samples[rejected] < 0) | (samples[rejected] > self.sample_length)]
+    return samples
+
   class ProgLinearDistribution(Distribution):
     """
     A sampling distribution used in training per stage mode.
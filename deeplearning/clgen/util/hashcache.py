@@ -16,21 +16,30 @@
 Checksums files and directories and cache results. If a file or directory has
 not been modified, subsequent hashes are cache hits. Hashes are recomputed
 lazily, when a directory (or any of its subdirectories) have been modified.
+
+Directories are hashed as Merkle trees: the digest of a directory combines
+the names and hashes of its files with the names and digests of its
+subdirectories. File hashes are cached individually, keyed on the file's
+mtime and size, so only files that changed are read again.
 """
+import collections
+import concurrent.futures
+import hashlib
 import os
 import pathlib
 import subprocess
 import time
 import typing
 import humanize
-import checksumdir
 import sqlalchemy as sql
 from sqlalchemy.ext import declarative
 
 from deeplearning.clgen.util import crypto
-from deeplearning.clgen.util import fs
+from deeplearning.clgen.util import dirscan
 from deeplearning.clgen.util import sqlutil
 
+from eupy.native import logger as l
+
 Base = declarative.declarative_base()
 
 class InMemoryCacheKey(typing.NamedTuple):
@@ -60,6 +69,21 @@ class HashCacheRecord(Base):
   hash: str = sql.Column(sql.String(64), nullable=False)
 
 
+class HashCacheFileRecord(Base):
+  """A hashed file of a directory digest."""
+
+  __tablename__ = "file_entries"
+
+  # The absolute path to the file.
+  absolute_path : str = sql.Column(sql.String(4096), primary_key=True)
+  # Nanoseconds since the epoch that the file was last modified.
+  mtime_ns      : int = sql.Column(sql.BigInteger, nullable=False)
+  # Size of the file in bytes.
+  size          : int = sql.Column(sql.BigInteger, nullable=False)
+  # The cached hash in hexadecimal encoding.
+  hash          : str = sql.Column(sql.String(64), nullable=False)
+
+
 def GetDirectoryMTime(path: pathlib.Path) -> int:
   """Get the timestamp of the most recently modified file/dir in directory.
 
@@ -146,7 +170,7 @@ class HashCache(sqlutil.Database):
     if path.is_file():
       return self._HashFile(path)
     elif path.is_dir():
-      return self._HashDirectory(path)
+      return self.GetDirectoryDigest(path)
     else:
       raise FileNotFoundError(f"File not found: '{path}'")
 
@@ -161,16 +185,114 @@ class HashCache(sqlutil.Database):
     with self.Session(commit=True) as session:
       session.query(HashCacheRecord).delete()
 
-  def _HashDirectory(self, absolute_path: pathlib.Path) -> str:
-    if fs.directory_is_empty(absolute_path):
-      last_modified_fn = lambda path: int(time.time())
-    else:
-      last_modified_fn = lambda path: GetDirectoryMTime(path)
-    return self._InMemoryWrapper(
-      absolute_path,
-      last_modified_fn,
-      lambda x: checksumdir.dirhash(x, self.hash_fn_name),
+  def GetDirectoryDigest(self,
+                         path: pathlib.Path,
+                         num_threads: typing.Optional[int] = None,
+                         ) -> str:
+    """Get the Merkle digest of the files in a directory tree.
+
+    Every file is stat-ed, but only files whose mtime or size differ from
+    their cache entry are read and hashed again, on a pool of threads.
+    Symlinks and empty directories are ignored.
+
+    Args:
+      path: Path to the directory.
+      num_threads: Number of files hashed concurrently.
+
+    Returns:
+      Hexadecimal string hash.
+
+    Raises:
+      FileNotFoundError: If the directory does not exist.
+    """
+    if not path.is_dir():
+      raise FileNotFoundError(f"Directory not found: '{path}'")
+    root = str(path.absolute())
+    if self.keep_in_memory:
+      in_memory_key = InMemoryCacheKey(self.hash_fn_name, root)
+      if in_memory_key in IN_MEMORY_CACHE:
+        return IN_MEMORY_CACHE[in_memory_key]
+    start_time = time.time()
+
+    files = {
+      entry.path: entry for entry in dirscan.Walk(pathlib.Path(root), None, num_threads = num_threads)
+    }
+    # Cache entries of the tree are a range of the primary key.
+    prefix = root.rstrip(os.sep) + os.sep
+    with self.Session() as session:
+      cached = {
+        p: (mtime_ns, size, hash_) for p, mtime_ns, size, hash_ in session.query(
+          HashCacheFileRecord.absolute_path,
+          HashCacheFileRecord.mtime_ns,
+          HashCacheFileRecord.size,
+          HashCacheFileRecord.hash,
+        ).filter(
+          HashCacheFileRecord.absolute_path >= prefix,
+          HashCacheFileRecord.absolute_path < prefix[:-1] + chr(ord(os.sep) + 1),
+        )
+      }
+    hashes = {}
+    stale  = []
+    for p, entry in files.items():
+      if p in cached and cached[p][:2] == (entry.mtime_ns, entry.size):
+        hashes[p] = cached[p][2]
+      else:
+        stale.append(p)
+    with concurrent.futures.ThreadPoolExecutor(num_threads or min(32, 4 * (os.cpu_count() or 1))) as pool:
+      for p, hash_ in zip(stale, pool.map(self.hash_fn_file, stale)):
+        hashes[p] = hash_
+    self._UpdateFileRecords(
+      [p for p in cached if p not in files],
+      [
+        {"absolute_path": p, "mtime_ns": files[p].mtime_ns, "size": files[p].size, "hash": hashes[p]}
+        for p in stale
+      ],
     )
+    digest = self._MerkleDigest(root, hashes)
+    l.getLogger().info("Hashed {}: {} files, {} changed, in {} ms.".format(
+      root, humanize.intcomma(len(files)), humanize.intcomma(len(stale)),
+      humanize.intcomma(int((time.time() - start_time) * 1000)),
+    ))
+    if self.keep_in_memory:
+      IN_MEMORY_CACHE[in_memory_key] = digest
+    return digest
+
+  def _UpdateFileRecords(self,
+                         deleted: typing.List[str],
+                         updated: typing.List[typing.Dict[str, typing.Any]],
+                         ) -> None:
+    """Delete the file entries of deleted paths and replace those of updated ones."""
+    paths = deleted + [x["absolute_path"] for x in updated]
+    with self.Session(commit=True) as session:
+      for idx in range(0, len(paths), 500):
+        session.query(HashCacheFileRecord).filter(
+          HashCacheFileRecord.absolute_path.in_(paths[idx: idx + 500])
+        ).delete(synchronize_session=False)
+      session.bulk_insert_mappings(HashCacheFileRecord, updated)
+    return
+
+  def _MerkleDigest(self, root: str, hashes: typing.Dict[str, str]) -> str:
+    """Combine file hashes bottom-up into the digest of root."""
+    children = collections.defaultdict(list)
+    for p, hash_ in hashes.items():
+      dirname, name = os.path.split(os.path.relpath(p, root))
+      children[dirname].append(("f", name, hash_))
+    # Directories that only hold subdirectories.
+    for dirname in list(children.keys()):
+      while dirname:
+        dirname = os.path.dirname(dirname)
+        children.setdefault(dirname, [])
+    children.setdefault("", [])
+    depth = lambda d: d.count(os.sep) + 1 if d else 0
+    # Deepest directories first, so subdirectory digests are complete.
+    for dirname in sorted(children, key = depth, reverse = True):
+      h = hashlib.new(self.hash_fn_name)
+      for kind, name, hash_ in sorted(children[dirname]):
+        h.update(f"{kind} {name} {hash_}\n".encode("utf-8", "surrogateescape"))
+      if not dirname:
+        return h.hexdigest()
+      parent, name = os.path.split(dirname)
+      children[parent].append(("d", name, h.hexdigest()))
 
   def _HashFile(self, absolute_path: pathlib.Path) -> str:
     return self._InMemoryWrapper(
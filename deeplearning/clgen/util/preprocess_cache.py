@@ -0,0 +1,199 @@
+"""A persistent, content-addressed cache of preprocessing results.
+
+Corpora mined from the same sources share most of their files, and re-running
+the clang/rewriter pipeline on identical content is the dominant cost of
+importing a corpus. Results are keyed on the sha256 of the input content, the
+names of the preprocessors and a digest of the code and toolchain they run
+(see preprocessors.PipelineDigest()), so they are shared between all corpora
+that use the same pipeline, and any change of the pipeline yields fresh
+entries. Worker processes only read the cache, their new entries are written
+in batches by the parent through a CacheWriter. The
+cache lives in an SQLite database in the clgen cache directory and it is
+bounded: once it grows past --preprocess_cache_size entries, the least
+recently used ones are evicted.
+
+The cache is best effort. Failures to read or write the database are logged
+and the caller falls back to preprocessing.
+"""
+import json
+import os
+import pathlib
+import time
+import typing
+
+import sqlalchemy as sql
+from sqlalchemy.ext import declarative
+from absl import flags
+
+from deeplearning.clgen.util import cache
+from deeplearning.clgen.util import crypto
+from deeplearning.clgen.util import sqlutil
+
+from eupy.native import logger as l
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer(
+  "preprocess_cache_size",
+  10000000,
+  "Maximum number of input files kept in the on-disk preprocessing cache. "
+  "Least recently used entries are evicted. Set to 0 to disable the cache.",
+)
+
+Base = declarative.declarative_base()
+
+# Number of inserts between two checks of the cache size.
+EVICTION_INTERVAL = 5000
+# Minimum age, in seconds, of an entry's access time before a hit refreshes it.
+TOUCH_INTERVAL = 3600
+# Number of entries a CacheWriter writes per transaction.
+WRITE_BATCH_SIZE = 1000
+
+class PreprocessResult(Base):
+  """Output of a preprocessor pipeline for a single input."""
+  __tablename__ = "preprocess_results"
+  # sha256 of input content and preprocessor pipeline.
+  sha256      : str = sql.Column(sql.String(64), primary_key = True)
+  # JSON list of [text, preprocessing_succeeded] pairs, one per output file.
+  outputs     : str = sql.Column(sqlutil.ColumnTypes.UnboundedUnicodeText(), nullable = False)
+  # Seconds since epoch of the last time the entry was read or written.
+  last_access : int = sql.Column(sql.Integer, nullable = False, index = True)
+
+class PreprocessCache(sqlutil.Database):
+  """Disk-backed cache of preprocessor pipeline outputs."""
+
+  def __init__(self, path: pathlib.Path, max_entries: int):
+    """Instantiate a preprocessing cache.
+
+    Args:
+      path: Path of the SQLite database.
+      max_entries: Maximum number of entries kept.
+    """
+    super(PreprocessCache, self).__init__(f"sqlite:///{path.absolute()}", Base)
+    self.max_entries = max_entries
+    self.hits        = 0
+    self.misses      = 0
+    self._inserts    = 0
+    return
+
+  @staticmethod
+  def Key(input_sha256: str, preprocessors: typing.List[str], pipeline_digest: str) -> str:
+    """Compute the cache key of an input preprocessed by a pipeline.
+
+    pipeline_digest identifies the code of the pipeline, see
+    preprocessors.PipelineDigest().
+    """
+    return crypto.sha256_str("{}\0{}\0{}".format(input_sha256, '\n'.join(preprocessors), pipeline_digest))
+
+  def Get(self, key: str) -> typing.Optional[typing.List[typing.Tuple[str, bool]]]:
+    """Look up the (text, preprocessing_succeeded) outputs of an input, or None."""
+    outputs = None
+    try:
+      with self.Session(commit = True) as session:
+        entry = session.query(PreprocessResult).filter(PreprocessResult.sha256 == key).first()
+        if entry is not None:
+          outputs = [(text, success) for text, success in json.loads(entry.outputs)]
+          if entry.last_access < int(time.time()) - TOUCH_INTERVAL:
+            entry.last_access = int(time.time())
+    except sql.exc.OperationalError as e:
+      l.getLogger().warn("Preprocess cache lookup failed: {}".format(e))
+    if outputs is None:
+      self.misses += 1
+    else:
+      self.hits += 1
+    return outputs
+
+  def SetMany(self, entries: typing.List[typing.Tuple[str, typing.List[typing.Tuple[str, bool]]]]) -> None:
+    """Store the (text, preprocessing_succeeded) outputs of inputs, given (key, outputs) pairs."""
+    if not entries:
+      return
+    now = int(time.time())
+    try:
+      with self.Session(commit = True) as session:
+        for key, outputs in entries:
+          session.merge(
+            PreprocessResult(
+              sha256      = key,
+              outputs     = json.dumps([[text, success] for text, success in outputs]),
+              last_access = now,
+            )
+          )
+        self._MaybeEvict(session, len(entries))
+    except sql.exc.OperationalError as e:
+      l.getLogger().warn("Preprocess cache write failed: {}".format(e))
+    return
+
+  def _MaybeEvict(self, session: sqlutil.Session, num_inserts: int) -> None:
+    """Every EVICTION_INTERVAL inserts, trim the cache to max_entries rows.
+
+    Exactly the least recently used excess rows are deleted, access times are
+    in whole seconds and a batch of entries shares one.
+    """
+    self._inserts += num_inserts
+    if self._inserts < EVICTION_INTERVAL:
+      return
+    self._inserts = 0
+    excess = session.query(sql.func.count()).select_from(PreprocessResult).scalar() - self.max_entries
+    if excess > 0:
+      session.execute(
+        sql.text(
+          "DELETE FROM {0} WHERE rowid IN "
+          "(SELECT rowid FROM {0} ORDER BY last_access LIMIT :excess)".format(PreprocessResult.__tablename__)
+        ),
+        {"excess": excess},
+      )
+      l.getLogger().info("Preprocess cache: evicted {} entries.".format(excess))
+    return
+
+  def __repr__(self) -> str:
+    total = self.hits + self.misses
+    return "Preprocess cache: {} hits, {} misses, hit rate {:.2f}%".format(
+      self.hits, self.misses, 100 * self.hits / total if total else 0.0
+    )
+
+class CacheWriter(object):
+  """Writes the cache entries of worker processes from a single process.
+
+  Workers look results up in the cache, but send the outputs of their misses
+  back with their results instead of writing them, so that they don't queue
+  on the SQLite write lock. Entries are written WRITE_BATCH_SIZE at a time.
+  """
+
+  def __init__(self, pcache: typing.Optional[PreprocessCache]):
+    self.pcache  = pcache
+    self.entries = []
+    return
+
+  def Add(self, entries: typing.List[typing.Tuple[str, typing.List[typing.Tuple[str, bool]]]]) -> None:
+    """Queue (key, outputs) pairs, writing them once a batch is full."""
+    if self.pcache is None:
+      return
+    self.entries += entries
+    if len(self.entries) >= WRITE_BATCH_SIZE:
+      self.Flush()
+    return
+
+  def Flush(self) -> None:
+    """Write the queued entries."""
+    if self.pcache is not None and self.entries:
+      self.pcache.SetMany(self.entries)
+    self.entries = []
+    return
+
+_CACHE : typing.Optional[PreprocessCache] = None
+_CACHE_PID : typing.Optional[int] = None
+
+def GetPreprocessCache() -> typing.Optional[PreprocessCache]:
+  """Get this process's handle of the shared preprocessing cache.
+
+  Returns:
+    The cache, or None if it is disabled.
+  """
+  global _CACHE
+  global _CACHE_PID
+  if FLAGS.preprocess_cache_size <= 0:
+    return None
+  if _CACHE is None or _CACHE_PID != os.getpid():
+    _CACHE     = PreprocessCache(cache.cachepath("preprocess_cache.db"), FLAGS.preprocess_cache_size)
+    _CACHE_PID = os.getpid()
+  return _CACHE
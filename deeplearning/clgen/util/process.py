@@ -1,4 +1,6 @@
 import multiprocessing
+import threading
+import typing
 
 def isolate(process: callable, **kwargs) -> None:
   """
@@ -13,4 +15,68 @@ def isolate(process: callable, **kwargs) -> None:
   pr = multiprocessing.Process(target = process, **kwargs)
   pr.start()
   pr.join()
-  return
\ No newline at end of file
+  return
+
+class ThrottledMap(object):
+  """
+  Pool.imap_unordered over a lazy iterable of jobs, with a bounded number of
+  jobs in flight.
+
+  The task feeder of a pool drains its input eagerly. Here it blocks once
+  max_in_flight jobs are waiting for their result to be consumed. Stop() must
+  be called before the pool is terminated: Pool.terminate() joins the feeder
+  thread, which would otherwise wait for a free slot forever.
+
+    results = ThrottledMap(pool, worker, jobs, 64)
+    try:
+      for result in results:
+        ...
+    except Exception:
+      results.Stop()
+      pool.terminate()
+      raise
+  Args:
+    pool: multiprocessing.Pool to run the jobs on.
+    worker: callable, applied to every job.
+    jobs: iterable of jobs, read as the pool needs them.
+    max_in_flight: Maximum number of jobs handed to the pool but not consumed.
+    chunksize: See Pool.imap_unordered.
+  """
+  # Seconds between checks of the stop flag by a blocked feeder.
+  POLL_SECS = 0.1
+
+  def __init__(self,
+               pool: multiprocessing.Pool,
+               worker: typing.Callable[[typing.Any], typing.Any],
+               jobs: typing.Iterable[typing.Any],
+               max_in_flight: int,
+               chunksize: int = 1,
+               ):
+    self._in_flight = threading.BoundedSemaphore(max_in_flight)
+    self._stopped   = threading.Event()
+    self._results   = pool.imap_unordered(worker, self._Feed(iter(jobs)), chunksize = chunksize)
+    return
+
+  def __iter__(self) -> typing.Iterator[typing.Any]:
+    try:
+      for result in self._results:
+        self._in_flight.release()
+        yield result
+    finally:
+      self.Stop()
+    return
+
+  def Stop(self) -> None:
+    """Stop feeding jobs to the pool, so that it can be terminated."""
+    self._stopped.set()
+    return
+
+  def _Feed(self, jobs: typing.Iterator[typing.Any]) -> typing.Iterator[typing.Any]:
+    for job in jobs:
+      while not self._in_flight.acquire(timeout = self.POLL_SECS):
+        if self._stopped.is_set():
+          return
+      if self._stopped.is_set():
+        return
+      yield job
+    return
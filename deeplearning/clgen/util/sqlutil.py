@@ -13,6 +13,7 @@
 # limitations under the License.
 """Utility code for working with sqlalchemy."""
 import contextlib
+import functools
 import os
 import pathlib
 import queue
@@ -22,6 +23,7 @@ import sys
 import threading
 import time
 import typing
+import uuid
 from typing import Callable
 from typing import List
 from typing import Optional
@@ -35,6 +37,8 @@ from sqlalchemy.ext import declarative
 
 from deeplearning.clgen.util import pbutil
 
+from eupy.native import logger as l
+
 FLAGS = absl_flags.FLAGS
 
 absl_flags.DEFINE_boolean(
@@ -76,6 +80,37 @@ absl_flags.DEFINE_boolean(
   "constraints, and enables cascaded update/delete statements. See: "
   "https://docs.sqlalchemy.org/en/13/dialects/sqlite.html#foreign-key-support",
 )
+absl_flags.DEFINE_enum(
+  "sqlite_profile",
+  "default",
+  ["default", "wal", "performance"],
+  "PRAGMA profile of SQLite connections. Databases that select a profile of "
+  "their own, e.g. the corpora, use it unless this flag is given. "
+  "'default' keeps SQLite's settings: rollback journal and synchronous=FULL. "
+  "'wal' switches to a write-ahead log with synchronous=NORMAL, which lets "
+  "readers run concurrently with a writer, and waits for locks instead of "
+  "failing. 'performance' adds a larger page cache, memory-mapped reads and "
+  "in-memory temporary tables. WAL does not work on network filesystems.",
+)
+
+# PRAGMAs applied to every new connection of an SQLite database, per profile.
+SQLITE_PROFILES = {
+  "default": [],
+  "wal": [
+    ("busy_timeout", 60000),
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+  ],
+  "performance": [
+    ("busy_timeout", 60000),
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    # Negative sizes are in KiB.
+    ("cache_size", -64 * 1024),
+    ("mmap_size", 256 * 1024 * 1024),
+    ("temp_store", "MEMORY"),
+  ],
+}
 
 # The Query type is returned by Session.query(). This is a convenience for type
 # annotations.
@@ -160,7 +195,10 @@ def Get(
   return session.query(model).filter_by(**kwargs).first()
 
 
-def CreateEngine(url: str, must_exist: bool = False) -> sql.engine.Engine:
+def CreateEngine(url: str,
+                 must_exist: bool = False,
+                 sqlite_profile: Optional[str] = None,
+                 ) -> sql.engine.Engine:
   """Create an sqlalchemy database engine.
 
   This is a convenience wrapper for creating an sqlalchemy engine, that also
@@ -205,6 +243,9 @@ def CreateEngine(url: str, must_exist: bool = False) -> sql.engine.Engine:
     url: The URL of the database to connect to.
     must_exist: If True, raise DatabaseNotFound if it doesn't exist. Else,
         database is created if it doesn't exist.
+    sqlite_profile: The key of SQLITE_PROFILES to configure SQLite connections
+        with. An explicit --sqlite_profile takes precedence, and is the
+        default.
 
   Returns:
     An SQLalchemy Engine instance.
@@ -301,6 +342,21 @@ def CreateEngine(url: str, must_exist: bool = False) -> sql.engine.Engine:
     pool_pre_ping=FLAGS.sqlutil_pool_pre_ping,
     **engine_args,
   )
+  if url.startswith("sqlite://"):
+    # An explicit --sqlite_profile overrides the choice of the database.
+    if sqlite_profile is None or FLAGS["sqlite_profile"].present:
+      profile = FLAGS.sqlite_profile
+    else:
+      profile = sqlite_profile
+    if profile not in SQLITE_PROFILES:
+      raise ValueError(f"Unknown SQLite profile '{profile}'")
+    pragmas = SQLITE_PROFILES[profile]
+    if url == "sqlite://":
+      # In-memory databases have neither a journal file nor pages to map.
+      pragmas = [(k, v) for k, v in pragmas if k not in {"journal_mode", "mmap_size"}]
+    sql.event.listen(
+      engine, "connect", functools.partial(SetSqlitePragmasCallback, pragmas)
+    )
 
   # Create and immediately close a connection. This is because SQLAlchemy engine
   # is lazily instantiated, so for connections such as SQLite, this line
@@ -425,12 +481,28 @@ class Session(orm.session.Session):
     return GetOrAdd(self, model, defaults, **kwargs)
 
 
+def SetSqlitePragmasCallback(pragmas, dbapi_connection, connection_record):
+  """Configure a new SQLite connection with the PRAGMAs of its profile.
+
+  See --sqlite_profile for details.
+  """
+  del connection_record
+  cursor = dbapi_connection.cursor()
+  for key, value in pragmas:
+    cursor.execute(f"PRAGMA {key}={value}")
+  cursor.close()
+
 class Database(object):
   """A base class for implementing databases."""
 
   SessionType = Session
 
-  def __init__(self, url: str, declarative_base, must_exist: bool = False):
+  def __init__(self,
+               url: str,
+               declarative_base,
+               must_exist: bool = False,
+               sqlite_profile: Optional[str] = None,
+               ):
     """Instantiate a database object.
 
     Example:
@@ -442,13 +514,16 @@ class Database(object):
       declarative_base: The SQLAlchemy declarative base instance.
       must_exist: If True, raise DatabaseNotFound if it doesn't exist. Else,
         database is created if it doesn't exist.
+      sqlite_profile: The SQLITE_PROFILES key of an SQLite database. An
+        explicit --sqlite_profile takes precedence, and is the default.
 
     Raises:
       DatabaseNotFound: If the database does not exist and must_exist is set.
       ValueError: If the datastore backend is not supported.
     """
     self._url = url
-    self.engine = CreateEngine(url, must_exist=must_exist)
+    self._declarative_base = declarative_base
+    self.engine = CreateEngine(url, must_exist=must_exist, sqlite_profile=sqlite_profile)
     declarative_base.metadata.create_all(self.engine)
     declarative_base.metadata.bind = self.engine
 
@@ -496,7 +571,14 @@ class Database(object):
     elif self.url.startswith("sqlite:///"):
       path = pathlib.Path(self.url[len("sqlite:///") :])
       assert path.is_file()
+      self.engine.dispose()
       path.unlink()
+      # Write-ahead log files of the 'wal' and 'performance' profiles.
+      for suffix in ("-wal", "-shm"):
+        try:
+          pathlib.Path(str(path) + suffix).unlink()
+        except FileNotFoundError:
+          pass
     else:
       raise NotImplementedError(
         f"Unsupported operation DROP for database: '{self.url}'",
@@ -507,6 +589,40 @@ class Database(object):
     """Return the URL of the database."""
     return self._url
 
+  def CreateMissingColumns(self) -> None:
+    """Add nullable columns of the schema that databases of older versions lack.
+
+    Columns are added with ALTER TABLE, so they hold NULL in existing rows.
+    """
+    inspector = sql.inspect(self.engine)
+    for table in self._declarative_base.metadata.sorted_tables:
+      existing = set(c["name"] for c in inspector.get_columns(table.name))
+      for column in table.columns:
+        if column.name not in existing:
+          if not column.nullable:
+            raise ValueError(
+              f"Cannot add non-nullable column {table.name}.{column.name} to {self.url}"
+            )
+          l.getLogger().info(f"Adding column {table.name}.{column.name} to {self.url}")
+          column_type = column.type.compile(dialect=self.engine.dialect)
+          self.engine.execute(
+            f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+          )
+
+  def CreateMissingIndexes(self) -> None:
+    """Create indexes of the schema that databases of older versions lack.
+
+    create_all() only creates missing tables, so indexes added to the schema
+    of an existing table have to be created explicitly.
+    """
+    inspector = sql.inspect(self.engine)
+    for table in self._declarative_base.metadata.sorted_tables:
+      existing = set(i["name"] for i in inspector.get_indexes(table.name))
+      for index in table.indexes:
+        if index.name not in existing:
+          l.getLogger().info(f"Creating index {index.name} on {self.url}")
+          index.create(self.engine)
+
   @contextlib.contextmanager
   def Session(
     self, commit: bool = False, session: Optional[Session] = None
@@ -831,6 +947,80 @@ def ResilientAddManyAndCommit(db: Database, mapped: typing.Iterable[Base]):
   return failures
 
 
+def MergeShards(
+  db: Database,
+  shard_paths: typing.Iterable[pathlib.Path],
+  table: sql.Table,
+  keep_primary_key: bool = True,
+) -> int:
+  """Append the rows of a table of SQLite shard databases to a SQLite database.
+
+  Each shard is attached to the database and its rows are copied with a
+  single INSERT ... SELECT in primary key order. Merged shards are deleted.
+
+  A shard is first renamed to a name of its own, and that name is recorded
+  in the merged_shards table of the database in the transaction that copies
+  its rows. A shard left behind by a crash before its deletion is skipped by
+  the next merge, and no new shard can take its name.
+
+  Args:
+    db: The SQLite database to merge the shards into.
+    shard_paths: Paths of SQLite databases which contain the table.
+    table: The table to merge.
+    keep_primary_key: If False, the primary key of the shard rows is dropped
+      and the database assigns new ones.
+
+  Returns:
+    The number of merged rows.
+  """
+  if db.engine.dialect.name != "sqlite":
+    raise ValueError(f"Cannot merge SQLite shards into {db.url}")
+  columns = ", ".join(
+    c.name for c in table.columns if keep_primary_key or not c.primary_key
+  )
+  order = ", ".join(c.name for c in table.primary_key.columns)
+  merged = 0
+  with db.engine.connect() as connection:
+    connection.execute(
+      "CREATE TABLE IF NOT EXISTS main.merged_shards (name VARCHAR(255) PRIMARY KEY)"
+    )
+    for path in shard_paths:
+      if ".merging" not in path.name:
+        merging = path.with_name(f"{path.stem}.{uuid.uuid4().hex}.merging{path.suffix}")
+        for suffix in ("-wal", "-shm", ""):
+          if pathlib.Path(str(path) + suffix).exists():
+            os.replace(str(path) + suffix, str(merging) + suffix)
+        path = merging
+      connection.execute(sql.text("ATTACH DATABASE :path AS shard"), path=str(path))
+      try:
+        with connection.begin():
+          done = connection.execute(
+            sql.text("SELECT 1 FROM main.merged_shards WHERE name = :name"),
+            name=path.name,
+          ).first()
+          if done is None:
+            result = connection.execute(
+              f"INSERT INTO main.{table.name} ({columns}) "
+              f"SELECT {columns} FROM shard.{table.name} ORDER BY {order}"
+            )
+            merged += result.rowcount
+            connection.execute(
+              sql.text("INSERT INTO main.merged_shards (name) VALUES (:name)"),
+              name=path.name,
+            )
+      finally:
+        connection.execute("DETACH DATABASE shard")
+      for suffix in ("", "-wal", "-shm"):
+        try:
+          pathlib.Path(str(path) + suffix).unlink()
+        except FileNotFoundError:
+          pass
+      connection.execute(
+        sql.text("DELETE FROM main.merged_shards WHERE name = :name"), name=path.name
+      )
+  return merged
+
+
 def QueryToString(query) -> str:
   """Compile the query to inline literals in place of '?' placeholders.
 
@@ -849,7 +1039,8 @@ class BufferedDatabaseWriter(threading.Thread):
   creating and committing a session for every object.
 
   This object spawns a separate thread for asynchronously performing database
-  writes. Use AddOne() and AddMany() methods to add objects to the write buffer.
+  writes. Each flush inserts the buffered objects with executemany-style bulk
+  INSERTs, falling back to ResilientAddManyAndCommit() if that fails. Use AddOne() and AddMany() methods to add objects to the write buffer.
   Note that because this is a multithreaded implementation, in-memory SQLite
   databases are not supported.
 
@@ -870,7 +1061,7 @@ class BufferedDatabaseWriter(threading.Thread):
     max_buffer_length: Optional[int] = None,
     max_seconds_since_flush: Optional[float] = None,
     log_level: int = 2,
-    ctx = None,
+    daemon: bool = False,
   ):
     """Constructor.
 
@@ -884,12 +1075,13 @@ class BufferedDatabaseWriter(threading.Thread):
         flushing.
       max_seconds_since_flush: The maximum number of elapsed seconds between
         flushes.
-      ctx: progress.ProgressContext = progress.NullContext,
-      log_level: The logging level for logging output.
+      log_level: Flushes are logged at info level if log_level <= 1, else at
+        debug level.
+      daemon: Run the writer in a daemon thread, which does not keep the
+        process alive. Buffered objects are lost unless Close() is called.
     """
-    super(BufferedDatabaseWriter, self).__init__()
+    super(BufferedDatabaseWriter, self).__init__(daemon=daemon)
     self.db = db
-    self.ctx = ctx
     self.log_level = log_level
 
     self.max_seconds_since_flush = max_seconds_since_flush
@@ -911,7 +1103,7 @@ class BufferedDatabaseWriter(threading.Thread):
 
     self.start()
 
-  def __enter__(self) -> "Buff":
+  def __enter__(self) -> "BufferedDatabaseWriter":
     """Enter a scoped writer context closes at the end."""
     return self
 
@@ -1058,9 +1250,15 @@ class BufferedDatabaseWriter(threading.Thread):
     if not mapped:
       return
 
-    failures = ResilientAddManyAndCommit(self.db, mapped)
+    try:
+      with self.db.Session(commit=True) as session:
+        session.bulk_save_objects(mapped)
+      return
+    except sql.exc.SQLAlchemyError:
+      # Bisect the batch to isolate the objects that can't be written.
+      failures = ResilientAddManyAndCommit(self.db, mapped)
     if failures:
-      self.ctx.Error("Logger failed to commit %d objects", len(failures))
+      l.getLogger().error("Logger failed to commit {} objects".format(len(failures)))
     self.error_count += len(failures)
 
   def _Flush(self):
@@ -1068,11 +1266,9 @@ class BufferedDatabaseWriter(threading.Thread):
     if not self._buffer:
       return
 
-    with self.ctx.Profile(
-      self.log_level,
-      f"Committed {self.buffer_length} rows "
-      f"({humanize.BinaryPrefix(self.buffer_size, 'B')}) to {self.db.url}",
-    ), self.db.Session() as session:
+    start = time.time()
+    buffer_length, buffer_size = self.buffer_length, self.buffer_size
+    with self.db.Session() as session:
       # Iterate through the buffer and handle any lambda ops.
       start_i, end_i = 0, 0
       for end_i, item in enumerate(self._buffer):
@@ -1090,3 +1286,7 @@ class BufferedDatabaseWriter(threading.Thread):
       self._last_flush = time.time()
       self.buffer_size = 0
       self.flush_count += 1
+    log = l.getLogger().info if self.log_level <= 1 else l.getLogger().debug
+    log("Committed {} rows ({}) to {} in {:.2f}s".format(
+      buffer_length, humanize.naturalsize(buffer_size, binary = True), self.db.url, time.time() - start)
+    )